@@ -0,0 +1,304 @@
+# benchmarks of the stages of the pipeline on a synthetic dataset, such that the performance can be measured at any scale without network access
+# every benchmark is run over all countries of the dataset and repeated, the fastest repeat is compared with the stored baseline of the scale
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+from importlib.metadata import version
+from contextlib import redirect_stdout
+from datetime import timedelta
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import utils
+import rendering
+import generate_charts_report
+import synthetic_data
+
+BASELINES_FILENAME = f'{BENCHMARK_DIR}/baselines.json'
+DATA_DIR = f'{BENCHMARK_DIR}/data'
+OUTPUT_DIR = 'benchmark_outputs/{country_iso3}'
+# the libraries of which the version is stored with the baseline, as the timings depend on them
+LIBRARIES = ['numpy', 'pandas', 'pyarrow', 'scipy', 'matplotlib', 'geopandas']
+# a benchmark regresses if its fastest repeat is this fraction slower than the baseline
+REGRESSION_TOLERANCE = 0.25
+SCALES = {
+    'small': {'countries': 1, 'admin_units': 34, 'dates': 60, 'quantiles': 23, 'vertices': 200},
+    'medium': {'countries': 3, 'admin_units': 100, 'dates': 90, 'quantiles': 23, 'vertices': 500},
+    'large': {'countries': 6, 'admin_units': 200, 'dates': 120, 'quantiles': 23, 'vertices': 1000},
+}
+
+
+class Country:
+    """
+    The inputs of one country of the synthetic dataset, shared by the benchmarks
+    Args:
+        country_iso3: iso3 code of the country
+        parameters: country specific parameters, from the config of the dataset
+    """
+    def __init__(self, country_iso3, parameters):
+        self.country_iso3 = country_iso3
+        self.parameters = parameters
+        self.output_dir = OUTPUT_DIR.format(country_iso3=country_iso3)
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def new_session(self):
+        return utils.DataSession(self.country_iso3, self.parameters, generate_charts_report.WHO_COVID_FILENAME)
+
+
+def remove_cache(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def get_benchmarks(countries, dates):
+    """
+    Define the benchmarks
+    Args:
+        countries: list of Country
+        dates: ReportDates of the assessment of the dataset
+    Returns:
+        list of (name, setup, run) tuples, setup is called before every repeat and isn't timed
+    """
+    inputs = {}
+
+    def load_inputs():
+        # the inputs of the quality checks and Reff estimates are loaded once, such that only the computation is timed
+        if inputs:
+            return
+        for country in countries:
+            session = country.new_session()
+            inputs[country.country_iso3] = {
+                'who': session.get_who(dates.earliest, dates.four_weeks),
+                'subnational': session.get_subnational_covid_data(True, dates.earliest, dates.four_weeks),
+                'bucky_adm0': session.get_bucky('adm0', dates.earliest, dates.four_weeks, 'npi'),
+                'bucky_adm1': session.get_bucky('adm1', dates.earliest, dates.four_weeks, 'npi'),
+                'reff_adm0': session.get_bucky('adm0', dates.tomorrow, dates.four_weeks, 'npi', columns=['cumulative_reported_cases'], quantiles=[0.5]),
+                'reff_adm1': session.get_bucky('adm1', dates.tomorrow, dates.four_weeks, 'npi', columns=['cumulative_reported_cases'], as_cube=True),
+            }
+
+    def remove_bucky_caches():
+        remove_cache(utils.BUCKY_CACHE_DIR)
+
+    def remove_who_cache():
+        remove_cache(utils.WHO_CACHE_DIR)
+
+    def remove_shapefile_cache():
+        remove_cache(utils.SHAPEFILE_CACHE_DIR)
+
+    def for_all_countries(function):
+        return lambda: [function(country) for country in countries]
+
+    def quality_check(check, *args):
+        # run a quality check on every source it is run on by quality_check_allsources
+        def run(country):
+            country_inputs = inputs[country.country_iso3]
+            for name in ['who', 'subnational', 'bucky_adm0', 'bucky_adm1']:
+                check(country_inputs[name], name, *args)
+        return run
+
+    def get_charts(country):
+        session = country.new_session()
+        return (generate_charts_report.generate_data_model_comparison(session, country.country_iso3, country.parameters, dates, country.output_dir)
+                + generate_charts_report.generate_data_model_comparison_lifetime(session, country.country_iso3, country.parameters, dates, country.output_dir))
+
+    def get_maps(country):
+        session = country.new_session()
+        regions = utils.shapefile_registry.get_shapefile(country.parameters['shape'])[[country.parameters['adm1_pcode'], 'geometry']]
+        maps = []
+        for metric, date in [('hospitalizations_per_100k', dates.tomorrow), ('daily_reported_cases_per_100k', dates.tomorrow + timedelta(days=1)),
+                             ('daily_cases_total_per_100k', dates.tomorrow + timedelta(days=1)), ('daily_reported_cases_per_100k', dates.two_weeks),
+                             ('daily_cases_total_per_100k', dates.two_weeks)]:
+            maps.append(generate_charts_report.create_subnational_map_incidence_100k(
+                session, metric, country.country_iso3, country.parameters, regions, date, metric, f'{country.output_dir}/map_{metric}_{date}.png'))
+        return maps
+
+    return [
+        ('get_bucky_adm0_cold', remove_bucky_caches,
+         for_all_countries(lambda c: [c.new_session().get_bucky('adm0', dates.earliest, dates.four_weeks, npi_filter) for npi_filter in ['npi', 'no_npi']])),
+        ('get_bucky_adm1_cold', remove_bucky_caches,
+         for_all_countries(lambda c: [c.new_session().get_bucky('adm1', dates.earliest, dates.four_weeks, npi_filter) for npi_filter in ['npi', 'no_npi']])),
+        ('get_bucky_adm0', None,
+         for_all_countries(lambda c: [c.new_session().get_bucky('adm0', dates.earliest, dates.four_weeks, npi_filter) for npi_filter in ['npi', 'no_npi']])),
+        ('get_bucky_adm1', None,
+         for_all_countries(lambda c: [c.new_session().get_bucky('adm1', dates.earliest, dates.four_weeks, npi_filter) for npi_filter in ['npi', 'no_npi']])),
+        ('get_bucky_adm1_date', None,
+         for_all_countries(lambda c: c.new_session().get_bucky('adm1', dates.two_weeks, dates.two_weeks, 'npi', quantiles=[0.5]))),
+        ('get_who_cold', remove_who_cache, for_all_countries(lambda c: c.new_session().get_who(dates.earliest, dates.today))),
+        ('get_who', None, for_all_countries(lambda c: c.new_session().get_who(dates.earliest, dates.today))),
+        ('get_subnational_covid_data', None,
+         for_all_countries(lambda c: utils.get_subnational_covid_data(c.parameters, True, dates.earliest, dates.today))),
+        ('get_shapefile_cold', remove_shapefile_cache,
+         for_all_countries(lambda c: utils.ShapefileRegistry().get_shapefile(c.parameters['shape']))),
+        ('quality_check_nan', load_inputs, for_all_countries(quality_check(utils.quality_check_nan))),
+        ('quality_check_negative', load_inputs, for_all_countries(quality_check(utils.quality_check_negative))),
+        ('quality_check_nondecreasing', load_inputs, for_all_countries(quality_check(utils.quality_check_nondecreasing))),
+        ('quality_check_missing_dates', load_inputs, for_all_countries(quality_check(utils.quality_check_missing_dates, dates.today))),
+        ('quality_check_allsources', None,
+         for_all_countries(lambda c: utils.quality_check_allsources(c.new_session(), c.country_iso3, c.parameters, dates.earliest, dates.four_weeks, dates.today))),
+        ('get_bucky_dt_reff', load_inputs, for_all_countries(lambda c: utils.get_bucky_dt_reff(inputs[c.country_iso3]['reff_adm0']))),
+        ('get_bucky_dt_reff_distribution', load_inputs,
+         for_all_countries(lambda c: utils.get_bucky_dt_reff_distribution(inputs[c.country_iso3]['reff_adm1']))),
+        ('calculate_subnational_trends', None,
+         for_all_countries(lambda c: generate_charts_report.calculate_subnational_trends(c.new_session(), c.country_iso3, c.parameters, dates, c.output_dir))),
+        ('render_charts', None, lambda: rendering.render_charts([chart for country in countries for chart in get_charts(country)])),
+        ('render_maps', None, lambda: rendering.render_charts([chart for country in countries for chart in get_maps(country)])),
+        ('report', None,
+         for_all_countries(lambda c: generate_charts_report.main(c.country_iso3, parameters=c.parameters, output_folder=c.output_dir, offline=True, force=True))),
+        ('report_metrics_only', None,
+         for_all_countries(lambda c: generate_charts_report.main(c.country_iso3, parameters=c.parameters, output_folder=c.output_dir, offline=True, force=True,
+                                                                 metrics_only=True))),
+    ]
+
+
+def get_library_versions():
+    return {library: version(library) for library in LIBRARIES}
+
+
+def run_benchmark(setup, run, repeat):
+    # the time of every repeat in seconds, the output of the pipeline is suppressed
+    times = []
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def get_dataset(scale, data_dir):
+    """
+    Retrieve the synthetic dataset of a scale, it is only generated again if the scale changed
+    Args:
+        scale: dict with the arguments of synthetic_data.generate_dataset
+        data_dir: directory of the dataset
+    Returns:
+        the description of the dataset
+    """
+    dataset = synthetic_data.read_dataset(data_dir)
+    if dataset is not None and dataset['scale'] == {**scale, 'seed': 0}:
+        return dataset
+    remove_cache(data_dir)
+    print(f'Generating synthetic dataset in {data_dir}')
+    return synthetic_data.generate_dataset(data_dir, **scale)
+
+
+def read_baselines():
+    if not os.path.exists(BASELINES_FILENAME):
+        return {}
+    with open(BASELINES_FILENAME, 'r') as f:
+        return json.load(f)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Print the results next to the baseline
+    Args:
+        results: dict with per benchmark the times of the repeats
+        baseline: the baseline of the scale, or None
+        tolerance: fraction that a benchmark may be slower than its baseline
+    Returns:
+        list with the names of the benchmarks that regressed
+    """
+    regressions = []
+    print(f'{"benchmark":32s} {"min (s)":>10s} {"median (s)":>10s} {"baseline":>10s} {"ratio":>7s}')
+    for name, times in results.items():
+        fastest = min(times)
+        line = f'{name:32s} {fastest:10.4f} {statistics.median(times):10.4f}'
+        if baseline is not None and name in baseline['benchmarks']:
+            ratio = fastest / baseline['benchmarks'][name]
+            line += f' {baseline["benchmarks"][name]:10.4f} {ratio:7.2f}'
+            if ratio > 1 + tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic dataset')
+    parser.add_argument('--scale', choices=list(SCALES), default='small', help='scale of the synthetic dataset')
+    parser.add_argument('--countries', type=int, help='number of countries, overrides the scale')
+    parser.add_argument('--admin-units', type=int, help='number of admin1 regions per country, overrides the scale')
+    parser.add_argument('--dates', type=int, help='number of projected dates, overrides the scale')
+    parser.add_argument('--quantiles', type=int, help='number of quantiles, overrides the scale')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times every benchmark is run')
+    parser.add_argument('-b', '--benchmark', action='append', help='only run the given benchmark, can be given several times')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE, help='fraction that a benchmark may be slower than its baseline')
+    parser.add_argument('--update-baselines', action='store_true', help='store the results as the baseline of the scale')
+    return parser.parse_args()
+
+
+def main(scale_name, scale, repeat, benchmark_names=None, tolerance=REGRESSION_TOLERANCE, update_baselines=False):
+    """
+    Run the benchmarks and compare them with the baseline of the scale
+    Args:
+        scale_name: name under which the baseline is stored, the name of a preset or custom
+        scale: dict with the arguments of synthetic_data.generate_dataset
+        repeat: number of times every benchmark is run
+        benchmark_names: the benchmarks to run. If None, all benchmarks are run
+        tolerance: fraction that a benchmark may be slower than its baseline
+        update_baselines: if True, the results are stored as the baseline of the scale
+    Returns:
+        list with the names of the benchmarks that regressed
+    """
+    data_dir = f'{DATA_DIR}/{scale_name}'
+    dataset = get_dataset(scale, data_dir)
+    # the pipeline reads and writes relative to the working directory, so it runs in the directory of the dataset
+    os.chdir(data_dir)
+    utils.set_offline(True)
+    utils.config_logger(level='error')
+    config = utils.parse_yaml(generate_charts_report.CONFIG_FILE)
+    countries = [Country(country_iso3, config[country_iso3]) for country_iso3 in dataset['countries']]
+    dates = generate_charts_report.get_report_dates(synthetic_data.ASSESSMENT_DATE)
+
+    results = {}
+    for name, setup, run in get_benchmarks(countries, dates):
+        if benchmark_names and name not in benchmark_names:
+            continue
+        results[name] = run_benchmark(setup, run, repeat)
+
+    baselines = read_baselines()
+    baseline = baselines.get(scale_name)
+    if baseline is not None and baseline['scale'] != scale:
+        print(f'The baseline of {scale_name} was measured at another scale, it is not compared')
+        baseline = None
+    libraries = get_library_versions()
+    same_libraries = baseline is not None and baseline.get('libraries') == libraries
+    if baseline is not None and not same_libraries:
+        print(f'The baseline of {scale_name} was measured with other library versions: {baseline.get("libraries")}')
+    regressions = compare_with_baseline(results, baseline, tolerance)
+    if update_baselines:
+        # the timings of other benchmarks are only kept if they were measured with the same libraries
+        benchmarks = baseline['benchmarks'] if same_libraries else {}
+        benchmarks.update({name: min(times) for name, times in results.items()})
+        baselines[scale_name] = {'scale': scale, 'python': platform.python_version(), 'machine': platform.machine(),
+                                 'libraries': libraries, 'benchmarks': benchmarks}
+        with open(BASELINES_FILENAME, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Baseline of {scale_name} written to {BASELINES_FILENAME}')
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    scale = dict(SCALES[args.scale])
+    overrides = {'countries': args.countries, 'admin_units': args.admin_units, 'dates': args.dates, 'quantiles': args.quantiles}
+    scale.update({key: value for key, value in overrides.items() if value is not None})
+    scale_name = args.scale if scale == SCALES[args.scale] else 'custom'
+    regressions = main(scale_name, scale, args.repeat, args.benchmark, args.tolerance, args.update_baselines)
+    if regressions and not args.update_baselines:
+        print(f'{len(regressions)} benchmarks regressed: {", ".join(regressions)}')
+        sys.exit(1)
@@ -0,0 +1,254 @@
+# generator of a synthetic dataset with the layout of this repository, to benchmark the pipeline offline at any scale
+# per country it writes the bucky adm0 and adm1 quantile csv's of both scenarios, the subnational csv with HXL tags,
+# the npi sheet and an admin1 shapefile, plus the global WHO csv and a config.yml that refers to the local files
+import os
+import json
+import string
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import yaml
+from scipy.stats import norm
+from shapely.geometry import Polygon
+
+ASSESSMENT_DATE = '2021-02-24'
+FIRST_REPORTED_DATE = '2020-03-01'
+DATASET_FILENAME = 'dataset.json'
+# the quantiles that are always generated, as they are used by the report
+REQUIRED_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+BUCKY_COLUMNS = ['R_eff', 'active_asymptomatic_cases', 'case_reporting_rate', 'cumulative_cases', 'cumulative_deaths',
+                 'cumulative_deaths_per_100k', 'cumulative_reported_cases', 'cumulative_reported_cases_per_100k',
+                 'current_hospitalizations', 'current_hospitalizations_per_100k', 'current_icu_usage', 'current_vent_usage',
+                 'daily_cases', 'daily_deaths', 'daily_hospitalizations', 'daily_reported_cases', 'doubling_t', 'total_population']
+WHO_COLUMNS = ['Date_reported', ' Country_code', ' Country', ' WHO_region', ' New_cases', ' Cumulative_cases', ' New_deaths',
+               ' Cumulative_deaths']
+SUBNATIONAL_COLUMNS = ['#date', '#adm1+pcode', '#adm2+pcode', '#affected+infected+confirmed+total', '#affected+infected+dead+total']
+NPI_COLUMNS = ['ID', 'ISO3', 'acaps_category', 'acaps_measure', 'bucky_measure', 'start_date', 'end_date', 'affected_pcodes',
+               'compliance_level', 'final_input']
+ADM2_PER_ADM1 = 3
+# fraction of the days on which an admin2 region reports its numbers
+SUBNATIONAL_REPORTING_RATE = 0.3
+
+
+def get_country_codes(num_countries):
+    # the iso3 codes start with X, which is reserved for user-assigned codes, such that they don't collide with real countries
+    letters = string.ascii_uppercase
+    iso2_codes = [f'{letters[i // 26]}{letters[i % 26]}' for i in range(num_countries)]
+    return [(f'X{iso2}', iso2) for iso2 in iso2_codes]
+
+
+def get_quantiles(num_quantiles):
+    # evenly spaced quantiles symmetric around the median, including the quantiles that are used by the report
+    quantiles = np.round(np.linspace(0.01, 0.99, num_quantiles), 3) if num_quantiles > 1 else []
+    return np.array(sorted(set(quantiles) | set(REQUIRED_QUANTILES)))
+
+
+def generate_bucky(admins, populations, growth_rates, dates, quantiles, rng):
+    """
+    Generate bucky projections of which the daily reported cases grow exponentially, with a wider spread for the outer quantiles
+    Args:
+        admins: the code of every admin unit
+        populations: the population of every admin unit
+        growth_rates: the daily growth rate of the median projection of every admin unit
+        dates: the projected dates, the first date is the initialization of the model
+        quantiles: the quantiles to generate
+        rng: numpy random Generator
+    Returns:
+        DataFrame with the admin unit, date, quantile and a column per metric, sorted by date, admin unit and quantile
+    """
+    num_admins, num_dates, num_quantiles = len(admins), len(dates), len(quantiles)
+    # all arrays are shaped (date, admin, quantile)
+    days = np.arange(num_dates)[:, np.newaxis, np.newaxis]
+    population = np.asarray(populations, dtype=float)[np.newaxis, :, np.newaxis]
+    rate = (np.asarray(growth_rates)[:, np.newaxis] + 0.01 * norm.ppf(quantiles)[np.newaxis, :])[np.newaxis]
+    reporting_rate = rng.uniform(0.02, 0.1, num_admins)[np.newaxis, :, np.newaxis]
+    initial_cases = population * rng.uniform(1e-4, 1e-3, num_admins)[np.newaxis, :, np.newaxis]
+
+    daily_reported_cases = initial_cases / 200 * np.exp(rate * days)
+    cumulative_reported_cases = initial_cases + np.cumsum(daily_reported_cases, axis=0)
+    daily_cases = daily_reported_cases / reporting_rate
+    daily_deaths = 0.002 * daily_cases
+    cumulative_deaths = 0.02 * initial_cases + np.cumsum(daily_deaths, axis=0)
+    current_hospitalizations = 0.2 * daily_cases
+    shape = (num_dates, num_admins, num_quantiles)
+    values = {
+        'R_eff': 1 + 5 * rate,
+        'active_asymptomatic_cases': 4 * daily_cases,
+        'case_reporting_rate': reporting_rate,
+        'cumulative_cases': cumulative_reported_cases / reporting_rate,
+        'cumulative_deaths': cumulative_deaths,
+        'cumulative_deaths_per_100k': cumulative_deaths / population * 1e5,
+        'cumulative_reported_cases': cumulative_reported_cases,
+        'cumulative_reported_cases_per_100k': cumulative_reported_cases / population * 1e5,
+        'current_hospitalizations': current_hospitalizations,
+        'current_hospitalizations_per_100k': current_hospitalizations / population * 1e5,
+        'current_icu_usage': 0.25 * current_hospitalizations,
+        'current_vent_usage': 0.15 * current_hospitalizations,
+        'daily_cases': daily_cases,
+        'daily_deaths': daily_deaths,
+        'daily_hospitalizations': 0.03 * daily_cases,
+        'daily_reported_cases': daily_reported_cases,
+        # a shrinking epidemic doesn't double, it is given a long doubling time instead of a negative one
+        'doubling_t': np.log(2) / np.maximum(rate, 1e-3),
+        'total_population': population,
+    }
+    df = pd.DataFrame({'adm': np.tile(np.repeat(admins, num_quantiles), num_dates),
+                       'date': np.repeat([d.strftime('%Y-%m-%d') for d in dates], num_admins * num_quantiles),
+                       'quantile': np.tile(quantiles, num_dates * num_admins)})
+    for column in BUCKY_COLUMNS:
+        df[column] = np.broadcast_to(values[column], shape).ravel()
+    return df
+
+
+def write_bucky(output_dir, country_iso3, num_admin_units, dates, quantiles, rng):
+    for npi_filter, growth in [('npi', -0.01), ('no_npi', 0.02)]:
+        bucky_dir = f'{output_dir}/Bucky_results/{country_iso3}_{npi_filter}'
+        os.makedirs(bucky_dir, exist_ok=True)
+        populations = rng.lognormal(13, 0.8, num_admin_units)
+        growth_rates = growth + rng.normal(0, 0.01, num_admin_units)
+        df_adm1 = generate_bucky(np.arange(1, num_admin_units + 1), populations, growth_rates, dates, quantiles, rng)
+        df_adm1.rename(columns={'adm': 'adm1'}).to_csv(f'{bucky_dir}/adm1_quantiles.csv', index=False)
+        df_adm0 = generate_bucky([country_iso3], [populations.sum()], [growth], dates, quantiles, rng)
+        df_adm0.rename(columns={'adm': 'adm0'}).to_csv(f'{bucky_dir}/adm0_quantiles.csv', index=False)
+
+
+def generate_who(countries, dates, rng):
+    # daily reported numbers of every country, following a wave with noise
+    rows = []
+    days = np.arange(len(dates))
+    for country_iso3, country_iso2 in countries:
+        wave = 50 + 40 * np.sin(days / 30 + rng.uniform(0, 2 * np.pi))
+        new_cases = np.maximum(0, rng.normal(wave, 10)).astype(int)
+        new_deaths = new_cases // 30
+        rows.append(pd.DataFrame({WHO_COLUMNS[0]: [d.strftime('%Y-%m-%d') for d in dates], WHO_COLUMNS[1]: country_iso2,
+                                  WHO_COLUMNS[2]: f'Country {country_iso3}', WHO_COLUMNS[3]: 'EMRO',
+                                  WHO_COLUMNS[4]: new_cases, WHO_COLUMNS[5]: np.cumsum(new_cases),
+                                  WHO_COLUMNS[6]: new_deaths, WHO_COLUMNS[7]: np.cumsum(new_deaths)}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def generate_subnational(country_iso2, num_admin_units, dates, rng):
+    # cumulative numbers per admin2 region, reported on a random subset of the days
+    num_adm2 = num_admin_units * ADM2_PER_ADM1
+    reported = rng.uniform(size=(num_adm2, len(dates))) < SUBNATIONAL_REPORTING_RATE
+    cumulative_cases = np.cumsum(rng.integers(0, 20, size=reported.shape) * reported, axis=1)
+    cumulative_deaths = np.cumsum(rng.integers(0, 2, size=reported.shape) * reported, axis=1)
+    adm2, day = np.nonzero(reported)
+    df = pd.DataFrame({SUBNATIONAL_COLUMNS[0]: np.array([d.strftime('%Y-%m-%d') for d in dates])[day],
+                       SUBNATIONAL_COLUMNS[1]: [f'{country_iso2}{a // ADM2_PER_ADM1 + 1:02d}' for a in adm2],
+                       SUBNATIONAL_COLUMNS[2]: [f'{country_iso2}{a:04d}' for a in adm2],
+                       SUBNATIONAL_COLUMNS[3]: cumulative_cases[adm2, day],
+                       SUBNATIONAL_COLUMNS[4]: cumulative_deaths[adm2, day]})
+    return df.sort_values(SUBNATIONAL_COLUMNS[0], kind='mergesort')
+
+
+def get_cell_polygon(column, row, size, vertices):
+    # square cell of a grid, with the vertices spread over its boundary such that the rendering cost is similar to a real boundary
+    position = np.linspace(0, 4, max(vertices, 4), endpoint=False)
+    side, offset = np.floor(position), position % 1
+    x = np.select([side == 0, side == 1, side == 2], [offset, 1, 1 - offset], 0)
+    y = np.select([side == 0, side == 1, side == 2], [0, offset, 1], 1 - offset)
+    return Polygon(zip((column + 0.9 * x) * size, (row + 0.9 * y) * size))
+
+
+def generate_shapefile(country_iso2, num_admin_units, vertices):
+    # the admin1 regions are the cells of a square grid
+    columns = int(np.ceil(np.sqrt(num_admin_units)))
+    geometry = [get_cell_polygon(i % columns, i // columns, 1., vertices) for i in range(num_admin_units)]
+    return gpd.GeoDataFrame({'ADM1_PCODE': [f'{country_iso2}{i:02d}' for i in range(1, num_admin_units + 1)],
+                             'ADM1_EN': [f'Region {i}' for i in range(1, num_admin_units + 1)]},
+                            geometry=geometry, crs='EPSG:4326')
+
+
+def generate_npis(country_iso3, country_iso2, num_admin_units):
+    measures = [('Movement restrictions', 'Border closure', 'closing borders'),
+                ('Social distancing', 'Schools closure', 'school closure'),
+                ('Social distancing', 'Limit public gatherings', 'limit gatherings'),
+                ('Public health measures', 'Health screenings in airports and border crossings', '')]
+    return pd.DataFrame([{'ID': i + 1, 'ISO3': country_iso3, 'acaps_category': category, 'acaps_measure': measure,
+                          'bucky_measure': bucky_measure, 'start_date': '2020-03-15', 'end_date': '',
+                          'affected_pcodes': ', '.join(f'{country_iso2}{j:02d}' for j in range(1, min(num_admin_units, 3) + 1)),
+                          'compliance_level': 50, 'final_input': 'Yes' if bucky_measure else 'No'}
+                         for i, (category, measure, bucky_measure) in enumerate(measures)], columns=NPI_COLUMNS)
+
+
+def generate_dataset(output_dir, countries=1, admin_units=34, dates=60, quantiles=23, vertices=200, seed=0):
+    """
+    Write a synthetic dataset with the layout of the repository
+    Args:
+        output_dir: directory to write the dataset to, the pipeline is run with this as working directory
+        countries: number of countries
+        admin_units: number of admin1 regions per country
+        dates: number of projected dates of the bucky results, starting at the assessment date
+        quantiles: number of quantiles of the bucky results, the quantiles used by the report are always added
+        vertices: number of vertices of the boundary of every admin1 region
+        seed: seed of the random generator
+    Returns:
+        dict with the scale of the dataset and the iso3 codes of the countries
+    """
+    rng = np.random.default_rng(seed)
+    assessment_date = datetime.strptime(ASSESSMENT_DATE, '%Y-%m-%d').date()
+    bucky_dates = [assessment_date + timedelta(days=i) for i in range(dates)]
+    reported_dates = pd.date_range(FIRST_REPORTED_DATE, assessment_date)
+    quantile_values = get_quantiles(quantiles)
+    country_codes = get_country_codes(countries)
+
+    config = {}
+    for country_iso3, country_iso2 in country_codes:
+        write_bucky(output_dir, country_iso3, admin_units, bucky_dates, quantile_values, rng)
+        country_dir = f'{output_dir}/Inputs/{country_iso3}'
+        os.makedirs(country_dir, exist_ok=True)
+        generate_subnational(country_iso2, admin_units, reported_dates, rng).to_csv(f'{country_dir}/{country_iso3}_COVID.csv', index=False)
+        generate_npis(country_iso3, country_iso2, admin_units).to_csv(f'{country_dir}/npis.csv', index=False)
+        shape = f'Shapes/{country_iso3.lower()}_adm1/{country_iso3.lower()}_adm1.shp'
+        os.makedirs(os.path.dirname(f'{output_dir}/{shape}'), exist_ok=True)
+        generate_shapefile(country_iso2, admin_units, vertices).to_file(f'{output_dir}/{shape}', encoding='UTF-8')
+        # the paths are relative to the dataset directory, local paths are read directly by fetch_url
+        config[country_iso3] = {'subnational_cases_url': f'Inputs/{country_iso3}/{country_iso3}_COVID.csv',
+                                'subnational_cases_source': 'Synthetic (subnational)',
+                                'iso2_code': country_iso2,
+                                'adm1_name': 'ADM1_EN',
+                                'adm1_pcode': 'ADM1_PCODE',
+                                'shape': shape,
+                                'npis_url': f'Inputs/{country_iso3}/npis.csv'}
+
+    os.makedirs(f'{output_dir}/WHO_data', exist_ok=True)
+    generate_who(country_codes, reported_dates, rng).to_csv(f'{output_dir}/WHO_data/WHO-COVID-19-global-data.csv', index=False)
+    os.makedirs(f'{output_dir}/automated_reports/report_metrics', exist_ok=True)
+    with open(f'{output_dir}/config.yml', 'w') as f:
+        yaml.safe_dump(config, f)
+    dataset = {'scale': {'countries': countries, 'admin_units': admin_units, 'dates': dates, 'quantiles': quantiles,
+                         'vertices': vertices, 'seed': seed},
+               'countries': list(config)}
+    # the description is written last, such that an interrupted generation is not mistaken for a complete dataset
+    with open(f'{output_dir}/{DATASET_FILENAME}', 'w') as f:
+        json.dump(dataset, f, indent=2)
+    return dataset
+
+
+def read_dataset(output_dir):
+    # the description of the dataset in output_dir, or None if there is no complete dataset
+    if not os.path.exists(f'{output_dir}/{DATASET_FILENAME}'):
+        return None
+    with open(f'{output_dir}/{DATASET_FILENAME}', 'r') as f:
+        return json.load(f)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset to benchmark the pipeline with')
+    parser.add_argument('output_dir', help='directory to write the dataset to')
+    parser.add_argument('--countries', type=int, default=1, help='number of countries')
+    parser.add_argument('--admin-units', type=int, default=34, help='number of admin1 regions per country')
+    parser.add_argument('--dates', type=int, default=60, help='number of projected dates')
+    parser.add_argument('--quantiles', type=int, default=23, help='number of quantiles')
+    parser.add_argument('--vertices', type=int, default=200, help='number of vertices per admin1 region')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dataset = generate_dataset(args.output_dir, args.countries, args.admin_units, args.dates, args.quantiles, args.vertices, args.seed)
+    print(f'Synthetic dataset of {len(dataset["countries"])} countries written to {args.output_dir}')
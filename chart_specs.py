@@ -0,0 +1,53 @@
+# descriptions of the figures, which are made while computing the metrics and rendered afterwards by rendering.py
+# the specs only hold the data that is drawn, such that describing a figure doesn't import matplotlib or geopandas
+
+
+class ChartSpec:
+    """
+    Description of a figure as the list of drawing operations to apply on a new subplot.
+    It only holds the data that is drawn, such that it can be pickled and rendered in another process
+    Args:
+        fig_title: the title of the figure
+        output_file: the path to save the figure to
+    """
+    def __init__(self, fig_title, output_file):
+        self.fig_title = fig_title
+        self.output_file = output_file
+        self.operations = []
+
+    def axis(self, method, *args, **kwargs):
+        # call method on the axis of the figure, e.g. spec.axis('scatter', x, y) for axis.scatter(x, y)
+        self.operations.append(('axis', method, args, kwargs))
+
+    def figure(self, method, *args, **kwargs):
+        # call method on the figure, e.g. spec.figure('tight_layout') for fig.tight_layout()
+        self.operations.append(('figure', method, args, kwargs))
+
+    def plot(self, data, **kwargs):
+        # plot a pandas or geopandas object on the axis of the figure, i.e. data.plot(ax=axis, **kwargs)
+        self.operations.append(('data', 'plot', (data,), kwargs))
+
+
+class MapSpec(ChartSpec):
+    """
+    ChartSpec of a choropleth map of admin regions. The maps of the same shapefile are rendered on one figure,
+    on which the regions are drawn once and only recolored per map, see rendering.render_maps.
+    The operations of the spec are applied after the regions are colored
+    Args:
+        fig_title: the title of the figure
+        output_file: the path to save the figure to
+        shape: path to the shapefile of the regions, which identifies the maps that share their regions
+        regions: GeoSeries with the geometry of the admin regions
+        values: array with the value of every region. Regions with a nan value are not colored
+        colors: the colors of the colormap, from the lowest to the highest value
+        bins: the boundaries of the bins of the values, every bin has one color of the colormap
+        boundary_kwargs: keyword arguments to plot the boundaries of the regions with
+    """
+    def __init__(self, fig_title, output_file, shape, regions, values, colors, bins, boundary_kwargs):
+        super().__init__(fig_title, output_file)
+        self.shape = shape
+        self.regions = regions
+        self.values = values
+        self.colors = colors
+        self.bins = bins
+        self.boundary_kwargs = boundary_kwargs
@@ -1,27 +1,21 @@
 import os
+import json
 import shutil
-import geopandas as gpd
+from collections import namedtuple
 from datetime import datetime,timedelta
-import sys
-import matplotlib
-import matplotlib.colors as mcolors
+import numpy as np
+import pandas as pd
 
 import utils
-from utils import *
-
-country_iso_3 = sys.argv[1]
+import manifest
+import metrics_store
+import profiler
+from utils import (DataSession, HLX_TAG_TOTAL_CASES, HLX_TAG_TOTAL_DEATHS, config_logger, download_who_covid_data, fetch_url,
+                   get_bucky_dt_reff_distribution, lighten_color, parse_args, quality_check_allsources, quality_check_negative,
+                   set_offline, shapefile_registry)
+from chart_specs import ChartSpec, MapSpec
 
 ASSESSMENT_DATE='2021-02-24' # Wednesday's date
-#today is the last date to retrieve historical data for
-TODAY = datetime.strptime(ASSESSMENT_DATE, '%Y-%m-%d').date()
-#tomorrow is the first date to use to calculate numbers on the projections, i.e. bucky output
-#The first date of the bucky results, is used as initialization and thus those numbers are not reliable.
-# Hence, if first date of bucky results=TODAY, then using TODAY as start date of the projections would produce incorrect numbers.
-# To circumvent that we always use TOMORROW as start date of the projections
-TOMORROW = TODAY+timedelta(days=1)
-FOUR_WEEKS = TOMORROW + timedelta(days=28)
-TWO_WEEKS = TOMORROW + timedelta(days=14)
-LAST_TWO_MONTHS = TODAY - timedelta(days=60)
 EARLIEST_DATE = datetime.strptime('2020-02-24', '%Y-%m-%d').date()
 
 #these are the quantile values to consider for min and max projected numbers
@@ -32,153 +26,280 @@ CONFIG_FILE = 'config.yml'
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 WHO_COVID_URL='https://covid19.who.int/WHO-COVID-19-global-data.csv'
 WHO_COVID_FILENAME='WHO_data/WHO-COVID-19-global-data.csv'
-RESULTS_FILENAME=f'automated_reports/report_metrics/{country_iso_3}_results.csv'
-OUTPUT_DIR=f'Outputs/{country_iso_3}/'
-NPISHEET_PATH=f'{OUTPUT_DIR}npis_googlesheet.csv'
+RESULTS_FILENAME='automated_reports/report_metrics/{country_iso3}_results.csv'
+QC_FILENAME='automated_reports/report_metrics/{country_iso3}_qc.json'
+OUTPUT_DIR='Outputs/{country_iso3}'
+NPISHEET_FILENAME='npis_googlesheet.csv'
+#bins and colors of the maps of the incidence per 100k, according to recommendations from https://globalhealth.harvard.edu/key-metrics-for-covid-suppression-researchers-and-public-health-experts-unite-to-bring-clarity-to-key-metrics-guiding-coronavirus-response/
+INCIDENCE_BINS=np.array([0,1,10,25,100000])
+INCIDENCE_COLORS=['#00a67e','#f8b931','#f88c29','#df431d']
+REFF_DISTRIBUTION_FILENAME='reff_distribution.csv'
+REFF_ADM1_FILENAME='ADM1_reff.csv'
 
 NPI_COLOR='green'
 NO_NPI_COLOR='red'
 WHO_DATA_COLOR='dodgerblue'
 SUBNATIONAL_DATA_COLOR='navy'
+#per metric of the projections, the bucky variable it is computed on and the title of its graph
+PROJECTION_METRICS={'daily_reported_cases':('daily_reported_cases','Daily reported cases'),
+                    'daily_deaths':('daily_deaths','Daily deaths'),
+                    'hospitalizations':('current_hospitalizations','People requiring healthcare support')}
 
-def main(country_iso3, download_covid=False,output_folder=OUTPUT_DIR):
+ReportDates = namedtuple('ReportDates', ['today', 'tomorrow', 'two_weeks', 'four_weeks', 'last_two_months', 'earliest'])
 
-    parameters = utils.parse_yaml(CONFIG_FILE)[country_iso3]
+def get_report_dates(assessment_date):
+    """
+    Compute the dates the report is made for
+    Args:
+        assessment_date: date of the assessment as a string in the format YYYY-MM-DD
+    Returns:
+        ReportDates with the dates relative to the assessment date
+    """
+    #today is the last date to retrieve historical data for
+    today = datetime.strptime(assessment_date, '%Y-%m-%d').date()
+    #tomorrow is the first date to use to calculate numbers on the projections, i.e. bucky output
+    #The first date of the bucky results, is used as initialization and thus those numbers are not reliable.
+    # Hence, if first date of bucky results=TODAY, then using TODAY as start date of the projections would produce incorrect numbers.
+    # To circumvent that we always use TOMORROW as start date of the projections
+    tomorrow = today+timedelta(days=1)
+    return ReportDates(today=today,
+                       tomorrow=tomorrow,
+                       two_weeks=tomorrow + timedelta(days=14),
+                       four_weeks=tomorrow + timedelta(days=28),
+                       last_two_months=today - timedelta(days=60),
+                       earliest=EARLIEST_DATE)
+
+def main(country_iso3, assessment_date=ASSESSMENT_DATE, download_covid=False, parameters=None, output_folder=None, render_jobs=1, offline=False, force=False,
+         profile=False, profile_memory=False, metrics_only=False):
+    """
+    Compute the metrics and produce the figures of the report of one country
+    Args:
+        country_iso3: iso3 code of the country of interest
+        assessment_date: date of the assessment as a string in the format YYYY-MM-DD
+        download_covid: if True, download the latest WHO data before computing the metrics
+        parameters: country specific parameters. If None, they are retrieved from the config
+        output_folder: folder to save the figures and csv's to. If None, Outputs/{country_iso3} is used
+        render_jobs: number of processes to render the figures with
+        offline: if True, the remote files are only retrieved from the local mirror
+        force: if True, all outputs are regenerated, also if their inputs didn't change
+        profile: if True, a summary and a chrome trace of the time spent per stage are written to profiles/
+        profile_memory: if True, the profile includes the peak memory per stage
+        metrics_only: if True, only the metrics and csv's are produced, without describing or rendering any figure
+    """
+    with profiler.profile_run(f'{country_iso3}_{assessment_date}', enabled=profile, trace_memory=profile_memory):
+        run_report(country_iso3, assessment_date, download_covid, parameters, output_folder, render_jobs, offline, force, metrics_only)
+
+
+def run_report(country_iso3, assessment_date, download_covid, parameters, output_folder, render_jobs, offline, force, metrics_only=False):
+    #see main for the arguments
+    set_offline(offline)
+    if parameters is None:
+        parameters = utils.parse_yaml(CONFIG_FILE)[country_iso3]
+    if output_folder is None:
+        output_folder = OUTPUT_DIR.format(country_iso3=country_iso3)
+    results_filename = RESULTS_FILENAME.format(country_iso3=country_iso3)
+    qc_filename = QC_FILENAME.format(country_iso3=country_iso3)
+    dates = get_report_dates(assessment_date)
     if download_covid:
         # Download latest covid file tiles and read them in
         download_who_covid_data(WHO_COVID_URL,f'{DIR_PATH}/{WHO_COVID_FILENAME}')
 
-    #function from utils to set plot parameters
-    set_matlotlib(plt)
     #set level to warning such that logger prints errors
     config_logger(level="warning")
 
-    #create folder if doesn't exist and if it exists empty the folder
-    #done such that old files with changed filenames are not lingering around in the output folder
-    if os.path.exists(output_folder):
-        shutil.rmtree(output_folder)
-    os.makedirs(output_folder)
-
     print('\n\n\n')
     print(f'{country_iso3}')
 
-    #retrieve file with previously computed metrics
-    if os.path.exists(RESULTS_FILENAME):
-        df_all=pd.read_csv(RESULTS_FILENAME)
-        #remove the rows that have same assessment date as current run
-        #-->make sure not duplicate results for the same date
-        df_all=df_all[df_all['assessment_date']!=str(TODAY)]
-    else:
-        df_all=pd.DataFrame()
+    #the outputs are only regenerated if any of the inputs changed since the previous run
+    os.makedirs(output_folder, exist_ok=True)
+    with profiler.span('manifest.get_run_inputs'):
+        run_inputs = manifest.get_run_inputs(country_iso3, parameters, assessment_date, WHO_COVID_FILENAME)
+    previous_manifest = manifest.read_manifest(output_folder)
+    if not force and manifest.is_up_to_date(previous_manifest, run_inputs):
+        print(f'Outputs of {country_iso3} are up to date')
+        return
+
+    #all the input data is read once and kept in memory for the rest of the run
+    session = DataSession(country_iso3, parameters, WHO_COVID_FILENAME)
 
     #check for negative, and decreasing cumulative values. Plus no data in last 14 days
-    quality_check_allsources(country_iso3, parameters, WHO_COVID_FILENAME, EARLIEST_DATE, FOUR_WEEKS,TODAY)
+    qc_issues = quality_check_allsources(session, country_iso3, parameters, dates.earliest, dates.four_weeks,dates.today)
+    #save the issues next to the metrics, such that they can be reviewed without going through the logs
+    with open(qc_filename, 'w') as f:
+        json.dump({'assessment_date': str(dates.today), 'country': country_iso3, 'issues': qc_issues}, f, indent=2)
 
     #compute metrics wrt to TODAY (can also be projections)
-    df_reff = extract_reff(country_iso3)
-    df_keyfigures = generate_key_figures(country_iso3,parameters)
-    df_hospitalizations = generate_model_projections(country_iso3, parameters)
+    df_reff, df_reff_distribution, df_reff_adm1 = extract_reff(session, country_iso3, parameters, dates)
+    df_reff_distribution.to_csv(f'{output_folder}/{REFF_DISTRIBUTION_FILENAME}', index=False)
+    df_reff_adm1.to_csv(f'{output_folder}/{REFF_ADM1_FILENAME}', index=False)
+    df_keyfigures = generate_key_figures(session, country_iso3, parameters, dates)
+    df_hospitalizations, projection_chart = generate_model_projections(session, country_iso3, parameters, dates, output_folder, draw=not metrics_only)
     #create dataframe with metrics computed wrt to TODAY
     results_df=pd.concat([df_reff,df_keyfigures,df_hospitalizations]).reset_index()
     results_df.columns=['metric_name','metric_value']
-    results_df['assessment_date'] = TODAY
-    results_df['country'] = f'{country_iso_3}'
-    #append metrics to file with metrics of all dates
-    df_all = df_all.append(results_df)
-    df_all.to_csv(RESULTS_FILENAME, index=False)
+    results_df['assessment_date'] = dates.today
+    results_df['country'] = f'{country_iso3}'
+    #save the metrics in the store, replacing the metrics of a previous run for the same date
+    #and export the metrics of all dates to the csv that is used by the report
+    with profiler.span('metrics_store', 'io'):
+        store = metrics_store.connect_metrics_store()
+        try:
+            #metrics computed before the store existed are imported from the csv
+            metrics_store.import_results_csv(store, country_iso3, results_filename)
+            metrics_store.upsert_metrics(store, country_iso3, dates.today, results_df[['metric_name','metric_value']].itertuples(index=False), replace=True)
+            metrics_store.export_results_csv(store, country_iso3, results_filename)
+        finally:
+            store.close()
 
     #calculate trends (being saved to separate csv within function)
-    calculate_subnational_trends(country_iso3, parameters)
+    calculate_subnational_trends(session, country_iso3, parameters, dates, output_folder)
 
     #retrieve active, modelled NPIS (Non Pharmeutical Interventions)
     #currently not used in report so not added to results_df
-    retrieve_current_npis(parameters['npis_url'],NPISHEET_PATH)
+    retrieve_current_npis(parameters['npis_url'],f'{output_folder}/{NPISHEET_FILENAME}')
 
     #retrieve the incidence (=NEW daily cases/100k) per admin and country average, for total and reported incidence
-    calculate_subnational_incidence(country_iso3, parameters, TOMORROW)
+    calculate_subnational_incidence(session, country_iso3, parameters, dates.tomorrow)
 
+    if metrics_only:
+        #the figures and the manifest are left as they are, such that the next full run renders the figures of the changed inputs
+        print(f'Metrics of {country_iso3} updated, no figures are rendered')
+        return
+
+    #the figures are only described while computing the metrics, and rendered all together at the end
+    charts = [projection_chart]
     #create graphs of cumulative cases, cumulative deaths, new daily cases, daily deaths
     #of last two months
-    generate_data_model_comparison(country_iso3,parameters)
+    charts += generate_data_model_comparison(session, country_iso3, parameters, dates, output_folder)
     #of start COVID
-    generate_data_model_comparison_lifetime(country_iso3,parameters)
+    charts += generate_data_model_comparison_lifetime(session, country_iso3, parameters, dates, output_folder)
 
+    #the admin1 regions are read once and shared by all maps, which are rendered on one figure
+    regions = shapefile_registry.get_shapefile(parameters['shape'])[[parameters['adm1_pcode'], 'geometry']]
     #active hospitalizations/100k TOMORROW
-    create_subnational_map_incidence_100k('hospitalizations_per_100k', country_iso3, parameters, TOMORROW, 'Current Reported Hospitalizations \n Per 100,000 People',
-                           'map_hospitalizations_per_100k_current.png')
+    charts.append(create_subnational_map_incidence_100k(session, 'hospitalizations_per_100k', country_iso3, parameters, regions, dates.tomorrow, 'Current Reported Hospitalizations \n Per 100,000 People',
+                           f'{output_folder}/map_hospitalizations_per_100k_current.png'))
     #new reported daily cases/100k on TOMORROW
     #set to TOMORROW instead of TODAY since on TODAY the output can be negative due to initialization
-    create_subnational_map_incidence_100k('daily_reported_cases_per_100k', country_iso3, parameters, TOMORROW+timedelta(days=1), 'Current Reported New Daily Cases \n Per 100,000 People',
-                           'map_dailyreportedcases_per_100k_current.png')
+    charts.append(create_subnational_map_incidence_100k(session, 'daily_reported_cases_per_100k', country_iso3, parameters, regions, dates.tomorrow+timedelta(days=1), 'Current Reported New Daily Cases \n Per 100,000 People',
+                           f'{output_folder}/map_dailyreportedcases_per_100k_current.png'))
     #new estimated total daily cases/100k (i.e. reported cases*reporting rate) on TOMORROW
-    create_subnational_map_incidence_100k('daily_cases_total_per_100k', country_iso3, parameters, TOMORROW+timedelta(days=1), 'Current Estimated Total New Daily Cases \n Per 100,000 People',
-                           'map_dailytotalcases_per_100k_current.png')
+    charts.append(create_subnational_map_incidence_100k(session, 'daily_cases_total_per_100k', country_iso3, parameters, regions, dates.tomorrow+timedelta(days=1), 'Current Estimated Total New Daily Cases \n Per 100,000 People',
+                           f'{output_folder}/map_dailytotalcases_per_100k_current.png'))
     #new reported daily cases/100k in TWO_WEEKS
-    create_subnational_map_incidence_100k('daily_reported_cases_per_100k', country_iso3, parameters, TWO_WEEKS, 'Projected Reported New Daily Cases \n Per 100,000 People',
-                           'map_dailyreportedcases_per_100k_2w.png')
+    charts.append(create_subnational_map_incidence_100k(session, 'daily_reported_cases_per_100k', country_iso3, parameters, regions, dates.two_weeks, 'Projected Reported New Daily Cases \n Per 100,000 People',
+                           f'{output_folder}/map_dailyreportedcases_per_100k_2w.png'))
     #new estimated total daily cases/100k in TWO_WEEKS
-    create_subnational_map_incidence_100k('daily_cases_total_per_100k', country_iso3, parameters, TWO_WEEKS, 'Projected Estimated Total New Daily Cases \n Per 100,000 People',
-                           'map_dailytotalcases_per_100k_2w.png')
+    charts.append(create_subnational_map_incidence_100k(session, 'daily_cases_total_per_100k', country_iso3, parameters, regions, dates.two_weeks, 'Projected Estimated Total New Daily Cases \n Per 100,000 People',
+                           f'{output_folder}/map_dailytotalcases_per_100k_2w.png'))
     #not being used in current report
     # create_binary_change_map(country_iso3, parameters)
 
-
+    #only the figures of which the data changed are rendered again
+    if force:
+        previous_manifest = {'inputs': None, 'artifacts': {}, 'charts': {}}
+    with profiler.span('manifest.get_stale_charts'):
+        stale_charts, chart_hashes = manifest.get_stale_charts(previous_manifest, charts)
+    print(f'Rendering {len(stale_charts)} of {len(charts)} figures')
+    #matplotlib and geopandas are only imported when the figures are rendered
+    from rendering import render_charts
+    render_charts(stale_charts, jobs=render_jobs)
+
+    with profiler.span('manifest.write_manifest'):
+        artifacts = {}
+        for filename in list(chart_hashes) + [f'{output_folder}/ADM1_ranking.csv', f'{output_folder}/{NPISHEET_FILENAME}', f'{output_folder}/{REFF_DISTRIBUTION_FILENAME}',
+                         f'{output_folder}/{REFF_ADM1_FILENAME}', results_filename, qc_filename]:
+            artifacts[filename] = manifest.get_content_hash(filename)
+        #done such that old files with changed filenames are not lingering around in the output folder
+        manifest.remove_orphans(output_folder, artifacts)
+        manifest.write_manifest(output_folder, run_inputs, artifacts, chart_hashes)
+
+
+@profiler.profiled()
 def retrieve_current_npis(npis_url,output_path):
     """
     Display the NPIs that are currently in place and are given as input to the model
     Note: these NPIs might not be fully up to date
     Args:
         npis_url: url to the csv with the list of all npis
-        output_path: path to where to save the npi csv while downloading
+        output_path: path to where to save the npi csv
     """
-    download_url(npis_url, output_path)
+    shutil.copyfile(fetch_url(npis_url), output_path)
     df_npis_sheet = pd.read_csv(output_path)
     #final_input==Yes indicates that the npi is given as input to the model
     df_npis_model = df_npis_sheet[df_npis_sheet['final_input'] == 'Yes']
     print('Currently in place NPIs')
     print(df_npis_model[['acaps_category', 'acaps_measure', 'bucky_measure', 'affected_pcodes', 'compliance_level', 'start_date','end_date']])
 
-def extract_reff(country_iso3):
+@profiler.profiled()
+def extract_reff(session,country_iso3,parameters,dates):
     """
     Calculate the estimated doubling time and the effective reproduction number of the coming four weeks, for the scenarios when current NPIs are in place and when they wouldn't
+    The estimates are computed for all quantiles, nationally and per admin1 region
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
+        parameters: country specific parameters, retrieved from config
+        dates: ReportDates of the assessment
     Returns:
         df_metrics: DataFrame containing the computed metrics
+        df_reff_distribution: DataFrame with the national doubling time and Reff per scenario and quantile
+        df_reff_adm1: DataFrame with the doubling time and Reff per admin1 region, scenario and quantile
     """
-    bucky_npi=get_bucky(country_iso3,admin_level='adm0',min_date=TOMORROW,max_date=FOUR_WEEKS,npi_filter='npi')
-    bucky_npi=bucky_npi[bucky_npi['quantile']==0.5]
-    #this is calculated over the period that is included in bucky_npi, so from TOMORROW till FOUR_WEEKS and is based on the reported cumulative cases
-    dt_npi,r_npi=get_bucky_dt_reff(bucky_npi)
+    #this is calculated over the period from TOMORROW till FOUR_WEEKS and is based on the reported cumulative cases
+    reff_distributions=[]
+    reff_adm1=[]
+    for npi_filter,scenario in [('npi','NPI'),('no_npi','No NPI')]:
+        bucky_adm0=session.get_bucky(admin_level='adm0',min_date=dates.tomorrow,max_date=dates.four_weeks,npi_filter=npi_filter,columns=['cumulative_reported_cases'],as_cube=True)
+        df_reff=get_bucky_dt_reff_distribution(bucky_adm0).drop(columns='adm')
+        df_reff.insert(0,'scenario',scenario)
+        reff_distributions.append(df_reff)
+        bucky_adm1=session.get_bucky(admin_level='adm1',min_date=dates.tomorrow,max_date=dates.four_weeks,npi_filter=npi_filter,columns=['cumulative_reported_cases'],as_cube=True)
+        df_reff=get_bucky_dt_reff_distribution(bucky_adm1).rename(columns={'adm':'adm1'})
+        df_reff.insert(1,'scenario',scenario)
+        reff_adm1.append(df_reff)
+    df_reff_distribution=pd.concat(reff_distributions,ignore_index=True)
+    df_reff_adm1=pd.concat(reff_adm1,ignore_index=True)
+
+    #the reported metrics are the estimates of the median projections
+    df_reff_median=df_reff_distribution[df_reff_distribution['quantile']==0.5].set_index('scenario')
+    dt_npi,r_npi=df_reff_median.loc['NPI','doubling_time'],df_reff_median.loc['NPI','Reff']
     #Reff= effective reproduction number, i.e. average number of secondary cases/infectious case in a population given the context, e.g. including measurements
     print(f'Estimated doubling time NPI {dt_npi}, Reff {r_npi}')
-
-    bucky_no_npi=get_bucky(country_iso3,admin_level='adm0',min_date=TOMORROW,max_date=FOUR_WEEKS,npi_filter='no_npi')
-    bucky_no_npi=bucky_no_npi[bucky_no_npi['quantile']==0.5]
-    dt_no_npi,r_no_npi=get_bucky_dt_reff(bucky_no_npi)
+    dt_no_npi,r_no_npi=df_reff_median.loc['No NPI','doubling_time'],df_reff_median.loc['No NPI','Reff']
     print(f'Estimated doubling time No NPI {dt_no_npi}, Reff {r_no_npi}')
 
+    adm1_pcode_prefix=parameters['iso2_code']
+    if country_iso3 == 'IRQ':
+        adm1_pcode_prefix='IQG'
+    df_reff_adm1['adm1']=adm1_pcode_prefix + df_reff_adm1['adm1'].apply(lambda x:  '{0:0=2d}'.format(int(x)))
+    shapefile = shapefile_registry.get_attributes(parameters['shape'],[parameters['adm1_pcode'],parameters['adm1_name']])
+    df_reff_adm1=df_reff_adm1.merge(shapefile,how='left',left_on='adm1',right_on=parameters['adm1_pcode']).drop(columns=parameters['adm1_pcode'])
+
     #create dict with all metrics
     dict_metrics={'Estimated doubling time NPI':dt_npi,'NPI Reff':r_npi,'Estimated doubling time No NPI':dt_no_npi,'No NPI Reff':r_no_npi}
     #convert dict to dataframe
     df_metrics=pd.DataFrame.from_dict(dict_metrics,orient='index')
-    return df_metrics
+    return df_metrics, df_reff_distribution, df_reff_adm1
 
-def generate_key_figures(country_iso3,parameters):
+@profiler.profiled()
+def generate_key_figures(session,country_iso3,parameters,dates):
     """
     Retrieve the current cumulative cases and deaths given by WHO, MPHO (subnational) and the model (Bucky).
     Moreover, compute the percentual change in new cases over the last week compared to the previous week based on WHO data
     And, compute the expected number of cumulative cases and deaths in four weeks, both with and without current NPIs in place, based on the model output.
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
 
+        dates: ReportDates of the assessment
     Returns:
         df_metrics: DataFrame containing the computed metrics
     """
     #This is the World Health Organization (WHO) data and is available on national level
     #all the numbers of WHO are reported numbers
-    who_covid=get_who(WHO_COVID_FILENAME,parameters['iso2_code'],min_date=LAST_TWO_MONTHS,max_date=TODAY)
+    who_covid=session.get_who(min_date=dates.last_two_months,max_date=dates.today)
     who_covid.index = pd.to_datetime(who_covid.index)
     who_lastdate=who_covid.index[-1]
     who_deaths_latest=who_covid.loc[who_lastdate,'Cumulative_deaths']
@@ -192,7 +313,7 @@ def generate_key_figures(country_iso3,parameters):
 
     # this is the data reported by the Ministry of Public Health (MPHO) and is available on subnational level
     # all the numbers of MPHO are reported numbers
-    subnational_covid = get_subnational_covid_data(parameters, aggregate=True, min_date=LAST_TWO_MONTHS, max_date=TODAY)
+    subnational_covid = session.get_subnational_covid_data(aggregate=True, min_date=dates.last_two_months, max_date=dates.today)
     subnational_covid.sort_index(inplace=True)
     subnational_lastdate = subnational_covid.iloc[-1].name.strftime('%Y-%m-%d')
     subnational_cases_latest = subnational_covid.iloc[-1][HLX_TAG_TOTAL_CASES].astype(int)
@@ -201,24 +322,24 @@ def generate_key_figures(country_iso3,parameters):
         f'Latest date of data by MPHO (subnational) was {subnational_lastdate}: {subnational_cases_latest} cumulative reported cases, {subnational_deaths_latest} cumulative reported deaths')
 
 
-    bucky_npi = get_bucky(country_iso3, admin_level='adm0', min_date=TOMORROW, max_date=FOUR_WEEKS, npi_filter='npi')
+    bucky_npi = session.get_bucky(admin_level='adm0', min_date=dates.tomorrow, max_date=dates.four_weeks, npi_filter='npi', as_cube=True)
 
     #cumulative cases TOMORROW - cumulative cases TODAY might not always equal the daily cases TOMORROW. This is due to the model being run several times after which the results are divided in quantiles.
-    bucky_npi_cases_tomorrow = round(bucky_npi[bucky_npi['quantile'] == 0.5].loc[TOMORROW, 'cumulative_reported_cases']).astype(int)
-    bucky_npi_cases_tomorrow_notrep = round(bucky_npi[bucky_npi['quantile'] == 0.5].loc[TOMORROW, 'cumulative_cases']).astype(int)
-    bucky_npi_deaths_tomorrow = round(bucky_npi[bucky_npi['quantile'] == 0.5].loc[TOMORROW, 'cumulative_deaths']).astype(int)
-    bucky_npi_daily_deaths_tomorrow = round(bucky_npi[bucky_npi['quantile'] == 0.5].loc[TOMORROW, 'daily_deaths']).astype(int)
-    reporting_rate = bucky_npi['case_reporting_rate'].mean() * 100
+    bucky_npi_cases_tomorrow = int(round(bucky_npi.value('cumulative_reported_cases', dates.tomorrow)))
+    bucky_npi_cases_tomorrow_notrep = int(round(bucky_npi.value('cumulative_cases', dates.tomorrow)))
+    bucky_npi_deaths_tomorrow = int(round(bucky_npi.value('cumulative_deaths', dates.tomorrow)))
+    bucky_npi_daily_deaths_tomorrow = int(round(bucky_npi.value('daily_deaths', dates.tomorrow)))
+    reporting_rate = bucky_npi.mean('case_reporting_rate') * 100
     print(
-        f'Current situation Bucky {TOMORROW}: {bucky_npi_cases_tomorrow:.0f} cumulative reported cases, {bucky_npi_deaths_tomorrow:.0f} cumulative reported deaths')
-    print(f'Current situation Bucky {TOMORROW}: {bucky_npi_cases_tomorrow_notrep:.0f} cumulative estimated total cases')
-    print(f'Current situation Bucky {TOMORROW}: {bucky_npi_daily_deaths_tomorrow:.0f} daily deaths')
+        f'Current situation Bucky {dates.tomorrow}: {bucky_npi_cases_tomorrow:.0f} cumulative reported cases, {bucky_npi_deaths_tomorrow:.0f} cumulative reported deaths')
+    print(f'Current situation Bucky {dates.tomorrow}: {bucky_npi_cases_tomorrow_notrep:.0f} cumulative estimated total cases')
+    print(f'Current situation Bucky {dates.tomorrow}: {bucky_npi_daily_deaths_tomorrow:.0f} daily deaths')
     print(f'- ESTIMATED CASE REPORTING RATE {reporting_rate:.0f}%')
 
     #calculate average over 7 last 7 days for the WHO data (MPHO data is too sparse to compute this on)
     #select the last week and use rolling, which returns nan if less than min_periods datapoints
     who_covid_7days=who_covid.loc[who_lastdate - timedelta(days=6):who_lastdate, ["New_cases", "New_deaths"]]
-    who_negative_values=quality_check_negative(who_covid_7days,"WHO")
+    who_negative_values=bool(quality_check_negative(who_covid_7days,"WHO"))
     if who_negative_values:
         print(f"Negative values in last 7 days from WHO")
     who_covid_mean = who_covid_7days.rolling(window=7,min_periods=4).mean()
@@ -256,12 +377,12 @@ def generate_key_figures(country_iso3,parameters):
 
     #model (i.e. bucky) outputs are not always integers. This cannot reflect the real situation, but nevertheless we choose to use the floats such that trend calculations more precisely reflect the projected development
     #numbers are only rounded for reporting purposes
-    min_cases_npi=round(bucky_npi[bucky_npi['quantile']==MIN_QUANTILE].loc[FOUR_WEEKS,'cumulative_reported_cases']).astype(int)
-    max_cases_npi=round(bucky_npi[bucky_npi['quantile']==MAX_QUANTILE].loc[FOUR_WEEKS,'cumulative_reported_cases']).astype(int)
+    min_cases_npi=int(round(bucky_npi.value('cumulative_reported_cases',dates.four_weeks,MIN_QUANTILE)))
+    max_cases_npi=int(round(bucky_npi.value('cumulative_reported_cases',dates.four_weeks,MAX_QUANTILE)))
     min_additional_cases_npi = min_cases_npi - bucky_npi_cases_tomorrow
     max_additional_cases_npi = max_cases_npi - bucky_npi_cases_tomorrow
-    min_deaths_npi=round(bucky_npi[bucky_npi['quantile']==MIN_QUANTILE].loc[FOUR_WEEKS,'cumulative_deaths']).astype(int)
-    max_deaths_npi=round(bucky_npi[bucky_npi['quantile']==MAX_QUANTILE].loc[FOUR_WEEKS,'cumulative_deaths']).astype(int)
+    min_deaths_npi=int(round(bucky_npi.value('cumulative_deaths',dates.four_weeks,MIN_QUANTILE)))
+    max_deaths_npi=int(round(bucky_npi.value('cumulative_deaths',dates.four_weeks,MAX_QUANTILE)))
     min_additional_deaths_npi = min_deaths_npi - bucky_npi_deaths_tomorrow
     max_additional_deaths_npi = max_deaths_npi - bucky_npi_deaths_tomorrow
 
@@ -270,7 +391,7 @@ def generate_key_figures(country_iso3,parameters):
     rel_inc_max_cases_npi=(max_cases_npi-bucky_npi_cases_tomorrow)/bucky_npi_cases_tomorrow*100
     rel_inc_min_deaths_npi=(min_deaths_npi-bucky_npi_deaths_tomorrow)/bucky_npi_deaths_tomorrow*100
     rel_inc_max_deaths_npi=(max_deaths_npi-bucky_npi_deaths_tomorrow)/bucky_npi_deaths_tomorrow*100
-    print(f'- Projection date:{FOUR_WEEKS}')
+    print(f'- Projection date:{dates.four_weeks}')
     print(f'-- NPI: Projected reported cumulative cases in 4w: {min_cases_npi:.0f} - {max_cases_npi:.0f}')
     print(f'-- NPI: Projected reported additional cases in 4w: {min_additional_cases_npi:.0f} - {max_additional_cases_npi:.0f}')
     print(f'-- NPI: Projected trend reported cases in 4w: {rel_inc_min_cases_npi:.0f}% - {rel_inc_max_cases_npi:.0f}%')
@@ -279,13 +400,13 @@ def generate_key_figures(country_iso3,parameters):
     print(f'-- NPI: Projected trend reported deaths in 4w: {rel_inc_min_deaths_npi:.0f}% - {rel_inc_max_deaths_npi:.0f}%')
 
     # Compute the expected percentual change in CUMULATIVE reported cases and deaths when there are no NPIs in place
-    bucky_no_npi=get_bucky(country_iso3,admin_level='adm0',min_date=TOMORROW,max_date=FOUR_WEEKS,npi_filter='no_npi')
-    min_cases_no_npi=round(bucky_no_npi[bucky_no_npi['quantile']==MIN_QUANTILE].loc[FOUR_WEEKS,'cumulative_reported_cases']).astype(int)
-    max_cases_no_npi=round(bucky_no_npi[bucky_no_npi['quantile']==MAX_QUANTILE].loc[FOUR_WEEKS,'cumulative_reported_cases']).astype(int)
+    bucky_no_npi=session.get_bucky(admin_level='adm0',min_date=dates.tomorrow,max_date=dates.four_weeks,npi_filter='no_npi',as_cube=True)
+    min_cases_no_npi=int(round(bucky_no_npi.value('cumulative_reported_cases',dates.four_weeks,MIN_QUANTILE)))
+    max_cases_no_npi=int(round(bucky_no_npi.value('cumulative_reported_cases',dates.four_weeks,MAX_QUANTILE)))
     min_additional_cases_no_npi = min_cases_no_npi - bucky_npi_cases_tomorrow
     max_additional_cases_no_npi = max_cases_no_npi - bucky_npi_cases_tomorrow
-    min_deaths_no_npi=round(bucky_no_npi[bucky_no_npi['quantile']==MIN_QUANTILE].loc[FOUR_WEEKS,'cumulative_deaths']).astype(int)
-    max_deaths_no_npi=round(bucky_no_npi[bucky_no_npi['quantile']==MAX_QUANTILE].loc[FOUR_WEEKS,'cumulative_deaths']).astype(int)
+    min_deaths_no_npi=int(round(bucky_no_npi.value('cumulative_deaths',dates.four_weeks,MIN_QUANTILE)))
+    max_deaths_no_npi=int(round(bucky_no_npi.value('cumulative_deaths',dates.four_weeks,MAX_QUANTILE)))
     min_additional_deaths_no_npi = min_deaths_no_npi - bucky_npi_deaths_tomorrow
     max_additional_deaths_no_npi = max_deaths_no_npi - bucky_npi_deaths_tomorrow
     print(f'--- no_npi: Projected cumulative reported cases in 4w: {min_cases_no_npi:.0f} - {max_cases_no_npi:.0f}')
@@ -338,147 +459,183 @@ def generate_key_figures(country_iso3,parameters):
     df_metrics=pd.DataFrame.from_dict(dict_metrics, orient='index')
     return df_metrics
 
-def generate_model_projections(country_iso3,parameters):
+@profiler.profiled()
+def generate_model_projections(session,country_iso3,parameters,dates,output_dir,draw=True):
     """
     Compute metrics and draw a graph related to the current and projected number of hospitalizations
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
 
+        dates: ReportDates of the assessment
+        output_dir: folder to save the output to
+        draw: if False, only the metrics are computed and no graph is described
     Returns:
         df_metrics: DataFrame with the computed metrics
+        chart: ChartSpec of the graph, None if draw is False
     """
     # generate plot with four-weeks ahead projections of daily cases
-    bucky_npi=get_bucky(country_iso3,admin_level='adm0',min_date=TOMORROW,max_date=FOUR_WEEKS,npi_filter='npi')
-    bucky_no_npi=get_bucky(country_iso3,admin_level='adm0',min_date=TOMORROW,max_date=FOUR_WEEKS,npi_filter='no_npi')
-    metric, metric_tomorrow_min, metric_tomorrow_max, metric_4w_npi_min, metric_4w_npi_max, metric_4w_no_npi_min, metric_4w_no_npi_max, metric_additional_npi_min, metric_additional_npi_max, metric_additional_no_npi_min, metric_additional_no_npi_max = draw_model_projections(country_iso3,bucky_npi,bucky_no_npi,parameters,'hospitalizations')
-
-    dict_metric={f'{metric.capitalize()} current situation - MIN': metric_tomorrow_min,
-    f'{metric.capitalize()} current situation - MAX':metric_tomorrow_max,
-    f'NPI {metric.capitalize()} projections 4w - MIN': metric_4w_npi_min,
-    f'NPI {metric.capitalize()} projections 4w - MAX': metric_4w_npi_max,
-    f'NPI additional {metric.capitalize()} projections 4w - MIN': metric_additional_npi_min,
-    f'NPI additional {metric.capitalize()} projections 4w - MAX': metric_additional_npi_max,
-    f'NO NPI {metric.capitalize()} projections 4w - MIN': metric_4w_no_npi_min,
-    f'NO NPI {metric.capitalize()} projections 4w - MAX': metric_4w_no_npi_max,
-    f'NO NPI additional {metric.capitalize()} projections 4w - MIN': metric_additional_no_npi_min,
-    f'NO NPI additional {metric.capitalize()} projections 4w - MAX': metric_additional_no_npi_max}
+    bucky_npi=session.get_bucky(admin_level='adm0',min_date=dates.tomorrow,max_date=dates.four_weeks,npi_filter='npi',as_cube=True)
+    bucky_no_npi=session.get_bucky(admin_level='adm0',min_date=dates.tomorrow,max_date=dates.four_weeks,npi_filter='no_npi',as_cube=True)
+    metric='hospitalizations'
+    projections=compute_model_projections(bucky_npi,bucky_no_npi,metric,dates)
+    chart=draw_model_projections(bucky_npi,bucky_no_npi,metric,output_dir) if draw else None
+
+    dict_metric={f'{metric.capitalize()} current situation - MIN': projections['tomorrow_min'],
+    f'{metric.capitalize()} current situation - MAX':projections['tomorrow_max'],
+    f'NPI {metric.capitalize()} projections 4w - MIN': projections['4w_npi_min'],
+    f'NPI {metric.capitalize()} projections 4w - MAX': projections['4w_npi_max'],
+    f'NPI additional {metric.capitalize()} projections 4w - MIN': projections['additional_npi_min'],
+    f'NPI additional {metric.capitalize()} projections 4w - MAX': projections['additional_npi_max'],
+    f'NO NPI {metric.capitalize()} projections 4w - MIN': projections['4w_no_npi_min'],
+    f'NO NPI {metric.capitalize()} projections 4w - MAX': projections['4w_no_npi_max'],
+    f'NO NPI additional {metric.capitalize()} projections 4w - MIN': projections['additional_no_npi_min'],
+    f'NO NPI additional {metric.capitalize()} projections 4w - MAX': projections['additional_no_npi_max']}
 
     df_metrics=pd.DataFrame.from_dict(dict_metric,orient='index')
-    return df_metrics
+    return df_metrics, chart
 
-def draw_model_projections(country_iso3,bucky_npi,bucky_no_npi,parameters,metric):
+def compute_model_projections(bucky_npi,bucky_no_npi,metric,dates):
     """
-    Compute the projected trends of the given metric, if NPIs are in place and when they are lifted, and produce a plot
+    Compute the projected trends of the given metric, if NPIs are in place and when they are lifted
     Args:
-        country_iso3: iso3 code of the country of interest
-        bucky_npi: DataFrame with model projections given the current NPIs
-        bucky_no_npi: DataFrame with model projections given the NPIs are lifted
-        parameters:
-        metric: the column name to compute the metrics on
-        parameters: country specific parameters, retrieved from config
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
+        metric: the metric to compute, one of PROJECTION_METRICS
+        dates: ReportDates of the assessment
     Returns:
-        the min and max value of the metric tomorrow and in four weeks, with and without NPIs
+        dict with the min and max value of the metric tomorrow and in four weeks, with and without NPIs, and the additional numbers in four weeks
     """
-    # draw NPI vs non NPIs projections
-    if metric=='daily_reported_cases':
-        bucky_var='daily_reported_cases'
-        fig_title='Daily reported cases'
-    elif metric=='daily_deaths':
-        bucky_var='daily_deaths'
-        fig_title='Daily deaths'
-    elif metric=='hospitalizations':
-        bucky_var='current_hospitalizations'
-        fig_title='People requiring healthcare support'
-    else:
+    if metric not in PROJECTION_METRICS:
         print(f'metric {metric} not implemented')
         return
-
-    #plot the history and projection of the metric, including uncertainty intervals
-    fig,axis=create_new_subplot(fig_title)
-    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,axis)
-    plt.legend(loc='upper left', prop={'size': 8})
+    bucky_var,_=PROJECTION_METRICS[metric]
     print(f'----{metric} statistics')
     # the number of hospitalizations is always an estimate. In the optimal case the assessment_date is close to the last date of subnational data
     # in that case the estimated number of hospitalizations is about the same for the situation with and without npi
     # however, if this is not the case, we choose to display the current situation as the estimated situation with npis in place since we assume that to be the closest to the real situation
-    metric_tomorrow_min = round(bucky_npi[bucky_npi['quantile'] == MIN_QUANTILE].loc[TOMORROW, bucky_var]).astype(int)
-    metric_tomorrow_max = round(bucky_npi[bucky_npi['quantile'] == MAX_QUANTILE].loc[TOMORROW, bucky_var]).astype(int)
-    metric_4w_npi_min=round(bucky_npi[bucky_npi['quantile']==MIN_QUANTILE].loc[FOUR_WEEKS,bucky_var]).astype(int)
-    metric_4w_npi_max=round(bucky_npi[bucky_npi['quantile']==MAX_QUANTILE].loc[FOUR_WEEKS,bucky_var]).astype(int)
-    metric_4w_no_npi_min=round(bucky_no_npi[bucky_no_npi['quantile']==MIN_QUANTILE].loc[FOUR_WEEKS,bucky_var]).astype(int)
-    metric_4w_no_npi_max=round(bucky_no_npi[bucky_no_npi['quantile']==MAX_QUANTILE].loc[FOUR_WEEKS,bucky_var]).astype(int)
+    metric_tomorrow_min = int(round(bucky_npi.value(bucky_var, dates.tomorrow, MIN_QUANTILE)))
+    metric_tomorrow_max = int(round(bucky_npi.value(bucky_var, dates.tomorrow, MAX_QUANTILE)))
+    metric_4w_npi_min=int(round(bucky_npi.value(bucky_var,dates.four_weeks,MIN_QUANTILE)))
+    metric_4w_npi_max=int(round(bucky_npi.value(bucky_var,dates.four_weeks,MAX_QUANTILE)))
+    metric_4w_no_npi_min=int(round(bucky_no_npi.value(bucky_var,dates.four_weeks,MIN_QUANTILE)))
+    metric_4w_no_npi_max=int(round(bucky_no_npi.value(bucky_var,dates.four_weeks,MAX_QUANTILE)))
     metric_additional_npi_min=metric_4w_npi_min-metric_tomorrow_min
     metric_additional_npi_max=metric_4w_npi_max-metric_tomorrow_max
     metric_additional_no_npi_min=metric_4w_no_npi_min-metric_tomorrow_min
     metric_additional_no_npi_max=metric_4w_no_npi_max-metric_tomorrow_max
 
-    print(f'----{metric} {TOMORROW}: {metric_tomorrow_min:.0f} - {metric_tomorrow_max:.0f}')
-    print(f'----{metric} NPI {FOUR_WEEKS}: {metric_4w_npi_min:.0f} - {metric_4w_npi_max:.0f}')
-    print(f'----{metric} additional NPI {FOUR_WEEKS}: {metric_additional_npi_min:.0f} - {metric_additional_npi_max:.0f}')
-    print(f'----{metric} NO NPI {FOUR_WEEKS}: {metric_4w_no_npi_min:.0f} - {metric_4w_no_npi_max:.0f}')
-    print(f'----{metric} additional NO NPI {FOUR_WEEKS}: {metric_additional_no_npi_min:.0f} - {metric_additional_no_npi_max:.0f}')
-    fig.savefig(f'Outputs/{country_iso3}/projection_{metric}.png')
+    print(f'----{metric} {dates.tomorrow}: {metric_tomorrow_min:.0f} - {metric_tomorrow_max:.0f}')
+    print(f'----{metric} NPI {dates.four_weeks}: {metric_4w_npi_min:.0f} - {metric_4w_npi_max:.0f}')
+    print(f'----{metric} additional NPI {dates.four_weeks}: {metric_additional_npi_min:.0f} - {metric_additional_npi_max:.0f}')
+    print(f'----{metric} NO NPI {dates.four_weeks}: {metric_4w_no_npi_min:.0f} - {metric_4w_no_npi_max:.0f}')
+    print(f'----{metric} additional NO NPI {dates.four_weeks}: {metric_additional_no_npi_min:.0f} - {metric_additional_no_npi_max:.0f}')
+
+    return {'tomorrow_min':metric_tomorrow_min,'tomorrow_max':metric_tomorrow_max,
+            '4w_npi_min':metric_4w_npi_min,'4w_npi_max':metric_4w_npi_max,
+            '4w_no_npi_min':metric_4w_no_npi_min,'4w_no_npi_max':metric_4w_no_npi_max,
+            'additional_npi_min':metric_additional_npi_min,'additional_npi_max':metric_additional_npi_max,
+            'additional_no_npi_min':metric_additional_no_npi_min,'additional_no_npi_max':metric_additional_no_npi_max}
 
-    return metric, metric_tomorrow_min, metric_tomorrow_max, metric_4w_npi_min, metric_4w_npi_max, metric_4w_no_npi_min, metric_4w_no_npi_max, metric_additional_npi_min, metric_additional_npi_max, metric_additional_no_npi_min, metric_additional_no_npi_max
+def draw_model_projections(bucky_npi,bucky_no_npi,metric,output_dir):
+    """
+    Produce a plot of the projections of the given metric, if NPIs are in place and when they are lifted
+    Args:
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
+        metric: the metric to plot, one of PROJECTION_METRICS
+        output_dir: folder to save the output to
+    Returns:
+        the ChartSpec of the plot
+    """
+    if metric not in PROJECTION_METRICS:
+        print(f'metric {metric} not implemented')
+        return
+    # draw NPI vs non NPIs projections
+    bucky_var,fig_title=PROJECTION_METRICS[metric]
+    #plot the history and projection of the metric, including uncertainty intervals
+    chart=ChartSpec(fig_title,f'{output_dir}/projection_{metric}.png')
+    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,chart)
+    chart.axis('legend',loc='upper left', prop={'size': 8})
+    return chart
 
-def generate_data_model_comparison(country_iso3,parameters):
+@profiler.profiled()
+def generate_data_model_comparison(session,country_iso3,parameters,dates,output_dir):
     """
     Produce plots of the last two months and the projections of the coming four weeks with cumulative reported cases, cumulative deaths, daily new cases, and daily deaths
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
+        dates: ReportDates of the assessment
+        output_dir: folder to save the output to
+    Returns:
+        charts: list with the ChartSpec of each plot
     """
     # generate plot with subnational data, WHO data and projections
-    subnational_covid=get_subnational_covid_data(parameters,aggregate=True,min_date=LAST_TWO_MONTHS,max_date=FOUR_WEEKS)
-    who_covid=get_who(WHO_COVID_FILENAME,parameters['iso2_code'],min_date=LAST_TWO_MONTHS,max_date=FOUR_WEEKS)
-    bucky_npi=get_bucky(country_iso3,admin_level='adm0',min_date=LAST_TWO_MONTHS,max_date=FOUR_WEEKS,npi_filter='npi')
-    bucky_no_npi=get_bucky(country_iso3,admin_level='adm0',min_date=LAST_TWO_MONTHS,max_date=FOUR_WEEKS,npi_filter='no_npi')
+    subnational_covid=session.get_subnational_covid_data(aggregate=True,min_date=dates.last_two_months,max_date=dates.four_weeks)
+    who_covid=session.get_who(min_date=dates.last_two_months,max_date=dates.four_weeks)
+    bucky_npi=session.get_bucky(admin_level='adm0',min_date=dates.last_two_months,max_date=dates.four_weeks,npi_filter='npi',as_cube=True)
+    bucky_no_npi=session.get_bucky(admin_level='adm0',min_date=dates.last_two_months,max_date=dates.four_weeks,npi_filter='no_npi',as_cube=True)
 
+    charts=[]
     #cumulative reported cases
-    draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_reported_cases')
+    charts.append(draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_reported_cases',output_dir))
     #cumulative deaths
-    draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_deaths')
+    charts.append(draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_deaths',output_dir))
 
     #daily new reported cases
-    draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_reported_cases')
+    charts.append(draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_reported_cases',output_dir))
     #daily reported deaths
-    draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_deaths')
+    charts.append(draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_deaths',output_dir))
+    return charts
 
-def generate_data_model_comparison_lifetime(country_iso3,parameters):
+@profiler.profiled()
+def generate_data_model_comparison_lifetime(session,country_iso3,parameters,dates,output_dir):
     """
     Produce plots from the moment cases were reported till now plus projections of the coming four weeks with cumulative reported cases, cumulative deaths, daily new cases, and daily deaths
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
+        dates: ReportDates of the assessment
+        output_dir: folder to save the output to
+    Returns:
+        charts: list with the ChartSpec of each plot
     """
     # generate plot with subnational data, WHO data and projections
-    subnational_covid=get_subnational_covid_data(parameters,aggregate=True,min_date=EARLIEST_DATE,max_date=FOUR_WEEKS)
-    who_covid=get_who(WHO_COVID_FILENAME,parameters['iso2_code'],min_date=EARLIEST_DATE,max_date=FOUR_WEEKS)
-    bucky_npi=get_bucky(country_iso3,admin_level='adm0',min_date=EARLIEST_DATE,max_date=FOUR_WEEKS,npi_filter='npi')
-    bucky_no_npi=get_bucky(country_iso3,admin_level='adm0',min_date=EARLIEST_DATE,max_date=FOUR_WEEKS,npi_filter='no_npi')
+    subnational_covid=session.get_subnational_covid_data(aggregate=True,min_date=dates.earliest,max_date=dates.four_weeks)
+    who_covid=session.get_who(min_date=dates.earliest,max_date=dates.four_weeks)
+    bucky_npi=session.get_bucky(admin_level='adm0',min_date=dates.earliest,max_date=dates.four_weeks,npi_filter='npi',as_cube=True)
+    bucky_no_npi=session.get_bucky(admin_level='adm0',min_date=dates.earliest,max_date=dates.four_weeks,npi_filter='no_npi',as_cube=True)
 
+    charts=[]
     #cumulative reported cases
-    draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_reported_cases')
+    charts.append(draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_reported_cases',output_dir))
     #cumulative reported deaths
-    draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_deaths')
+    charts.append(draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,'cumulative_deaths',output_dir))
 
     #daily new reported cases
-    draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_reported_cases')
+    charts.append(draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_reported_cases',output_dir))
     #daily deaths
-    draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_deaths')
+    charts.append(draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,bucky_no_npi,'daily_deaths',output_dir))
+    return charts
 
-def draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,metric):
+def draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,metric,output_dir):
     """
     For the given metric, plot the WHO and subnational historical data for the last two months plus the projected numbers by the model, given npis are in place and are lifted
     Args:
         country_iso3: iso3 code of the country of interest
         subnational_covid: DataFrame with historical subnational data reported by MPHO
         who_covid: DataFrame with historical national data reported by WHO
-        bucky_npi: DataFrame with model projections given the current NPIs
-        bucky_no_npi: DataFrame with model projections given the NPIs are lifted
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
         parameters: country specific parameters, retrieved from config
         metric: the column name to plot the data from
+        output_dir: folder to save the output to
+    Returns:
+        chart: ChartSpec of the plot
     """
     if metric=='cumulative_reported_cases':
         who_var='Cumulative_cases'
@@ -496,31 +653,34 @@ def draw_data_model_comparison_cumulative(country_iso3,subnational_covid,who_cov
         print(f'metric {metric} not implemented')
         return False
 
-    fig,axis=create_new_subplot(fig_title)
+    chart=ChartSpec(fig_title,f'{output_dir}/current_{metric}.png')
 
     # draw WHO national reported numbers
-    axis.scatter(who_covid.index, who_covid[who_var],
+    chart.axis('scatter',who_covid.index, who_covid[who_var],
                      alpha=0.8, s=20,c=WHO_DATA_COLOR,marker='*',label='WHO')
     # draw subnational reported numbers
-    axis.scatter(subnational_covid.index, subnational_covid[subnational_var],\
+    chart.axis('scatter',subnational_covid.index, subnational_covid[subnational_var],\
                      alpha=0.8, s=20,c=SUBNATIONAL_DATA_COLOR,marker='o',label=subnational_source)
     # draw bucky projections and uncertainty intervals
-    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,axis)
+    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,chart)
 
-    plt.legend(loc='upper left', prop={'size': 8})
-    fig.savefig(f'Outputs/{country_iso3}/current_{metric}.png')
+    chart.axis('legend',loc='upper left', prop={'size': 8})
+    return chart
 
-def draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,metric):
+def draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covid,who_covid,bucky_npi,bucky_no_npi,parameters,metric,output_dir):
     """
     For the given metric, plot the WHO and subnational historical data from the moment numbers were reported plus the projected numbers by the model, given npis are in place and are lifted
     Args:
         country_iso3: iso3 code of the country of interest
         subnational_covid: DataFrame with historical subnational data reported by MPHO
         who_covid: DataFrame with historical national data reported by WHO
-        bucky_npi: DataFrame with model projections given the current NPIs
-        bucky_no_npi: DataFrame with model projections given the NPIs are lifted
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
         parameters: country specific parameters, retrieved from config
         metric: the column name to plot the data from
+        output_dir: folder to save the output to
+    Returns:
+        chart: ChartSpec of the plot
     """
     if metric=='cumulative_reported_cases':
         who_var='Cumulative_cases'
@@ -537,36 +697,39 @@ def draw_data_model_comparison_cumulative_lifetime(country_iso3,subnational_covi
     else:
         print(f'metric {metric} not implemented')
         return False
-    fig,axis=create_new_subplot(fig_title)
-    who_mindate=who_covid[(who_covid[['Cumulative_cases','Cumulative_deaths']] > 0).any(1)].index.min()
-    subnational_mindate=subnational_covid[(subnational_covid[[HLX_TAG_TOTAL_CASES,HLX_TAG_TOTAL_DEATHS]] > 0).any(1)].index.min()
+    chart=ChartSpec(fig_title,f'{output_dir}/lifetime_{metric}.png')
+    who_mindate=who_covid[(who_covid[['Cumulative_cases','Cumulative_deaths']] > 0).any(axis=1)].index.min()
+    subnational_mindate=subnational_covid[(subnational_covid[[HLX_TAG_TOTAL_CASES,HLX_TAG_TOTAL_DEATHS]] > 0).any(axis=1)].index.min()
     mindate=min(who_mindate,subnational_mindate)-timedelta(days=14)
     who_covid_start=who_covid.loc[mindate:,:]
     subnational_covid_start=subnational_covid.loc[mindate:,:]
-    bucky_npi_start=bucky_npi.loc[mindate:,:]
-    bucky_no_npi_start=bucky_no_npi.loc[mindate:,:]
+    bucky_npi_start=bucky_npi.slice(min_date=mindate)
+    bucky_no_npi_start=bucky_no_npi.slice(min_date=mindate)
 
 
     # draw subnational reported cumulative cases
-    axis.scatter(who_covid_start.index, who_covid_start[who_var],
+    chart.axis('scatter',who_covid_start.index, who_covid_start[who_var],
                      alpha=0.8, s=20,c=WHO_DATA_COLOR,marker='*',label='WHO')
-    axis.scatter(subnational_covid_start.index, subnational_covid_start[subnational_var],
+    chart.axis('scatter',subnational_covid_start.index, subnational_covid_start[subnational_var],
                      alpha=0.8, s=20,c=SUBNATIONAL_DATA_COLOR,marker='o',label=subnational_source)
     # draw bucky
-    draw_bucky_projections(bucky_npi_start,bucky_no_npi_start,bucky_var,axis)
+    draw_bucky_projections(bucky_npi_start,bucky_no_npi_start,bucky_var,chart)
 
-    plt.legend(loc='upper left', prop={'size': 8})
-    fig.savefig(f'Outputs/{country_iso3}/lifetime_{metric}.png')
+    chart.axis('legend',loc='upper left', prop={'size': 8})
+    return chart
 
-def draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi,metric):
+def draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi,metric,output_dir):
     """
     For the given metric, plot the daily numbers with a 7-day rolling average of the last two months. Plus the projected numbers as given by the model
     Args:
         country_iso3: iso3 code of the country of interest
         who_covid: DataFrame with historical national data reported by WHO
-        bucky_npi: DataFrame with model projections given the current NPIs
-        bucky_no_npi: DataFrame with model projections given the NPIs are lifted
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
         metric: the column name to plot the data from
+        output_dir: folder to save the output to
+    Returns:
+        chart: ChartSpec of the plot
     """
     # plot the 4 inputs and save figure
     if metric=='daily_reported_cases':
@@ -581,28 +744,31 @@ def draw_data_model_comparison_new(country_iso3,who_covid,bucky_npi,bucky_no_npi
         print(f'metric {metric} not implemented')
         return False
 
-    fig,axis=create_new_subplot(fig_title)
+    chart=ChartSpec(fig_title,f'{output_dir}/current_{metric}.png')
     # draw reported data by who
-    axis.bar(who_covid.index, who_covid[who_var],alpha=0.8,color=WHO_DATA_COLOR,label='WHO')
+    chart.axis('bar',who_covid.index, who_covid[who_var],alpha=0.8,color=WHO_DATA_COLOR,label='WHO')
     # compute rolling 7-day average
     who_covid_rolling = who_covid[who_var].rolling(window=7).mean()
-    axis.plot(who_covid_rolling.index, who_covid_rolling,
+    chart.axis('plot',who_covid_rolling.index, who_covid_rolling,
         lw=3,color=lighten_color(WHO_DATA_COLOR,1.6),label='WHO - 7d rolling average')
     # draw bucky
-    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,axis)
+    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,chart)
 
-    plt.legend(loc='upper left', prop={'size': 8})
-    fig.savefig(f'Outputs/{country_iso3}/current_{metric}.png')
+    chart.axis('legend',loc='upper left', prop={'size': 8})
+    return chart
 
-def draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,bucky_no_npi,metric):
+def draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,bucky_no_npi,metric,output_dir):
     """
     For the given metric, plot the daily numbers with a 7-day rolling average from the moment numbers were reported. Plus the projected numbers as given by the model
     Args:
         country_iso3: iso3 code of the country of interest
         who_covid: DataFrame with historical national data reported by WHO
-        bucky_npi: DataFrame with model projections given the current NPIs
-        bucky_no_npi: DataFrame with model projections given the NPIs are lifted
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
         metric: the column name to plot the data from
+        output_dir: folder to save the output to
+    Returns:
+        chart: ChartSpec of the plot
     """
     if metric=='daily_reported_cases':
         who_var='New_cases'
@@ -615,67 +781,71 @@ def draw_data_model_comparison_new_lifetime(country_iso3,who_covid,bucky_npi,buc
     else:
         print(f'metric {metric} not implemented')
         return False
-    fig,axis=create_new_subplot(fig_title)
-    axis.bar(who_covid.index, who_covid[who_var],alpha=0.8,color=WHO_DATA_COLOR,label='WHO')
+    chart=ChartSpec(fig_title,f'{output_dir}/lifetime_{metric}.png')
+    chart.axis('bar',who_covid.index, who_covid[who_var],alpha=0.8,color=WHO_DATA_COLOR,label='WHO')
     # compute rolling 7-day average
     who_covid_rolling = who_covid[who_var].rolling(window=7).mean()
-    axis.plot(who_covid_rolling.index, who_covid_rolling,\
+    chart.axis('plot',who_covid_rolling.index, who_covid_rolling,\
         lw=3,color=lighten_color(WHO_DATA_COLOR,1.6),label='WHO - 7d rolling average')
     # draw bucky
-    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,axis)
+    draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,chart)
 
-    plt.legend(loc='upper left', prop={'size': 8})
-    fig.savefig(f'Outputs/{country_iso3}/lifetime_{metric}.png')
+    chart.axis('legend',loc='upper left', prop={'size': 8})
+    return chart
 
-def draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,axis):
+def draw_bucky_projections(bucky_npi,bucky_no_npi,bucky_var,chart):
     """
     Draw historical and projection of the bucky_var, including the uncertainty intervals
     Args:
-        bucky_npi: DataFrame with model projections given the current NPIs
-        bucky_no_npi: DataFrame with model projections given the NPIs are lifted
+        bucky_npi: QuantileCube with model projections given the current NPIs
+        bucky_no_npi: QuantileCube with model projections given the NPIs are lifted
         bucky_var: the column name to plot
-        axis: the fig axis to plot them on
-    """
-    bucky_npi=bucky_npi[bucky_npi[bucky_var]>0]
-    bucky_npi_median=bucky_npi[bucky_npi['quantile']==0.5][bucky_var]
-    bucky_npi_median.plot(c=NPI_COLOR,ax=axis,label='Current NPIs maintained')
-    axis.fill_between(bucky_npi_median.index,
-                          bucky_npi[bucky_npi['quantile']==MIN_QUANTILE][bucky_var],
-                          bucky_npi[bucky_npi['quantile']==MAX_QUANTILE][bucky_var],
+        chart: the ChartSpec to add them to
+    """
+    bucky_npi_median=bucky_npi.median(bucky_var)
+    bucky_npi_min,bucky_npi_max=bucky_npi.band(bucky_var,MIN_QUANTILE,MAX_QUANTILE)
+    #only the positive values of each quantile are drawn
+    bucky_npi_median=bucky_npi_median[bucky_npi_median>0]
+    chart.plot(bucky_npi_median,c=NPI_COLOR,label='Current NPIs maintained')
+    chart.axis('fill_between',bucky_npi_median.index,
+                          bucky_npi_min[bucky_npi_min>0],
+                          bucky_npi_max[bucky_npi_max>0],
                           color=NPI_COLOR,alpha=0.2
                           )
     # draw line NO NPI
-    bucky_no_npi=bucky_no_npi[bucky_no_npi[bucky_var]>0]
-    bucky_no_npi_median=bucky_no_npi[bucky_no_npi['quantile']==0.5][bucky_var]
-    bucky_no_npi_median.plot(c=NO_NPI_COLOR,ax=axis,label='No NPIs in place'.format())
-    axis.fill_between(bucky_no_npi_median.index,
-                          bucky_no_npi[bucky_no_npi['quantile']==MIN_QUANTILE][bucky_var],
-                          bucky_no_npi[bucky_no_npi['quantile']==MAX_QUANTILE][bucky_var],
+    bucky_no_npi_median=bucky_no_npi.median(bucky_var)
+    bucky_no_npi_min,bucky_no_npi_max=bucky_no_npi.band(bucky_var,MIN_QUANTILE,MAX_QUANTILE)
+    bucky_no_npi_median=bucky_no_npi_median[bucky_no_npi_median>0]
+    chart.plot(bucky_no_npi_median,c=NO_NPI_COLOR,label='No NPIs in place'.format())
+    chart.axis('fill_between',bucky_no_npi_median.index,
+                          bucky_no_npi_min[bucky_no_npi_min>0],
+                          bucky_no_npi_max[bucky_no_npi_max>0],
                           color=NO_NPI_COLOR,alpha=0.2
                           )
 
-def calculate_subnational_incidence(country_iso3, parameters, date):
+@profiler.profiled()
+def calculate_subnational_incidence(session, country_iso3, parameters, date):
     """
     Compute the reported and total estimated daily NEW cases per 100k on DATE and display these per admin1 and national average
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
         date: date for which the metrics are computed
     """
-    bucky_npi = get_bucky(country_iso3, admin_level='adm1', min_date=date, max_date=date, npi_filter='npi')
-    bucky_npi = bucky_npi[bucky_npi['quantile'] == 0.5]
+    bucky_npi = session.get_bucky(admin_level='adm1', min_date=date, max_date=date, npi_filter='npi',
+                                  columns=['daily_reported_cases', 'daily_cases', 'total_population'], quantiles=[0.5])
     adm1_pcode_prefix = parameters['iso2_code']
     if country_iso3 == 'IRQ':
         adm1_pcode_prefix = 'IQG'
-    bucky_npi['adm1'] = adm1_pcode_prefix + bucky_npi['adm1'].apply(lambda x: '{0:0=2d}'.format(int(x)))
+    bucky_npi['adm1'] = adm1_pcode_prefix + bucky_npi['adm1'].astype(int).apply(lambda x: '{0:0=2d}'.format(x))
 
     #in the model output the daily_cases per admin1 is given. The N column gives the population per admin1 through which the cases/100k can be calculated
     bucky_npi['daily_reported_cases_per_100k'] = bucky_npi['daily_reported_cases'] /(bucky_npi['total_population']/100000)
     bucky_npi['daily_cases_total_per_100k'] = bucky_npi['daily_cases'] /(bucky_npi['total_population']/100000)
 
     #shapefile contains adm1 names so add them to printout on console
-    shapefile = gpd.read_file(parameters['shape'], encoding='UTF-8')
-    shapefile = shapefile[[parameters['adm1_pcode'], parameters['adm1_name']]]
+    shapefile = shapefile_registry.get_attributes(parameters['shape'], [parameters['adm1_pcode'], parameters['adm1_name']])
     combined_shp = bucky_npi.merge(shapefile, how='left', left_on='adm1', right_on=parameters['adm1_pcode'])
     combined_shp=combined_shp.set_index('adm1')
     print(f'Daily reported and estimated total cases per admin1 region on {date}')
@@ -686,71 +856,71 @@ def calculate_subnational_incidence(country_iso3, parameters, date):
     print(f'Average over all admin regions of reported new daily cases per 100K: {daily_rep_avg:.2f}')
     print(f'Average over all admin regions of total estimated new daily cases per 100K: {daily_tot_avg:.2f}')
 
-def create_subnational_map_incidence_100k(metric, country_iso3, parameters, date,fig_title,output_file):
+@profiler.profiled()
+def create_subnational_map_incidence_100k(session, metric, country_iso3, parameters, regions, date,fig_title,output_file):
     """
     Plot a map with the given metric per 100k per admin1 region.
     The bins and color scheme being used are according to the guidelines of the Harvard Global Health Institute, see https://globalhealth.harvard.edu/key-metrics-for-covid-suppression-researchers-and-public-health-experts-unite-to-bring-clarity-to-key-metrics-guiding-coronavirus-response/
     Args:
+        session: DataSession from which the input data is retrieved
         metric: the name to plot the data for
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
+        regions: GeoDataFrame with the adm1 pcode and geometry of the admin1 regions
         date: the date to plot the data for
         fig_title: the title of the plot
-        output_file: the filename to save the figure to
+        output_file: the path to save the figure to
+    Returns:
+        chart: MapSpec of the map
     """
-    bucky_npi = get_bucky(country_iso3, admin_level='adm1', min_date=date, max_date=date, npi_filter='npi')
-    bucky_npi = bucky_npi[bucky_npi['quantile'] == 0.5]
+    bucky_npi = session.get_bucky(admin_level='adm1', min_date=date, max_date=date, npi_filter='npi', quantiles=[0.5])
     adm1_pcode_prefix = parameters['iso2_code']
     if country_iso3 == 'IRQ':
         adm1_pcode_prefix = 'IQG'
-    bucky_npi['adm1'] = adm1_pcode_prefix + bucky_npi['adm1'].apply(lambda x: '{0:0=2d}'.format(int(x)))
+    bucky_npi['adm1'] = adm1_pcode_prefix + bucky_npi['adm1'].astype(int).apply(lambda x: '{0:0=2d}'.format(x))
     #calculate metrics per 100k that are not in the output of the model but can be given as in put 'metric'
     bucky_npi['daily_reported_cases_per_100k'] = bucky_npi['daily_reported_cases'] /(bucky_npi['total_population']/100000)
     bucky_npi['daily_cases_total_per_100k'] = bucky_npi['daily_cases'] /(bucky_npi['total_population']/100000)
     bucky_npi['hospitalizations_per_100k'] = bucky_npi['current_hospitalizations'] /(bucky_npi['total_population']/100000)
 
-    shapefile = gpd.read_file(parameters['shape'])
-    shapefile = shapefile.merge(bucky_npi, left_on=parameters['adm1_pcode'], right_on='adm1', how='left')
-
-    fig, axis = create_new_subplot(fig_title)
-    axis.axis('off')
-    #bins according to recommendations from https://globalhealth.harvard.edu/key-metrics-for-covid-suppression-researchers-and-public-health-experts-unite-to-bring-clarity-to-key-metrics-guiding-coronavirus-response/
-    bins_list=np.array([0,1,10,25,100000])
-    cmap = matplotlib.colors.LinearSegmentedColormap.from_list('', ['#00a67e','#f8b931','#f88c29','#df431d'])
-    # set bins
-    norm2 = mcolors.BoundaryNorm(boundaries=bins_list, ncolors=256)
-    # print(shapefile)
-    shapefile.plot(column=metric, cmap=cmap, norm=norm2, ax=axis)
+    #the value of every region, regions without model output are not colored
+    values = regions[parameters['adm1_pcode']].map(bucky_npi.set_index('adm1')[metric]).to_numpy(dtype=float)
+
+    #the regions are colored by their value and their boundaries are drawn in light grey
+    chart = MapSpec(fig_title, output_file, parameters['shape'], regions.geometry, values, INCIDENCE_COLORS, INCIDENCE_BINS, {'linewidth':0.1, 'color':'lightgrey'})
+    chart.axis('axis','off')
     #plot legend
     # cbar=fig.colorbar(axis.collections[0], cax=fig.add_axes([0.9, 0.2, 0.03, 0.60]))
     # cbar.ax.set_yticklabels(['0', '1', '10','25+',''])
-    #plot boundaries of admin regions
-    shapefile.boundary.plot(linewidth=0.1, ax=axis,color='lightgrey')
-    fig.tight_layout()
-    fig.set_size_inches(7,6)
-    fig.savefig(f'Outputs/{country_iso3}/{output_file}')
+    chart.figure('tight_layout')
+    chart.figure('set_size_inches',7,6)
+    return chart
 
-def calculate_subnational_trends(country_iso3, parameters):
+@profiler.profiled()
+def calculate_subnational_trends(session, country_iso3, parameters, dates, output_dir):
     """
     Compute the absolute and percentual change in ACTIVE cases/100k in TWO_WEEKS compared to tomorrow
     Args:
+        session: DataSession from which the input data is retrieved
         country_iso3: iso3 code of the country of interest
         parameters: country specific parameters, retrieved from config
 
+        dates: ReportDates of the assessment
+        output_dir: folder to save the output to
     Returns:
         combined_change: DataFrame with the metrics related to the change in active cases/100k. Also includes the English admin1 names
     """
-    bucky_npi = get_bucky(country_iso3 ,admin_level='adm1',min_date=TOMORROW,max_date=TWO_WEEKS,npi_filter='npi')
-    bucky_npi = bucky_npi[bucky_npi['quantile']==0.5]
+    bucky_npi = session.get_bucky(admin_level='adm1',min_date=dates.tomorrow,max_date=dates.two_weeks,npi_filter='npi',
+                                  columns=['R_eff','daily_reported_cases','daily_cases','total_population'],quantiles=[0.5])
     adm1_pcode_prefix=parameters['iso2_code']
     if country_iso3 == 'IRQ':
         adm1_pcode_prefix='IQG'
-    bucky_npi['adm1']=adm1_pcode_prefix + bucky_npi['adm1'].apply(lambda x:  '{0:0=2d}'.format(int(x)))
+    bucky_npi['adm1']=adm1_pcode_prefix + bucky_npi['adm1'].astype(int).apply(lambda x:  '{0:0=2d}'.format(x))
     bucky_npi['daily_reported_cases_per_100k'] = bucky_npi['daily_reported_cases'] / (bucky_npi['total_population'] / 100000)
     bucky_npi['daily_cases_total_per_100k'] = bucky_npi['daily_cases'] / (bucky_npi['total_population'] / 100000)
     # make the col selector a list to ensure always a dataframe is returned (and not a series)
-    start = bucky_npi.loc[[TOMORROW+timedelta(days=1)], :]
-    end = bucky_npi.loc[[TWO_WEEKS], :]
+    start = bucky_npi.loc[[dates.tomorrow+timedelta(days=1)], :]
+    end = bucky_npi.loc[[dates.two_weeks], :]
     combined = start[['adm1','R_eff','daily_reported_cases_per_100k','daily_cases_total_per_100k']].merge(end[['adm1', 'daily_reported_cases_per_100k','daily_cases_total_per_100k']], how='outer', on='adm1',suffixes=('_tomorrow','_inTWOweeks'))
 
     combined['daily_reported_cases_per_100k_abs_change']=combined['daily_reported_cases_per_100k_inTWOweeks'] - combined['daily_reported_cases_per_100k_tomorrow']
@@ -764,8 +934,7 @@ def calculate_subnational_trends(country_iso3, parameters):
     # combined_cases['cases_per_100k_perc_change'] = (combined_cases['cases_per_100k_inTWOweeks'] -combined_cases['cases_per_100k_tomorrow'])/ combined_cases['cases_per_100k_tomorrow'] * 100
     # combined_change=combined.merge(combined_cases[['adm1','cases_per_100k_perc_change']],on='adm1',how='left')
 
-    shapefile = gpd.read_file(parameters['shape'],encoding='UTF-8')
-    shapefile=shapefile[[parameters['adm1_pcode'],parameters['adm1_name']]]
+    shapefile = shapefile_registry.get_attributes(parameters['shape'],[parameters['adm1_pcode'],parameters['adm1_name']])
 
     combined_shp=combined.merge(shapefile,how='left',left_on='adm1',right_on=parameters['adm1_pcode'])
     #inf values are given when cases_per100k tomorrow was 0 and in two weeks this is larger than 0
@@ -776,7 +945,7 @@ def calculate_subnational_trends(country_iso3, parameters):
     print(combined_shp[[parameters['adm1_name'], 'daily_cases_total_per_100k_tomorrow', 'daily_cases_total_per_100k_inTWOweeks']])
 
     # combined_shp = combined_shp.sort_values('daily_reported_cases_per_100k_abs_change', ascending=False)
-    combined_shp.to_csv(f'Outputs/{country_iso3}/ADM1_ranking.csv', index=False)
+    combined_shp.to_csv(f'{output_dir}/ADM1_ranking.csv', index=False)
     return combined_shp
 
 #this map is currently not used and has to be revised given the changes in metrics we made (especially active vs new cases)
@@ -814,7 +983,8 @@ def calculate_subnational_trends(country_iso3, parameters):
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args.country_iso3.upper(),download_covid=args.download_covid)
+    main(args.country_iso3.upper(),assessment_date=args.assessment_date or ASSESSMENT_DATE,download_covid=args.download_covid,render_jobs=args.jobs,offline=args.offline,force=args.force,
+         profile=args.profile,profile_memory=args.profile_memory,metrics_only=args.metrics_only)
 
 # # this graph is currently not being used
 # def generate_new_cases_graph(country_iso3):
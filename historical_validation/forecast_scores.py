@@ -0,0 +1,134 @@
+# skill scores of all vintages of the bucky projections against the reported data
+# the vintages of a metric are stacked into one array of forecasts by (vintage, date) and quantile, such that every score
+# is computed with array operations over all vintages and horizons at once
+import numpy as np
+import pandas as pd
+
+import utils
+import vintage_store
+
+# the reported variable of every source that a bucky metric is compared with
+OBSERVED_VARIABLES = {
+    'cumulative_reported_cases': {'WHO': 'Cumulative_cases', 'subnational': utils.HLX_TAG_TOTAL_CASES},
+    'daily_reported_cases': {'WHO': 'New_cases'},
+    'cumulative_deaths': {'WHO': 'Cumulative_deaths', 'subnational': utils.HLX_TAG_TOTAL_DEATHS},
+    'daily_deaths': {'WHO': 'New_deaths'},
+}
+SCORE_COLUMNS = ['country', 'metric', 'source', 'vintage', 'forecast_start', 'date', 'horizon', 'observed', 'median',
+                 'lower', 'upper', 'covered', 'absolute_error', 'wis']
+
+
+def get_symmetric_quantiles(quantiles, decimals=6):
+    # the quantiles of which the complement is also available, which are the bounds of the central prediction intervals
+    quantiles = np.round(np.asarray(quantiles, dtype=float), decimals)
+    complements = set(np.round(1 - quantiles, decimals))
+    return np.array(sorted(q for q in quantiles if q in complements))
+
+
+def get_weighted_interval_score(forecasts, quantiles, observed):
+    """
+    Compute the weighted interval score of quantile forecasts
+    The score of the K central prediction intervals and the median equals the mean quantile score over the 2K+1 quantiles,
+    such that it is computed on the whole array without pairing the interval bounds
+    Args:
+        forecasts: array with a row per forecast and a column per quantile
+        quantiles: the quantile of every column, symmetric around the median
+        observed: array with the observed value of every forecast
+    Returns:
+        array with the weighted interval score of every forecast
+    """
+    errors = forecasts - observed[:, np.newaxis]
+    quantile_scores = 2 * ((errors >= 0) - quantiles[np.newaxis, :]) * errors
+    return quantile_scores.mean(axis=1)
+
+
+def score_forecasts(forecasts, observed, min_quantile, max_quantile):
+    """
+    Score quantile forecasts against the observed values
+    Args:
+        forecasts: DataFrame with a row per forecast and a column per quantile, symmetric around the median
+        observed: array with the observed value of every forecast
+        min_quantile: quantile of the lower bound of the prediction interval of which the coverage is computed
+        max_quantile: quantile of the upper bound of the prediction interval of which the coverage is computed
+    Returns:
+        DataFrame with the median, interval bounds, coverage, absolute error of the median and weighted interval score of every forecast
+    """
+    values = forecasts.to_numpy(dtype=float)
+    quantiles = forecasts.columns.to_numpy(dtype=float)
+    median = forecasts[0.5].to_numpy(dtype=float)
+    lower = forecasts[min_quantile].to_numpy(dtype=float)
+    upper = forecasts[max_quantile].to_numpy(dtype=float)
+    return pd.DataFrame({
+        'median': median,
+        'lower': lower,
+        'upper': upper,
+        'covered': (observed >= lower) & (observed <= upper),
+        'absolute_error': np.abs(median - observed),
+        'wis': get_weighted_interval_score(values, quantiles, observed),
+    }, index=forecasts.index)
+
+
+def get_forecast_scores(session, country_iso3, metric, commit_ids, min_quantile, max_quantile, min_date, max_date):
+    """
+    Score all vintages of a bucky metric against every source of reported data
+    Args:
+        session: DataSession of the country, providing the WHO and subnational data
+        country_iso3: iso3 code of the country of interest
+        metric: the bucky metric to score
+        commit_ids: the commits of the vintages to score
+        min_quantile: quantile of the lower bound of the prediction interval of which the coverage is computed
+        max_quantile: quantile of the upper bound of the prediction interval of which the coverage is computed
+        min_date: vintages of which the projections start before this date are skipped
+        max_date: last date to score
+    Returns:
+        tidy DataFrame with a row per source, vintage and date that has both a projection and a reported value
+    """
+    table = vintage_store.read_vintage_table(country_iso3, commit_ids, metric, min_vintage_date=min_date, max_date=max_date)
+    if table.empty:
+        return pd.DataFrame(columns=SCORE_COLUMNS)
+    # one row per forecast, i.e. per vintage and date, with a column per quantile
+    forecasts = table.pivot_table(index=['vintage', 'forecast_start', 'date'], columns='quantile', values=metric)
+    quantiles = get_symmetric_quantiles(forecasts.columns)
+    forecasts.columns = np.round(forecasts.columns.to_numpy(dtype=float), 6)
+    # forecasts that miss a quantile, e.g. of vintages with fewer quantiles, are only scored on the quantiles all vintages have
+    forecasts = forecasts[quantiles].dropna()
+    forecast_dates = forecasts.index.get_level_values('date')
+
+    reported = {'WHO': session.get_who(min_date=min_date, max_date=max_date),
+                'subnational': session.get_subnational_covid_data(aggregate=True, min_date=min_date, max_date=max_date)}
+    scores = []
+    for source, variable in OBSERVED_VARIABLES[metric].items():
+        # align the reported values with the date of every forecast
+        observed = reported[source][variable].reindex(forecast_dates).to_numpy(dtype=float)
+        has_observation = ~np.isnan(observed)
+        df_scores = score_forecasts(forecasts[has_observation], observed[has_observation], min_quantile, max_quantile)
+        df_scores.insert(0, 'observed', observed[has_observation])
+        df_scores = df_scores.reset_index()
+        # the horizon is the number of days after the first projected date of the vintage
+        df_scores.insert(3, 'horizon', (pd.to_datetime(df_scores['date']) - pd.to_datetime(df_scores['forecast_start'])).dt.days)
+        df_scores.insert(0, 'country', country_iso3)
+        df_scores.insert(1, 'metric', metric)
+        df_scores.insert(2, 'source', source)
+        scores.append(df_scores)
+    return pd.concat(scores, ignore_index=True)[SCORE_COLUMNS]
+
+
+def summarize_forecast_scores(df_scores, horizon_bins=(0, 7, 14, 21, 28, 42, 56, 84)):
+    """
+    Aggregate the scores of the forecasts per country, metric, source and horizon
+    Args:
+        df_scores: DataFrame returned by get_forecast_scores
+        horizon_bins: edges of the horizons in days, the last bin includes all longer horizons
+    Returns:
+        tidy DataFrame with the coverage, mean absolute error, mean weighted interval score and number of forecasts per horizon bin
+    """
+    edges = list(horizon_bins) + [np.inf]
+    labels = [f'{start}-{end - 1}' for start, end in zip(horizon_bins[:-1], horizon_bins[1:])] + [f'{horizon_bins[-1]}+']
+    df_scores = df_scores.assign(horizon_days=pd.cut(df_scores['horizon'], edges, right=False, labels=labels))
+    summary = df_scores.groupby(['country', 'metric', 'source', 'horizon_days'], observed=True).agg(
+        coverage=('covered', 'mean'),
+        mean_absolute_error=('absolute_error', 'mean'),
+        mean_wis=('wis', 'mean'),
+        forecasts=('wis', 'size'),
+        vintages=('vintage', 'nunique'))
+    return summary.reset_index()
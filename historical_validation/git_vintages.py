@@ -0,0 +1,95 @@
+# read the historical versions (vintages) of a file from the local git repository, without checking them out or downloading them
+import io
+import subprocess
+import pandas as pd
+
+
+def list_commits(path, repo_dir='.'):
+    """
+    List the commits that changed path, most recent first
+    Args:
+        path: path of the file, relative to the root of the repository
+        repo_dir: directory of the repository
+    Returns:
+        list of (commit id, author date) tuples
+    """
+    log = subprocess.run(['git', 'log', '--format=%H %aI', '--', path], cwd=repo_dir,
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    commits = []
+    for line in log.splitlines():
+        commit_id, date = line.split(' ')
+        commits.append((commit_id, pd.to_datetime(date)))
+    return commits
+
+
+def read_gitlog(gitlog_filename):
+    """
+    Read the commits from the output of `git log` saved to a file, such as the logs archived with the old vintages
+    Args:
+        gitlog_filename: path to the saved output of git log
+    Returns:
+        list of (commit id, author date) tuples, in the order of the log
+    """
+    commits = []
+    with open(gitlog_filename, 'r') as f:
+        for line in f:
+            if line.startswith('commit '):
+                commit_id = line.split()[1]
+            elif line.startswith('Date:'):
+                commits.append((commit_id, pd.to_datetime(line[len('Date:'):].strip())))
+    return commits
+
+
+def merge_commits(*commit_lists):
+    # union of lists of (commit id, date) tuples, most recent first
+    commits = dict(commit for commit_list in commit_lists for commit in commit_list)
+    return sorted(commits.items(), key=lambda commit: commit[1], reverse=True)
+
+
+class GitBlobReader:
+    """
+    Read the content of files at given commits through one persistent `git cat-file --batch` process,
+    such that retrieving a vintage doesn't start a new process or write a temporary file
+    Args:
+        repo_dir: directory of the repository
+    """
+    def __init__(self, repo_dir='.'):
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo_dir,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, commit_id, path):
+        """
+        Read the content of a file at a commit
+        Args:
+            commit_id: id of the commit
+            path: path of the file, relative to the root of the repository
+        Returns:
+            the content as bytes, or None if the file doesn't exist at the commit
+        """
+        self.process.stdin.write(f'{commit_id}:{path}\n'.encode())
+        self.process.stdin.flush()
+        # the header is "<object id> <type> <size>", or "<object> missing" if it doesn't exist
+        header = self.process.stdout.readline().decode().split()
+        if header[-1] == 'missing':
+            return None
+        content = self.process.stdout.read(int(header[2]))
+        # the content is followed by a newline
+        self.process.stdout.read(1)
+        return content
+
+    def read_csv(self, commit_id, path, **kwargs):
+        # parse the file at the commit in memory, kwargs are passed to pd.read_csv
+        content = self.read(commit_id, path)
+        if content is None:
+            return None
+        return pd.read_csv(io.BytesIO(content), **kwargs)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,22 +2,24 @@ import os
 DIR_PATH = os.path.dirname(os.path.realpath('__file__'))
 import sys
 sys.path.insert(0, DIR_PATH)
-from datetime import datetime, timedelta
+from datetime import datetime
 import utils
-from utils import *
+from utils import DataSession, HLX_TAG_TOTAL_CASES, HLX_TAG_TOTAL_DEATHS, download_who_covid_data, lighten_color
+import numpy as np
 import pandas as pd
 from matplotlib import cm
+from git_vintages import GitBlobReader, list_commits, read_gitlog, merge_commits
+import vintage_store
+import forecast_scores
+from rendering import open_figure
 
 iso3s=['SSD','AFG','SOM','COD','SDN','IRQ']
-iso2s=['SS', 'AF', 'SO', 'CD', 'SD', 'IQ']
 
-download_bucky_csv=0
 download_WHO_csv=0
 
 TODAY = datetime.today().date()
 EARLIEST_DATE = datetime.strptime('2020-06-01', '%Y-%m-%d').date()
 
-GITHUB_REPO='https://raw.githubusercontent.com/OCHA-DAP/pa-COVID-model-reports'
 CONFIG_FILE = 'config.yml'
 WHO_COVID_URL='https://covid19.who.int/WHO-COVID-19-global-data.csv'
 WHO_COVID_FILENAME='WHO_data/WHO-COVID-19-global-data.csv'
@@ -30,17 +32,14 @@ MAX_QUANTILE=0.95
 
 
 
-def get_list_of_commits():
-    os.system(f'git log {DIR_PATH}/{BUCKY_CSV_FILE} > {GIT_LOGFILE}')
-    commit_ids=list()
-    dates=list()
-    with open (GIT_LOGFILE, 'rt') as myfile:  
-        for myline in myfile:
-            if 'commit' in myline:
-                commit_ids.append(myline.split(' ')[1].replace('\n',''))
-            if 'Date' in myline:
-                dates.append(myline.split('   ')[1].replace('\n',''))
-    dates=pd.to_datetime(dates)
+def get_list_of_commits(bucky_csv_file,data_folder):
+    commits=list_commits(bucky_csv_file,DIR_PATH)
+    # the commits of the archived vintages are added, as they can be missing from the local history, e.g. in a shallow clone
+    gitlog_filename=f'{data_folder}/gitlog.txt'
+    if os.path.exists(gitlog_filename):
+        commits=merge_commits(commits,read_gitlog(gitlog_filename))
+    commit_ids=[commit_id for commit_id,_ in commits]
+    dates=[date for _,date in commits]
     hour_diffs=[abs(t - s).total_seconds()/3600 for s, t in zip(dates, dates[1:])]
     # we always want to select the latest commit (position 0)
     hour_diffs.insert(0,1000)
@@ -48,131 +47,95 @@ def get_list_of_commits():
     commit_ids_download=[commit_id for commit_id,hour_diff in zip(commit_ids, hour_diffs) if hour_diff>=120]
     return commit_ids_download
 
-def download_bucky_results(DATA_FOLDER,GITHUB_REPO,BUCKY_CSV_FILE):
-    for commit_id in get_list_of_commits(BUCKY_CSV_FILE):
-        os.system(f'wget -O {DATA_FOLDER}/adm0_quantiles_{commit_id}.csv {GITHUB_REPO}/{commit_id}/{BUCKY_CSV_FILE}')
-
-def create_new_subplot(fig_title):
-    fig,axis=plt.subplots(figsize=(FIG_SIZE[0],FIG_SIZE[1]))
-    
-    locator = mdates.AutoDateLocator(minticks=3, maxticks=7)
-    formatter = mdates.DateFormatter('%d %b')
-    axis.xaxis.set_major_locator(locator)
-    axis.xaxis.set_major_formatter(formatter)
-
-    axis.set_title(fig_title)
-    x_axis = axis.axes.get_xaxis()
-    x_label = x_axis.get_label()
-    x_label.set_visible(False)
-    axis.grid(linestyle='-', linewidth='0.5', color='black',alpha=0.2)
-    return fig,axis
-
-def get_historical_bucky_collection(country_iso3,bucky_var):
-
-    DATA_FOLDER=f'{DIR_PATH}/historical_validation/data/{country_iso3}'
+def get_historical_bucky_collection(country_iso3,commit_ids,bucky_var):
     bucky_collection={}
-    for commit_id in get_list_of_commits():
-        csv_filename=f'{DATA_FOLDER}/adm0_quantiles_{commit_id}.csv'
-        df=pd.read_csv(csv_filename)
-        bucky_metric=''
-        quantile='quantile'
-        if not quantile in df.columns:
-            quantile='q'
-        for var in bucky_var:
-            if var in df.columns:
-                bucky_metric=var
-                break
-        df=df.set_index('date')
+    # vintages of which the projections start before EARLIEST_DATE are not read
+    vintages=vintage_store.read_vintages(country_iso3,commit_ids,bucky_var,[0.5,MIN_QUANTILE,MAX_QUANTILE],min_vintage_date=EARLIEST_DATE)
+    for commit_id,df in vintages.items():
         out_df=pd.DataFrame({
-            'med':df[df[quantile]==0.5][bucky_metric],
-            'min':df[df[quantile]==MIN_QUANTILE][bucky_metric],
-            'max':df[df[quantile]==MAX_QUANTILE][bucky_metric],
+            'med':df[0.5],
+            'min':df[MIN_QUANTILE],
+            'max':df[MAX_QUANTILE],
         })
         out_df.index = pd.to_datetime(out_df.index)
-        # the first date of the simulation should be removed, as it is an adjustment of the model
-        out_df = out_df.iloc[1:]
-        # finally remove all projections before EARLIEST_DATE
-        if min(out_df.index) < EARLIEST_DATE:
-            continue
-        bucky_collection[csv_filename]=out_df
+        bucky_collection[commit_id]=out_df
     return bucky_collection
 
 
-def draw_data_model_comparison(country_iso3,country_iso2,metric):
+def draw_data_model_comparison(session,country_iso3,metric,commit_ids):
     # plot the 4 inputs and save figure
     if metric=='cumulative_reported_cases':
         who_var='Cumulative_cases'
-        bucky_var=['cumulative_reported_cases','cumulative_cases_reported']
+        bucky_var='cumulative_reported_cases'
         subnational_var=HLX_TAG_TOTAL_CASES
         fig_title='Cumulative reported cases'
     elif metric=='daily_reported_cases':
         who_var='New_cases'
-        bucky_var=['daily_reported_cases','daily_cases_reported']
+        bucky_var='daily_reported_cases'
         fig_title='Daily reported cases'
     elif metric=='daily_deaths':
         who_var='New_deaths'
-        bucky_var=['daily_deaths']
+        bucky_var='daily_deaths'
         fig_title='Daily reported deaths'
     elif metric=='cumulative_deaths':
         who_var='Cumulative_deaths'
-        bucky_var=['cumulative_deaths']
+        bucky_var='cumulative_deaths'
         subnational_var=HLX_TAG_TOTAL_DEATHS
         fig_title='Cumulative deaths'
     else:
         print(f'metric {metric} not implemented')
         return False
 
-    parameters = utils.parse_yaml(CONFIG_FILE)[country_iso3]
-    who_covid=get_who(WHO_COVID_FILENAME,country_iso2,min_date=EARLIEST_DATE,max_date=TODAY)
-    subnational_covid = get_subnational_covid_data(parameters, aggregate=True, min_date=EARLIEST_DATE, max_date=TODAY)
-    bucky_npi_collection=get_historical_bucky_collection(country_iso3,bucky_var)
-
-    fig,axis=create_new_subplot(f'{fig_title} - {country_iso3}')
-
-    evenly_spaced_interval = np.linspace(0, 1, len(bucky_npi_collection))
-    colors = [cm.viridis(x) for x in evenly_spaced_interval]
-
-    for icolor,(_, bucky_npi) in enumerate(bucky_npi_collection.items()):
-        bucky_npi=bucky_npi[bucky_npi['med']>0]
-        bucky_npi['med'].plot(c=colors[icolor],ax=axis,label='_nolegend_',lw=5, zorder=0)
-        axis.fill_between(bucky_npi.index,
-                          bucky_npi['min'],
-                          bucky_npi['max'],
-                          color=colors[icolor],
-                          alpha=0.4)
-
-    # draw reported data by who
-    if 'daily' in metric:
-        axis.bar(who_covid.index, who_covid[who_var],alpha=0.8,color=WHO_DATA_COLOR,label='WHO')
-        # compute rolling 7-day average
-        who_covid_rolling = who_covid[who_var].rolling(window=7).mean()
-        axis.plot(who_covid_rolling.index, who_covid_rolling,
-        lw=3,color=lighten_color(WHO_DATA_COLOR,1.6),label='WHO - 7d rolling average')
-    else:
-        # draw WHO national reported numbers
-        axis.scatter(who_covid.index, who_covid[who_var],
-                     alpha=0.8, s=20,c=WHO_DATA_COLOR,marker='*',label='WHO')
-
-    axis.set_xlim(EARLIEST_DATE,TODAY)
-    if 'daily' in metric:
-        axis.add_artist(plt.legend(title='COVID-19 data',loc='upper left',ncol=2))
-        axis.add_artist(get_bucky_legend(colors,location='upper right'))
+    who_covid=session.get_who(min_date=EARLIEST_DATE,max_date=TODAY)
+    subnational_covid = session.get_subnational_covid_data(aggregate=True, min_date=EARLIEST_DATE, max_date=TODAY)
+    bucky_npi_collection=get_historical_bucky_collection(country_iso3,commit_ids,bucky_var)
+
+    # the figure is closed as soon as it is saved, such that the figures of all countries and metrics are not kept open
+    with open_figure(f'{fig_title} - {country_iso3}') as (fig,axis):
+        evenly_spaced_interval = np.linspace(0, 1, len(bucky_npi_collection))
+        colors = [cm.viridis(x) for x in evenly_spaced_interval]
+
+        for icolor,(_, bucky_npi) in enumerate(bucky_npi_collection.items()):
+            bucky_npi=bucky_npi[bucky_npi['med']>0]
+            bucky_npi['med'].plot(c=colors[icolor],ax=axis,label='_nolegend_',lw=5, zorder=0)
+            axis.fill_between(bucky_npi.index,
+                              bucky_npi['min'],
+                              bucky_npi['max'],
+                              color=colors[icolor],
+                              alpha=0.4)
+
+        # draw reported data by who
+        if 'daily' in metric:
+            axis.bar(who_covid.index, who_covid[who_var],alpha=0.8,color=WHO_DATA_COLOR,label='WHO')
+            # compute rolling 7-day average
+            who_covid_rolling = who_covid[who_var].rolling(window=7).mean()
+            axis.plot(who_covid_rolling.index, who_covid_rolling,
+            lw=3,color=lighten_color(WHO_DATA_COLOR,1.6),label='WHO - 7d rolling average')
+        else:
+            # draw WHO national reported numbers
+            axis.scatter(who_covid.index, who_covid[who_var],
+                         alpha=0.8, s=20,c=WHO_DATA_COLOR,marker='*',label='WHO')
+
+        axis.set_xlim(EARLIEST_DATE,TODAY)
+        if 'daily' in metric:
+            axis.add_artist(axis.legend(title='COVID-19 data',loc='upper left',ncol=2))
+            axis.add_artist(get_bucky_legend(axis,colors,location='upper right'))
+            fig.savefig(f'{DATA_FOLDER}/{country_iso3}_{metric}.png')
+            return
+        # draw subnational reported numbers
+        axis.scatter(subnational_covid.index, subnational_covid[subnational_var],\
+                         alpha=0.8, s=20,c=SUBNATIONAL_DATA_COLOR,marker='o',label='MoPH')
+
+        axis.add_artist(axis.legend(title='COVID-19 data',loc='upper left',ncol=2))
+        axis.add_artist(get_bucky_legend(axis,colors,location='lower right'))
         fig.savefig(f'{DATA_FOLDER}/{country_iso3}_{metric}.png')
-        return
-    # draw subnational reported numbers
-    axis.scatter(subnational_covid.index, subnational_covid[subnational_var],\
-                     alpha=0.8, s=20,c=SUBNATIONAL_DATA_COLOR,marker='o',label='MoPH')
-
-    axis.add_artist(plt.legend(title='COVID-19 data',loc='upper left',ncol=2))
-    axis.add_artist(get_bucky_legend(colors,location='lower right'))
-    fig.savefig(f'{DATA_FOLDER}/{country_iso3}_{metric}.png')
     return
 
-def get_bucky_legend(colors,location):
+def get_bucky_legend(axis,colors,location):
     from matplotlib.lines import Line2D
     custom_lines = [Line2D([0], [0], color=colors[0], lw=4),
                     Line2D([0], [0], color=colors[-1], lw=4)]
-    return plt.legend(custom_lines, ['Recent','Past'],title='OCHA-Bucky projections',loc=location,ncol=2)
+    return axis.legend(custom_lines, ['Recent','Past'],title='OCHA-Bucky projections',loc=location,ncol=2)
 
 
 if __name__ == "__main__":
@@ -181,18 +144,27 @@ if __name__ == "__main__":
         # Download latest covid file tiles and read them in
         download_who_covid_data(WHO_COVID_URL,WHO_COVID_FILENAME)
 
-    for icountry,country_iso3 in enumerate(iso3s):
-        country_iso2=iso2s[icountry]
-        BUCKY_CSV_FILE=f'Bucky_results/{country_iso3}_npi/adm0_quantiles.csv'
-        DATA_FOLDER=f'{DIR_PATH}/historical_validation/data/{country_iso3}'
-        GIT_LOGFILE=f'{DATA_FOLDER}/gitlog.txt'
-
-        if download_bucky_csv:
-            # get all bucky results from github
-            download_bucky_results(DATA_FOLDER,GITHUB_REPO,BUCKY_CSV_FILE)
-
-        draw_data_model_comparison(country_iso3,country_iso2,'daily_reported_cases')
-        draw_data_model_comparison(country_iso3,country_iso2,'cumulative_reported_cases')
-        draw_data_model_comparison(country_iso3,country_iso2,'daily_deaths')
-        draw_data_model_comparison(country_iso3,country_iso2,'cumulative_deaths')
-    plt.show()
\ No newline at end of file
+    config = utils.parse_yaml(CONFIG_FILE)
+    all_scores=[]
+    # the versions of the bucky results that are not in the vintage store yet are read from the local git history through one git process
+    with GitBlobReader(DIR_PATH) as reader:
+        for country_iso3 in iso3s:
+            # WHO and subnational data are read once per country and shared by all metrics
+            session=DataSession(country_iso3,config[country_iso3],WHO_COVID_FILENAME)
+            BUCKY_CSV_FILE=f'Bucky_results/{country_iso3}_npi/adm0_quantiles.csv'
+            DATA_FOLDER=f'{DIR_PATH}/historical_validation/data/{country_iso3}'
+            commit_ids=get_list_of_commits(BUCKY_CSV_FILE,DATA_FOLDER)
+            vintage_store.update_vintage_store(reader,country_iso3,BUCKY_CSV_FILE,commit_ids,archive_dir=DATA_FOLDER)
+
+            draw_data_model_comparison(session,country_iso3,'daily_reported_cases',commit_ids)
+            draw_data_model_comparison(session,country_iso3,'cumulative_reported_cases',commit_ids)
+            draw_data_model_comparison(session,country_iso3,'daily_deaths',commit_ids)
+            draw_data_model_comparison(session,country_iso3,'cumulative_deaths',commit_ids)
+
+            # score all vintages of every metric against the reported data
+            df_scores=pd.concat([forecast_scores.get_forecast_scores(session,country_iso3,metric,commit_ids,MIN_QUANTILE,MAX_QUANTILE,EARLIEST_DATE,TODAY)
+                                 for metric in forecast_scores.OBSERVED_VARIABLES],ignore_index=True)
+            df_scores.to_csv(f'{DATA_FOLDER}/{country_iso3}_forecast_scores.csv',index=False)
+            all_scores.append(df_scores)
+    forecast_scores.summarize_forecast_scores(pd.concat(all_scores,ignore_index=True))\
+        .to_csv(f'{DIR_PATH}/historical_validation/data/forecast_scores_summary.csv',index=False)
\ No newline at end of file
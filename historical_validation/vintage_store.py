@@ -0,0 +1,156 @@
+# store of all historical versions (vintages) of the bucky results of a country, with one normalized schema
+# each vintage is ingested once from the git history, after which the store is queried by vintage, date, quantile and metric
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import utils
+
+# one long-format dataset with a row per vintage, date, quantile and metric, partitioned by country as country=<iso3>/.
+# every update appends a file with the new vintages to the partition of the country
+VINTAGE_STORE_DIR = f'{utils.CACHE_DIR}/vintage_store'
+# the rows are sorted by vintage, metric and date, such that the statistics of the row groups allow skipping most of them on a filter
+VINTAGE_STORE_ROW_GROUP_SIZE = 100000
+# the vintages that were downloaded before they were read from the git history are archived under this name
+ARCHIVE_FILENAME = 'adm0_quantiles_{commit_id}.csv'
+# old bucky results used other column names, these are renamed to the current names at ingest
+COLUMN_NAMES = {'q': 'quantile', 'cumulative_cases_reported': 'cumulative_reported_cases', 'daily_cases_reported': 'daily_reported_cases'}
+STORE_SCHEMA = pa.schema([('vintage', pa.string()), ('forecast_start', pa.date32()), ('date', pa.date32()),
+                          ('quantile', pa.float64()), ('metric', pa.string()), ('value', pa.float64())])
+
+
+def get_store_dir(country_iso3):
+    return f'{VINTAGE_STORE_DIR}/country={country_iso3}'
+
+
+def read_store(country_iso3, columns, filters=None):
+    # read the rows of a country in one call, the partitions of the other countries are skipped on their directory name
+    if not os.path.isdir(get_store_dir(country_iso3)):
+        return STORE_SCHEMA.empty_table().select(columns).to_pandas()
+    return pq.read_table(VINTAGE_STORE_DIR, columns=columns, filters=[('country', '=', country_iso3)] + (filters or [])).to_pandas()
+
+
+def get_stored_vintages(country_iso3):
+    return set(read_store(country_iso3, ['vintage'])['vintage'])
+
+
+def normalize_vintage(df):
+    """
+    Convert a vintage of the bucky results to the schema of the store
+    Args:
+        df: DataFrame of the bucky results as saved at the commit
+    Returns:
+        DataFrame with a date and quantile column and a column per metric, sorted by date and quantile
+    """
+    df = df.rename(columns=COLUMN_NAMES)
+    df['date'] = pd.to_datetime(df['date']).dt.date
+    # the first date of the simulation should be removed, as it is an adjustment of the model
+    df = df[df['date'] > df['date'].min()]
+    metrics = [c for c in df.select_dtypes(include=[np.number]).columns if c not in ['quantile', 'adm0', 'adm1']]
+    return df[['date', 'quantile'] + metrics].sort_values(['date', 'quantile'])
+
+
+def read_vintage_csv(reader, commit_id, bucky_csv_file, archive_dir=None):
+    # read a vintage from the git history, or from the archive if the commit isn't in the local history, e.g. in a shallow clone
+    df = reader.read_csv(commit_id, bucky_csv_file)
+    archive_filename = f'{archive_dir}/{ARCHIVE_FILENAME.format(commit_id=commit_id)}'
+    if df is None and archive_dir is not None and os.path.exists(archive_filename):
+        df = pd.read_csv(archive_filename)
+    return df
+
+
+def to_long_format(commit_id, df):
+    # one row per date, quantile and metric of a normalized vintage
+    df = df.melt(id_vars=['date', 'quantile'], var_name='metric', value_name='value')
+    df.insert(0, 'vintage', commit_id)
+    df.insert(1, 'forecast_start', df['date'].min())
+    return df
+
+
+def update_vintage_store(reader, country_iso3, bucky_csv_file, commit_ids, archive_dir=None):
+    """
+    Ingest the vintages that are not in the store yet, they are appended to the partition of the country as one file
+    Args:
+        reader: GitBlobReader to read the vintages with
+        country_iso3: iso3 code of the country of interest
+        bucky_csv_file: path of the bucky results, relative to the root of the repository
+        commit_ids: the commits of the vintages to have in the store
+        archive_dir: directory with the archived vintages, which are read if the commit isn't in the local git history
+    Returns:
+        the number of vintages that were ingested
+    """
+    stored_vintages = get_stored_vintages(country_iso3)
+    vintages = []
+    for commit_id in commit_ids:
+        if commit_id in stored_vintages:
+            continue
+        df = read_vintage_csv(reader, commit_id, bucky_csv_file, archive_dir)
+        # the file doesn't exist at the commit
+        if df is None:
+            continue
+        vintages.append(to_long_format(commit_id, normalize_vintage(df)))
+    if not vintages:
+        return 0
+    df = pd.concat(vintages, ignore_index=True).sort_values(['vintage', 'metric', 'date', 'quantile'])
+    store_dir = get_store_dir(country_iso3)
+    os.makedirs(store_dir, exist_ok=True)
+    # the file is written under a hidden name first, which is not part of the dataset, such that readers never see a partial file
+    filename = f'part-{time.time_ns()}-{os.getpid()}.parquet'
+    pq.write_table(pa.Table.from_pandas(df, schema=STORE_SCHEMA, preserve_index=False), f'{store_dir}/.{filename}.tmp',
+                   row_group_size=VINTAGE_STORE_ROW_GROUP_SIZE)
+    os.replace(f'{store_dir}/.{filename}.tmp', f'{store_dir}/{filename}')
+    print(f'{country_iso3}: ingested {len(vintages)} new vintages')
+    return len(vintages)
+
+
+def read_vintage_table(country_iso3, commit_ids, metric, quantiles=None, min_vintage_date=None, min_date=None, max_date=None):
+    """
+    Read a metric of several vintages from the store as one long table, with a single filtered read
+    Args:
+        country_iso3: iso3 code of the country of interest
+        commit_ids: the commits of the vintages to read, in the order they are returned
+        metric: the metric to read
+        quantiles: the quantiles to read. If None, all quantiles are read
+        min_vintage_date: vintages of which the projections start before this date are skipped
+        min_date: first date to read of every vintage
+        max_date: last date to read of every vintage
+    Returns:
+        DataFrame with the columns vintage (the commit id), forecast_start (the first projected date of the vintage), date, quantile and the metric
+    """
+    filters = [('vintage', 'in', list(commit_ids)), ('metric', '=', metric)]
+    if quantiles is not None:
+        filters.append(('quantile', 'in', list(quantiles)))
+    if min_vintage_date is not None:
+        filters.append(('forecast_start', '>=', min_vintage_date))
+    if min_date is not None:
+        filters.append(('date', '>=', min_date))
+    if max_date is not None:
+        filters.append(('date', '<=', max_date))
+    df = read_store(country_iso3, ['vintage', 'forecast_start', 'date', 'quantile', 'value'], filters)
+    df = df.rename(columns={'value': metric})
+    # the vintages are returned in the order of the commits
+    order = {commit_id: i for i, commit_id in enumerate(commit_ids)}
+    df = df.sort_values(['vintage', 'date', 'quantile'], key=lambda c: c.map(order) if c.name == 'vintage' else c)
+    return df.reset_index(drop=True)
+
+
+def read_vintages(country_iso3, commit_ids, metric, quantiles, min_vintage_date=None, min_date=None, max_date=None):
+    """
+    Read a metric of several vintages from the store
+    Args:
+        country_iso3: iso3 code of the country of interest
+        commit_ids: the commits of the vintages to read, in the order they are returned
+        metric: the metric to read
+        quantiles: the quantiles to read
+        min_vintage_date: vintages of which the projections start before this date are skipped
+        min_date: first date to read of every vintage
+        max_date: last date to read of every vintage
+    Returns:
+        dict with per commit id a DataFrame indexed by date with a column per quantile
+    """
+    table = read_vintage_table(country_iso3, commit_ids, metric, quantiles, min_vintage_date, min_date, max_date)
+    return {commit_id: df.pivot(index='date', columns='quantile', values=metric)
+            for commit_id, df in table.groupby('vintage', sort=False)}
@@ -0,0 +1,152 @@
+# build manifest of the outputs of a country, such that a run only regenerates the outputs of which the inputs changed
+import os
+import json
+import pickle
+import hashlib
+
+import utils
+
+MANIFEST_FILENAME = 'manifest.json'
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+#the content hashes of the local input files, memoized by their stat, see get_file_hashes
+FILE_HASHES_FILENAME = f'{utils.CACHE_DIR}/file_hashes.json'
+#a change in the code can change every output, so the code is one of the inputs of a run
+CODE_FILES = ['generate_charts_report.py', 'utils.py', 'chart_specs.py', 'rendering.py', 'manifest.py', 'metrics_store.py', 'profiler.py']
+
+
+def get_content_hash(filename):
+    content_hash = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def get_file_hashes(filenames):
+    """
+    Hash the content of local files, such that a file that is touched or checked out again with the same content is not a change.
+    The hashes are memoized by the inode, size, modification time and change time of the files. The change time is updated by every
+    write and can't be set back, such that a rewrite that keeps the modification time and size, e.g. a copy with -p, is hashed again
+    Args:
+        filenames: paths of the files to hash
+    Returns:
+        dict with the sha256 of every file, by filename
+    """
+    memo = {}
+    if os.path.exists(FILE_HASHES_FILENAME):
+        with open(FILE_HASHES_FILENAME, 'r') as f:
+            memo = json.load(f)
+    hashes = {}
+    memo_changed = False
+    for filename in filenames:
+        file_stat = os.stat(filename)
+        stat_key = f'{file_stat.st_ino}-{file_stat.st_size}-{file_stat.st_mtime_ns}-{file_stat.st_ctime_ns}'
+        path = os.path.realpath(filename)
+        if memo.get(path, {}).get('stat') != stat_key:
+            memo[path] = {'stat': stat_key, 'sha256': get_content_hash(filename)}
+            memo_changed = True
+        hashes[filename] = memo[path]['sha256']
+    if memo_changed:
+        utils.write_json(FILE_HASHES_FILENAME, memo)
+    return hashes
+
+
+def get_mirror_hash(url):
+    #the mirror stores a file under the sha256 of its content, so the path identifies the content without reading it again
+    return os.path.basename(utils.fetch_url(url))
+
+
+def get_who_hash(who_filename, country_iso2):
+    #the partitions are rewritten by every ingest of the global csv, so only the content of the partition of the country identifies its data
+    partition_filename = utils.get_who_partition(who_filename, country_iso2)
+    return get_content_hash(partition_filename) if os.path.exists(partition_filename) else None
+
+
+def get_chart_hash(chart):
+    #the spec holds all the data that is drawn, so two specs with the same pickle produce the same figure
+    return hashlib.sha256(pickle.dumps(chart, protocol=4)).hexdigest()
+
+
+def get_run_inputs(country_iso3, parameters, assessment_date, who_filename):
+    """
+    Fingerprint all the inputs of the run of a country
+    Args:
+        country_iso3: iso3 code of the country of interest
+        parameters: country specific parameters, retrieved from config
+        assessment_date: date of the assessment as a string in the format YYYY-MM-DD
+        who_filename: path to the global WHO csv
+    Returns:
+        dict with a fingerprint per input
+    """
+    shape_basename = os.path.splitext(parameters['shape'])[0]
+    bucky_filenames = {f'{admin_level}_{npi_filter}': utils.get_bucky_filename(country_iso3, admin_level, npi_filter)
+                       for admin_level in ['adm0', 'adm1'] for npi_filter in ['npi', 'no_npi']}
+    shape_filenames = [f'{shape_basename}{ext}' for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg'] if os.path.exists(f'{shape_basename}{ext}')]
+    file_hashes = get_file_hashes(list(bucky_filenames.values()) + shape_filenames)
+    return {
+        'assessment_date': assessment_date,
+        'config': json.dumps(parameters, sort_keys=True, default=str),
+        'bucky': {name: file_hashes[filename] for name, filename in bucky_filenames.items()},
+        'who': get_who_hash(who_filename, parameters['iso2_code']),
+        'subnational': get_mirror_hash(parameters['subnational_cases_url']),
+        'npis': get_mirror_hash(parameters['npis_url']),
+        'shape': [file_hashes[filename] for filename in shape_filenames],
+        'code': {code_file: get_content_hash(f'{DIR_PATH}/{code_file}') for code_file in CODE_FILES},
+    }
+
+
+def read_manifest(output_folder):
+    manifest_filename = f'{output_folder}/{MANIFEST_FILENAME}'
+    if not os.path.exists(manifest_filename):
+        return {'inputs': None, 'artifacts': {}, 'charts': {}}
+    with open(manifest_filename, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(output_folder, inputs, artifacts, charts):
+    """
+    Write the manifest of a run. It is written after all outputs are generated, such that an interrupted run is never considered up to date
+    Args:
+        output_folder: folder of the outputs of the run
+        inputs: fingerprints of the inputs of the run, see get_run_inputs
+        artifacts: dict with the content hash of every output, by filename
+        charts: dict with the hash of the spec of every figure, by output file, see get_stale_charts
+    """
+    utils.write_json(f'{output_folder}/{MANIFEST_FILENAME}', {'inputs': inputs, 'artifacts': artifacts, 'charts': charts})
+
+
+def is_unchanged(manifest, artifact):
+    #an output is unchanged if it still has the content it was generated with
+    return os.path.exists(artifact) and manifest['artifacts'].get(artifact) == get_content_hash(artifact)
+
+
+def is_up_to_date(manifest, inputs):
+    #the outputs are up to date if they were generated from the same inputs and none of them was changed or removed since
+    return manifest['inputs'] == inputs and all(is_unchanged(manifest, artifact) for artifact in manifest['artifacts'])
+
+
+def get_stale_charts(manifest, charts):
+    """
+    Select the charts that have to be rendered
+    Args:
+        manifest: manifest of the previous run
+        charts: list of ChartSpec of the current run
+    Returns:
+        stale_charts: the charts of which the figure doesn't exist, was changed or was rendered from a different spec
+        chart_hashes: dict with the hash of every chart, by output file
+    """
+    chart_hashes = {chart.output_file: get_chart_hash(chart) for chart in charts}
+    #manifests written before the spec hashes were stored separately have no charts
+    previous_hashes = manifest.get('charts', {})
+    stale_charts = [chart for chart in charts if not is_unchanged(manifest, chart.output_file)
+                    or previous_hashes.get(chart.output_file) != chart_hashes[chart.output_file]]
+    return stale_charts, chart_hashes
+
+
+def remove_orphans(output_folder, artifacts):
+    #remove the files in the output folder that the run didn't produce, e.g. figures of which the filename changed
+    for filename in sorted(os.listdir(output_folder)):
+        path = f'{output_folder}/{filename}'
+        if filename != MANIFEST_FILENAME and path not in artifacts and os.path.isfile(path):
+            os.remove(path)
+            print(f'Removed orphaned output {path}')
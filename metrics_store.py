@@ -0,0 +1,105 @@
+# store of the computed metrics of all countries and assessment dates
+# the per country results csv's that are used by the reports are exported from this store
+import os
+import sqlite3
+
+import pandas as pd
+
+METRICS_STORE_FILENAME = 'automated_reports/report_metrics/metrics.sqlite'
+RESULTS_COLUMNS = ['metric_name', 'metric_value', 'assessment_date', 'country']
+
+
+def connect_metrics_store(filename=METRICS_STORE_FILENAME):
+    """
+    Open the metrics store and create the table if it doesn't exist yet
+    Args:
+        filename: path to the sqlite database
+    Returns:
+        sqlite3 connection to the store
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    #wait for the lock if other countries are writing at the same time
+    connection = sqlite3.connect(filename, timeout=60)
+    with connection:
+        #the values are stored as the text that is written to the csv, since a metric can be a number, a date or a boolean
+        connection.execute('''CREATE TABLE IF NOT EXISTS metrics (
+                                country TEXT NOT NULL,
+                                assessment_date TEXT NOT NULL,
+                                metric_name TEXT NOT NULL,
+                                metric_value TEXT,
+                                PRIMARY KEY (country, assessment_date, metric_name))''')
+        connection.execute('CREATE INDEX IF NOT EXISTS metrics_by_name ON metrics (metric_name, assessment_date)')
+    return connection
+
+
+def upsert_metrics(connection, country_iso3, assessment_date, metrics, replace=False):
+    """
+    Insert the metrics of an assessment, or update them if they already exist
+    Args:
+        connection: connection to the metrics store
+        country_iso3: iso3 code of the country of interest
+        assessment_date: date of the assessment
+        metrics: iterable of (metric_name, metric_value)
+        replace: if True, the metrics of the assessment that are not in metrics are removed
+    """
+    rows = [(country_iso3, str(assessment_date), metric_name, str(metric_value)) for metric_name, metric_value in metrics]
+    with connection:
+        if replace:
+            connection.execute('DELETE FROM metrics WHERE country=? AND assessment_date=?', (country_iso3, str(assessment_date)))
+        connection.executemany('''INSERT INTO metrics (country, assessment_date, metric_name, metric_value) VALUES (?, ?, ?, ?)
+                                  ON CONFLICT (country, assessment_date, metric_name) DO UPDATE SET metric_value=excluded.metric_value''',
+                               rows)
+
+
+def get_metrics(connection, country_iso3=None, metric_names=None, min_date=None, max_date=None):
+    """
+    Retrieve metrics from the store
+    Args:
+        connection: connection to the metrics store
+        country_iso3: iso3 code of the country to retrieve the metrics of. If None, the metrics of all countries are retrieved
+        metric_names: list of the names of the metrics to retrieve. If None, all metrics are retrieved
+        min_date: first assessment date to retrieve (inclusive)
+        max_date: last assessment date to retrieve (inclusive)
+    Returns:
+        DataFrame with the columns of the results csv, ordered by assessment date
+    """
+    conditions = []
+    parameters = []
+    if country_iso3 is not None:
+        conditions.append('country=?')
+        parameters.append(country_iso3)
+    if metric_names is not None:
+        conditions.append(f'metric_name IN ({",".join("?" * len(metric_names))})')
+        parameters += list(metric_names)
+    if min_date is not None:
+        conditions.append('assessment_date>=?')
+        parameters.append(str(min_date))
+    if max_date is not None:
+        conditions.append('assessment_date<=?')
+        parameters.append(str(max_date))
+    query = f'SELECT {", ".join(RESULTS_COLUMNS)} FROM metrics'
+    if conditions:
+        query += f' WHERE {" AND ".join(conditions)}'
+    #within an assessment the metrics are kept in the order they were inserted
+    query += ' ORDER BY assessment_date, rowid'
+    return pd.read_sql_query(query, connection, params=parameters)
+
+
+def import_results_csv(connection, country_iso3, filename):
+    #import the results csv of a country that isn't in the store yet, i.e. the metrics computed before the store existed
+    if not os.path.exists(filename):
+        return
+    if connection.execute('SELECT 1 FROM metrics WHERE country=? LIMIT 1', (country_iso3,)).fetchone() is not None:
+        return
+    #read everything as text, such that the values are stored exactly as they were written
+    df_results = pd.read_csv(filename, dtype=str, keep_default_na=False)
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO metrics (country, assessment_date, metric_name, metric_value) VALUES (?, ?, ?, ?)',
+                               df_results[['country', 'assessment_date', 'metric_name', 'metric_value']].itertuples(index=False))
+
+
+def export_results_csv(connection, country_iso3, filename):
+    #write the metrics of all assessments of a country to the csv that is used by the reports
+    df_results = get_metrics(connection, country_iso3)
+    df_results.to_csv(f'{filename}.tmp', index=False)
+    os.replace(f'{filename}.tmp', filename)
@@ -0,0 +1,185 @@
+# profiler of the stages of a run, that records the duration and optionally the peak memory of nested spans
+# the spans of a run are written as a json summary and as a chrome trace, that can be opened in chrome://tracing or https://ui.perfetto.dev
+import os
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_DIR = 'profiles'
+
+#the profiler of the current run, None when the run isn't profiled such that the spans cost next to nothing
+_profiler = None
+
+
+class Profiler:
+    """
+    Collection of the spans of a run, in the chrome trace event format
+    Args:
+        trace_memory: if True, the peak memory allocated by python during every span is measured with tracemalloc.
+            Before python 3.9 the peak can't be reset, so the peak of a span is the peak since the start of the profiling
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.events = []
+        #per open span the time spent in its child spans and the peak memory of its finished child spans
+        self._stack = []
+
+    @contextmanager
+    def span(self, name, category, args):
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self._stack.append({'children': 0., 'peak': 0})
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            frame = self._stack.pop()
+            event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start_time * 1e6, 'dur': duration * 1e6,
+                     'pid': os.getpid(), 'tid': threading.get_ident(),
+                     'args': {**args, 'self_dur': (duration - frame['children']) * 1e6}}
+            if self._stack:
+                self._stack[-1]['children'] += duration
+            if self.trace_memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+                event['args']['peak_memory_mb'] = peak / (1024 * 1024)
+            self.events.append(event)
+
+    def summary(self):
+        """
+        Aggregate the spans by name
+        Returns:
+            list with per name the number of calls, the total, self and maximum duration in seconds and the peak memory in MB, by descending self duration
+        """
+        spans = {}
+        for event in self.events:
+            span = spans.setdefault(event['name'], {'name': event['name'], 'category': event['cat'], 'calls': 0,
+                                                    'total_s': 0., 'self_s': 0., 'max_s': 0.})
+            span['calls'] += 1
+            span['total_s'] += event['dur'] / 1e6
+            span['self_s'] += event['args']['self_dur'] / 1e6
+            span['max_s'] = max(span['max_s'], event['dur'] / 1e6)
+            if 'peak_memory_mb' in event['args']:
+                span['peak_memory_mb'] = max(span.get('peak_memory_mb', 0.), event['args']['peak_memory_mb'])
+        return sorted(spans.values(), key=lambda span: span['self_s'], reverse=True)
+
+    def write(self, output_dir, name):
+        """
+        Write the summary and the chrome trace of the spans
+        Args:
+            output_dir: directory to write the files to
+            name: name of the run, the files are named {name}_{time}_summary.json and {name}_{time}_trace.json
+        Returns:
+            the paths of the summary and the trace
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        basename = f'{output_dir}/{name}_{datetime.now():%Y%m%dT%H%M%S}'
+        with open(f'{basename}_summary.json', 'w') as f:
+            json.dump({'name': name, 'trace_memory': self.trace_memory, 'spans': self.summary()}, f, indent=2)
+        with open(f'{basename}_trace.json', 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        return f'{basename}_summary.json', f'{basename}_trace.json'
+
+
+def start_profiling(trace_memory=False):
+    global _profiler
+    _profiler = Profiler(trace_memory)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_profiling():
+    #stop the profiling and return the profiler with the spans of the run
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None and profiler.trace_memory:
+        tracemalloc.stop()
+    return profiler
+
+
+def is_profiling():
+    return _profiler is not None
+
+
+def is_tracing_memory():
+    return _profiler is not None and _profiler.trace_memory
+
+
+def span(name, category='stage', **args):
+    """
+    Context manager that records the code it wraps as a span of the current run, if the run is profiled
+    Args:
+        name: name of the span
+        category: category of the span, e.g. stage, io, compute or render
+        args: extra information that is added to the span in the trace
+    """
+    if _profiler is None:
+        return _null_span()
+    return _profiler.span(name, category, args)
+
+
+@contextmanager
+def _null_span():
+    yield
+
+
+def profiled(name=None, category='stage'):
+    # decorator that records every call of the function as a span, named after the function by default
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _profiler.span(span_name, category, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def pop_events():
+    #the spans recorded so far, e.g. in a worker process, which are removed such that they are returned only once
+    if _profiler is None:
+        return []
+    events, _profiler.events = _profiler.events, []
+    return events
+
+
+def add_events(events):
+    #add the spans recorded in another process, e.g. a render worker, to the current run
+    if _profiler is not None:
+        _profiler.events += events
+
+
+@contextmanager
+def profile_run(name, enabled=True, trace_memory=False, output_dir=PROFILE_DIR):
+    """
+    Profile the code in the context and write the summary and chrome trace of its spans when the context exits
+    Args:
+        name: name of the run, used in the filenames
+        enabled: if False, the run isn't profiled
+        trace_memory: if True, the peak memory of every span is measured
+        output_dir: directory to write the profile to
+    """
+    if not enabled:
+        yield
+        return
+    start_profiling(trace_memory)
+    try:
+        with span(name, 'run'):
+            yield
+    finally:
+        summary_filename, trace_filename = stop_profiling().write(output_dir, name)
+        print(f'Profile written to {summary_filename} and {trace_filename}')
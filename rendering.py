@@ -0,0 +1,237 @@
+# rendering of the figures, separated from the preparation of the data that is shown in them
+# this is the only module of the report that uses matplotlib and geopandas. They are imported in the functions that draw,
+# such that importing the module doesn't load them before there are figures to render
+import gc
+import os
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import profiler
+from chart_specs import MapSpec
+
+logger = logging.getLogger(__name__)
+
+FIG_SIZE = (8, 6)
+# ceiling of the growth of the resident memory of a process since it started rendering, in MB, such that the memory of the data
+# loaded before doesn't count. When a figure is closed with the growth above the ceiling, all pyplot state is released,
+# and if that doesn't bring it below the ceiling the rendering stops. None disables the ceiling
+FIGURE_MEMORY_CEILING_MB = 2048
+# resident memory of the process when it started rendering, in MB, see start_memory_ceiling
+rendering_start_memory = None
+
+
+def set_matlotlib(plt):
+
+    plt.rcParams['axes.grid'] = True
+    plt.rcParams['grid.color'] = 'lightgrey'
+    plt.rcParams['grid.linestyle'] = 'solid'
+    plt.rcParams['grid.linewidth'] = 0.5
+    plt.rcParams.update({'font.size': 15})
+
+
+def create_new_subplot(fig_title):
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    fig, axis = plt.subplots(figsize=(FIG_SIZE[0], FIG_SIZE[1]))
+
+    locator = mdates.AutoDateLocator(minticks=3, maxticks=7)
+    formatter = mdates.DateFormatter('%d %b')
+    axis.xaxis.set_major_locator(locator)
+    axis.xaxis.set_major_formatter(formatter)
+
+    axis.set_title(fig_title)
+    x_axis = axis.axes.get_xaxis()
+    x_label = x_axis.get_label()
+    x_label.set_visible(False)
+    axis.grid(linestyle='-', linewidth='0.5', color='black', alpha=0.2)
+    return fig, axis
+
+
+def get_colormap(spec):
+    # the colormap and normalization of the bins of a MapSpec. Regions with a nan value are drawn fully transparent,
+    # such that they are omitted like geopandas omits the regions with a missing value of the plotted column
+    from matplotlib.colors import BoundaryNorm, LinearSegmentedColormap
+    cmap = LinearSegmentedColormap.from_list('', spec.colors).with_extremes(bad=(0, 0, 0, 0))
+    return cmap, BoundaryNorm(boundaries=spec.bins, ncolors=256)
+
+
+def get_memory_usage():
+    # resident memory of the process in MB, or None if it can't be determined on this platform
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def start_memory_ceiling():
+    # record the memory of the process before it renders, the ceiling applies to the growth above it
+    global rendering_start_memory
+    rendering_start_memory = get_memory_usage()
+
+
+def check_memory_ceiling(ceiling=FIGURE_MEMORY_CEILING_MB):
+    """
+    Enforce the memory ceiling of the rendering. When the memory grew above the ceiling since the rendering started,
+    all figures that are still registered with pyplot are closed and their memory is collected
+    Args:
+        ceiling: ceiling of the growth in MB, None disables the check
+    Raises:
+        MemoryError: if the memory growth is still above the ceiling after the figures are released
+    """
+    import matplotlib.pyplot as plt
+    if ceiling is None or rendering_start_memory is None:
+        return
+    memory_usage = get_memory_usage()
+    if memory_usage is None or memory_usage - rendering_start_memory <= ceiling:
+        return
+    logger.warning(f'Memory usage grew by {memory_usage-rendering_start_memory:.0f}MB while rendering, above the ceiling of {ceiling}MB, '
+                   f'closing {len(plt.get_fignums())} open figures')
+    plt.close('all')
+    gc.collect()
+    memory_usage = get_memory_usage()
+    if memory_usage - rendering_start_memory > ceiling:
+        raise MemoryError(f'Memory usage grew by {memory_usage-rendering_start_memory:.0f}MB while rendering, '
+                          f'above the ceiling of {ceiling}MB after closing all figures')
+
+
+@contextmanager
+def open_figure(fig_title):
+    """
+    Create a new subplot that is closed when the context exits, also when drawing fails, such that no figure outlives its use.
+    The memory ceiling is only checked when drawing succeeded, such that it doesn't replace the error of the drawing
+    Args:
+        fig_title: the title of the figure
+    Yields:
+        fig, axis: the figure and its axis, see create_new_subplot
+    """
+    import matplotlib.pyplot as plt
+    if rendering_start_memory is None:
+        start_memory_ceiling()
+    fig, axis = create_new_subplot(fig_title)
+    try:
+        yield fig, axis
+    except BaseException:
+        plt.close(fig)
+        raise
+    plt.close(fig)
+    check_memory_ceiling(FIGURE_MEMORY_CEILING_MB)
+
+
+def apply_operations(fig, axis, operations):
+    for target, method, args, kwargs in operations:
+        if target == 'axis':
+            getattr(axis, method)(*args, **kwargs)
+        elif target == 'figure':
+            getattr(fig, method)(*args, **kwargs)
+        else:
+            getattr(args[0], method)(ax=axis, **kwargs)
+
+
+def render_chart(spec):
+    """
+    Draw the operations of the spec on a new subplot and save the figure
+    Args:
+        spec: ChartSpec of the figure
+    Returns:
+        the path the figure was saved to
+    """
+    with open_figure(spec.fig_title) as (fig, axis):
+        with profiler.span('draw', 'render', output_file=spec.output_file):
+            apply_operations(fig, axis, spec.operations)
+        with profiler.span('savefig', 'render', output_file=spec.output_file):
+            fig.savefig(spec.output_file)
+    return spec.output_file
+
+
+def render_maps(specs):
+    """
+    Render the maps of the same shapefile on one figure. The polygons and boundaries of the regions are drawn once,
+    after which every map only sets the colors of the polygons, the title and the layout before it is saved
+    Args:
+        specs: list of MapSpec with the same shape
+    Returns:
+        the paths the figures were saved to
+    """
+    import geopandas as gpd
+    with open_figure(specs[0].fig_title) as (fig, axis):
+        fig_size = fig.get_size_inches()
+        subplot_params = {name: getattr(fig.subplotpars, name) for name in ['left', 'bottom', 'right', 'top', 'wspace', 'hspace']}
+        # the polygons are drawn with the position of their region as value, such that the region of every polygon in the
+        # collection is known, also when a region consists of several polygons
+        with profiler.span('draw_regions', 'render'):
+            regions = gpd.GeoDataFrame(geometry=specs[0].regions)
+            cmap, norm = get_colormap(specs[0])
+            regions.plot(column=np.arange(len(regions), dtype=float), cmap=cmap, norm=norm, ax=axis)
+            collection = axis.collections[-1]
+            positions = np.asarray(collection.get_array(), dtype=int)
+            regions.boundary.plot(ax=axis, **specs[0].boundary_kwargs)
+        for spec in specs:
+            # the operations of a map, e.g. a change of the figure size or layout, are applied on the figure as it was created
+            fig.set_size_inches(fig_size)
+            fig.subplots_adjust(**subplot_params)
+            axis.set_title(spec.fig_title)
+            collection.set_array(np.asarray(spec.values, dtype=float)[positions])
+            cmap, norm = get_colormap(spec)
+            collection.set_cmap(cmap)
+            collection.set_norm(norm)
+            apply_operations(fig, axis, spec.operations)
+            with profiler.span('savefig', 'render', output_file=spec.output_file):
+                fig.savefig(spec.output_file)
+    return [spec.output_file for spec in specs]
+
+
+def render_task(specs):
+    # a task is either a single chart or the maps of the same regions
+    if isinstance(specs[0], MapSpec):
+        return render_maps(specs)
+    return [render_chart(spec) for spec in specs]
+
+
+def run_render_task(specs):
+    # render a task in a worker process and return the spans recorded while rendering, such that they are added to the profile of the run
+    return render_task(specs), profiler.pop_events()
+
+
+def init_render_worker(profile=False, trace_memory=False):
+    # every worker renders with the non-interactive Agg backend and the same plot parameters as the main process
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    set_matlotlib(plt)
+    start_memory_ceiling()
+    # and is profiled if the main process is
+    if profile:
+        profiler.start_profiling(trace_memory)
+
+
+@profiler.profiled(category='render')
+def render_charts(specs, jobs=1):
+    """
+    Render the figures of all specs. With more than one job the figures are rendered in parallel in a pool of worker processes,
+    where the maps of the same regions are rendered by the same worker
+    Args:
+        specs: list of ChartSpec
+        jobs: number of processes to render the figures with
+    """
+    import matplotlib.pyplot as plt
+    set_matlotlib(plt)
+    start_memory_ceiling()
+    tasks = [[spec] for spec in specs if not isinstance(spec, MapSpec)]
+    # the maps are grouped by their shapefile, such that the regions are drawn once per group
+    map_groups = {}
+    for spec in specs:
+        if isinstance(spec, MapSpec):
+            map_groups.setdefault(spec.shape, []).append(spec)
+    tasks += list(map_groups.values())
+    if jobs <= 1:
+        for task in tasks:
+            render_task(task)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_render_worker,
+                             initargs=(profiler.is_profiling(), profiler.is_tracing_memory())) as executor:
+        # consume the results such that errors in the workers are raised
+        for _, events in executor.map(run_render_task, tasks):
+            profiler.add_events(events)
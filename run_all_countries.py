@@ -0,0 +1,116 @@
+import argparse
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import utils
+import generate_charts_report
+from generate_charts_report import ASSESSMENT_DATE, CONFIG_FILE, DIR_PATH, WHO_COVID_FILENAME, WHO_COVID_URL
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('countries', nargs='*',
+                        help='Country ISO3s to run, defaults to all countries in the config')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of countries to process in parallel')
+    parser.add_argument('--render-jobs', type=int, default=1,
+                        help='Number of processes to render the figures of each country with, only with --jobs 1')
+    parser.add_argument('-d', '--download-covid', action='store_true',
+                        help='Download the COVID-19 data')
+    parser.add_argument('-a', '--assessment-date', default=ASSESSMENT_DATE,
+                        help='Date of the assessment (YYYY-MM-DD)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only use the local mirror of the remote files, without network access')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Regenerate all outputs, also if their inputs did not change')
+    parser.add_argument('--metrics-only', action='store_true',
+                        help='Only compute the metrics and csv\'s of every country, without rendering any figure')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a summary and a chrome trace of the time spent per stage of every country to profiles/')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='With --profile, also measure the peak memory per stage (slows down the run)')
+    args = parser.parse_args()
+    if args.jobs > 1 and args.render_jobs > 1:
+        parser.error('--render-jobs can only be used with --jobs 1, the countries are already rendered in parallel')
+    return args
+
+
+def run_country(country_iso3, parameters, assessment_date, render_jobs, offline, force, profile, profile_memory, metrics_only):
+    """
+    Run the report of one country and catch any error, such that one failing country doesn't stop the others
+    Returns:
+        country_iso3, the traceback if the run failed (else None) and the duration of the run in seconds
+    """
+    start = time.time()
+    try:
+        generate_charts_report.main(country_iso3, assessment_date=assessment_date, parameters=parameters,
+                                    render_jobs=render_jobs, offline=offline, force=force, profile=profile, profile_memory=profile_memory,
+                                    metrics_only=metrics_only)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return country_iso3, error, time.time() - start
+
+
+def main(countries, jobs=1, download_covid=False, assessment_date=ASSESSMENT_DATE, render_jobs=1, offline=False, force=False,
+         profile=False, profile_memory=False, metrics_only=False):
+    """
+    Run the report of all the given countries, in a pool of jobs processes
+    Args:
+        countries: list of country ISO3s. If empty, all countries in the config are run
+        jobs: number of countries to process in parallel
+        download_covid: if True, download the latest WHO data once before running the countries
+        assessment_date: date of the assessment as a string in the format YYYY-MM-DD
+        render_jobs: number of processes to render the figures of each country with. Only with jobs=1, as every country
+            worker would otherwise start its own pool of render processes
+        offline: if True, the remote files are only retrieved from the local mirror
+        force: if True, all outputs are regenerated, also if their inputs didn't change
+        profile: if True, a profile of the run of every country is written to profiles/
+        profile_memory: if True, the profiles include the peak memory per stage
+        metrics_only: if True, only the metrics and csv's of every country are produced, without rendering any figure
+    Returns:
+        failed: list of the country ISO3s of which the run failed
+    """
+    if jobs > 1 and render_jobs > 1:
+        raise ValueError('render_jobs can only be larger than 1 with jobs=1, the countries are already rendered in parallel')
+    # the inputs shared by all countries are prepared once, before the countries are distributed over the workers
+    utils.set_offline(offline)
+    config = utils.parse_yaml(CONFIG_FILE)
+    countries = [c.upper() for c in countries] or list(config.keys())
+    if download_covid:
+        utils.download_who_covid_data(WHO_COVID_URL, f'{DIR_PATH}/{WHO_COVID_FILENAME}')
+    else:
+        # makes sure the WHO partitions are up to date, such that the workers don't ingest the global file concurrently
+        utils.get_who_partition(WHO_COVID_FILENAME, config[countries[0]]['iso2_code'])
+    # fill the mirror with the remote files in the config, a country of which a file can't be retrieved fails in its own run
+    if not offline:
+        for country_iso3 in countries:
+            for url in [config[country_iso3]['subnational_cases_url'], config[country_iso3]['npis_url']]:
+                try:
+                    utils.fetch_url(url)
+                except Exception as e:
+                    print(f'{country_iso3}: cannot retrieve "{url}": {e}')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_country, country_iso3, config[country_iso3], assessment_date, render_jobs, offline, force,
+                                   profile, profile_memory, metrics_only)
+                   for country_iso3 in countries]
+        for future in as_completed(futures):
+            country_iso3, error, duration = future.result()
+            if error is None:
+                print(f'{country_iso3}: done in {duration:.0f}s')
+            else:
+                print(f'{country_iso3}: failed after {duration:.0f}s\n{error}')
+                failed.append(country_iso3)
+    return failed
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    failed = main(args.countries, jobs=args.jobs, download_covid=args.download_covid,
+                  assessment_date=args.assessment_date, render_jobs=args.render_jobs, offline=args.offline, force=args.force,
+                  profile=args.profile, profile_memory=args.profile_memory, metrics_only=args.metrics_only)
+    sys.exit(1 if failed else 0)
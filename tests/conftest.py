@@ -0,0 +1,10 @@
+# the tests import the modules of the repository and the synthetic dataset of the benchmarks
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, f'{REPO_DIR}/benchmarks')
+sys.path.insert(0, f'{REPO_DIR}/historical_validation')
+os.environ.setdefault('MPLBACKEND', 'Agg')
@@ -0,0 +1,75 @@
+# the scores of the forecasts, which are computed on all forecasts at once, are compared with the definitions of the
+# scores computed one forecast at a time. The weighted interval score is computed from its prediction intervals as
+# defined by Bracher et al. (2021), https://doi.org/10.1371/journal.pcbi.1008618
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+
+import forecast_scores
+import synthetic_data
+
+MIN_QUANTILE = 0.05
+MAX_QUANTILE = 0.95
+
+
+def reference_interval_score(lower, upper, alpha, observed):
+    return (upper - lower) + 2 / alpha * (lower - observed) * (observed < lower) + 2 / alpha * (observed - upper) * (observed > upper)
+
+
+def reference_weighted_interval_score(forecast, observed):
+    # forecast is a Series with a value per quantile, of which the lower quantiles are the lower bounds of the intervals
+    lower_quantiles = [q for q in forecast.index if q < 0.5]
+    score = 0.5 * abs(observed - forecast[0.5])
+    for q in lower_quantiles:
+        alpha = 2 * q
+        upper_quantile = min(forecast.index, key=lambda u: abs(u - (1 - q)))
+        score += alpha / 2 * reference_interval_score(forecast[q], forecast[upper_quantile], alpha, observed)
+    return score / (len(lower_quantiles) + 0.5)
+
+
+def reference_score_forecasts(forecasts, observed, min_quantile, max_quantile):
+    rows = []
+    for (_, forecast), observation in zip(forecasts.iterrows(), observed):
+        rows.append({'median': forecast[0.5],
+                     'lower': forecast[min_quantile],
+                     'upper': forecast[max_quantile],
+                     'covered': forecast[min_quantile] <= observation <= forecast[max_quantile],
+                     'absolute_error': abs(forecast[0.5] - observation),
+                     'wis': reference_weighted_interval_score(forecast, observation)})
+    return pd.DataFrame(rows, index=forecasts.index)
+
+
+@pytest.fixture
+def forecasts_observed():
+    # the forecasts of the cumulative reported cases by date and quantile, with observations around the median
+    rng = np.random.default_rng(0)
+    dates = [date(2021, 1, 1) + timedelta(days=i) for i in range(42)]
+    df = synthetic_data.generate_bucky(['XAA'], [1e6], [0.02], dates, synthetic_data.get_quantiles(23), rng)
+    forecasts = df.pivot(index='date', columns='quantile', values='cumulative_reported_cases')
+    forecasts.columns = np.round(forecasts.columns.to_numpy(dtype=float), 6)
+    forecasts = forecasts[forecast_scores.get_symmetric_quantiles(forecasts.columns)]
+    observed = forecasts[0.5].to_numpy() * rng.lognormal(0, 0.3, len(forecasts))
+    return forecasts, observed
+
+
+def test_get_symmetric_quantiles():
+    quantiles = forecast_scores.get_symmetric_quantiles([0.025, 0.05, 0.1, 0.5, 0.9, 0.95, 0.99])
+    np.testing.assert_array_equal(quantiles, [0.05, 0.1, 0.5, 0.9, 0.95])
+
+
+def test_score_forecasts_equals_reference(forecasts_observed):
+    forecasts, observed = forecasts_observed
+    scores = forecast_scores.score_forecasts(forecasts, observed, MIN_QUANTILE, MAX_QUANTILE)
+    expected = reference_score_forecasts(forecasts, observed, MIN_QUANTILE, MAX_QUANTILE)
+    # the observations are both inside and outside of the interval, such that both terms of the interval score are tested
+    assert scores['covered'].any() and not scores['covered'].all()
+    pd.testing.assert_frame_equal(scores, expected, check_dtype=False, rtol=1e-10)
+
+
+def test_weighted_interval_score_of_median_only():
+    # without prediction intervals, the weighted interval score is the absolute error of the median
+    forecasts = np.array([[10.], [20.]])
+    observed = np.array([12., 15.])
+    scores = forecast_scores.get_weighted_interval_score(forecasts, np.array([0.5]), observed)
+    np.testing.assert_allclose(scores, [2., 5.])
@@ -0,0 +1,69 @@
+# the batched estimation of the doubling time and Reff is compared with the estimation it replaced, which fitted func
+# with curve_fit to one series at a time
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import curve_fit
+
+import utils
+import synthetic_data
+
+RTOL = 1e-6
+
+
+def reference_get_bucky_dt_reff(df_bucky):
+    # start fit
+    dates_proj = df_bucky.index
+    xfit = [(x - dates_proj[0]).days for x in dates_proj]
+    yfit = df_bucky['cumulative_reported_cases']
+    initial_caseload = yfit.iloc[0]
+    initial_parameters = [initial_caseload, 0.03]
+    popt, _ = curve_fit(utils.func, xfit, yfit, p0=initial_parameters)
+    doubling_time_fit = np.log(2) / popt[1]
+    # parameters suggested by Matt
+    Tg = 7.
+    Ts = 5.
+    n = 3
+    f = .4
+    m = 2
+    r = np.log(2) / doubling_time_fit
+    Te = utils.calc_Te(Tg, Ts, n, f)
+    reff = utils.calc_Reff(m, n, Tg, Te, r)
+    return doubling_time_fit, reff
+
+
+@pytest.fixture
+def bucky_adm1():
+    # the bucky projections over four weeks of shrinking and growing admin1 regions, with noise such that the fit isn't exact
+    rng = np.random.default_rng(0)
+    dates = [date(2021, 1, 1) + timedelta(days=i) for i in range(28)]
+    growth_rates = [-0.02, -0.005, 0.01, 0.03, 0.05]
+    df = synthetic_data.generate_bucky([f'AA{i:02d}' for i in range(1, len(growth_rates) + 1)], rng.lognormal(13, 0.8, len(growth_rates)),
+                                       growth_rates, dates, synthetic_data.REQUIRED_QUANTILES, rng)
+    df['cumulative_reported_cases'] *= rng.lognormal(0, 0.01, len(df))
+    df['date'] = pd.to_datetime(df['date']).dt.date
+    return df.rename(columns={'adm': 'adm1'}).set_index('date')
+
+
+def test_get_bucky_dt_reff_equals_reference(bucky_adm1):
+    for _, df_bucky in bucky_adm1[bucky_adm1['quantile'] == 0.5].groupby('adm1'):
+        np.testing.assert_allclose(utils.get_bucky_dt_reff(df_bucky), reference_get_bucky_dt_reff(df_bucky), rtol=RTOL)
+
+
+def test_get_bucky_dt_reff_distribution_equals_reference(bucky_adm1):
+    distribution = utils.get_bucky_dt_reff_distribution(utils.QuantileCube.from_frame(bucky_adm1))
+    assert len(distribution) == bucky_adm1.groupby(['adm1', 'quantile']).ngroups
+    for (adm, quantile), df_bucky in bucky_adm1.groupby(['adm1', 'quantile']):
+        estimate = distribution[(distribution['adm'] == adm) & (distribution['quantile'] == quantile)]
+        np.testing.assert_allclose(estimate[['doubling_time', 'Reff']].to_numpy()[0], reference_get_bucky_dt_reff(df_bucky), rtol=RTOL)
+
+
+def test_fit_growth_rates_missing_values():
+    # a series with a missing value isn't fitted, the other series are
+    x = np.arange(10)
+    y = np.array([100 * np.exp(0.05 * x), 100 * np.exp(0.05 * x)])
+    y[1, 3] = np.nan
+    r = utils.fit_growth_rates(x, y)
+    assert r[0] == pytest.approx(0.05, rel=RTOL)
+    assert np.isnan(r[1])
@@ -0,0 +1,113 @@
+# the vectorized quality checks are compared with the checks they replaced, which looped over every column and value and only
+# logged the issues. The reference checks below are those checks, without their debug print
+import logging
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+import synthetic_data
+
+logger = logging.getLogger('utils')
+
+
+def reference_quality_check_nan(df, data_name):
+    df.loc[df.index == df.index.min(), [c for c in df.columns if "daily" in c]] = 0
+    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
+    for c in df_numeric_columns:
+        if df[c].isnull().values.any():
+            nan_dates = df[df[c].isnull()].index.unique().sort_values()
+            nan_dates_str = ",".join([n.strftime("%d-%m-%Y") for n in nan_dates])
+            logger.warning(f'{data_name}: Nan value in column {c} on {nan_dates_str}')
+
+
+def reference_quality_check_negative(df, data_name):
+    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
+    for c in df_numeric_columns:
+        if not all(i >= 0 for i in df[c].fillna(0)):
+            neg_dates = df[df[c] < 0].index.unique().sort_values()
+            neg_dates_str = ",".join([n.strftime("%d-%m-%Y") for n in neg_dates])
+            logger.warning(f'{data_name}: Negative value in column {c} on {neg_dates_str}')
+
+
+def reference_quality_check_nondecreasing(df, data_name):
+    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
+    for c in df_numeric_columns:
+        if not all(x <= y for x, y in zip(df[c], df[c][1:])):
+            df_copy = df.copy()
+            df_copy["prev_val"] = df_copy[c].shift(1)
+            neg_dates = df_copy[df_copy[c] < df_copy["prev_val"]].index.unique().sort_values()
+            neg_dates_str = ",".join([n.strftime("%d-%m-%Y") for n in neg_dates])
+            logger.warning(f'{data_name}: Decreasing value in column {c} on {neg_dates_str}')
+
+
+@pytest.fixture
+def who_covid():
+    # the WHO data of a country as returned by get_who, with a negative, a missing and a decreasing value
+    rng = np.random.default_rng(0)
+    dates = [date(2021, 1, 1) + timedelta(days=i) for i in range(60)]
+    df = synthetic_data.generate_who([('XAA', 'AA')], dates, rng).rename(columns=lambda c: c.strip())
+    df['Date_reported'] = pd.to_datetime(df['Date_reported']).dt.date
+    df = df.set_index('Date_reported').astype({'New_cases': float, 'Cumulative_deaths': float})
+    df.iloc[10, df.columns.get_loc('New_cases')] = -5
+    df.iloc[20, df.columns.get_loc('New_cases')] = np.nan
+    df.iloc[30, df.columns.get_loc('Cumulative_cases')] = df.iloc[29, df.columns.get_loc('Cumulative_cases')] - 1
+    df.iloc[40, df.columns.get_loc('Cumulative_deaths')] = -1
+    return df
+
+
+@pytest.fixture
+def bucky_adm0():
+    # the bucky output of a country, of which the daily metrics are missing on the first date like after the initialization
+    rng = np.random.default_rng(1)
+    dates = [date(2021, 1, 1) + timedelta(days=i) for i in range(30)]
+    df = synthetic_data.generate_bucky(['XAA'], [1e6], [0.02], dates, synthetic_data.REQUIRED_QUANTILES, rng)
+    df['date'] = pd.to_datetime(df['date']).dt.date
+    df = df.set_index('date')
+    df.loc[df.index == df.index.min(), [c for c in df.columns if 'daily' in c]] = np.nan
+    df.iloc[50, df.columns.get_loc('R_eff')] = np.nan
+    df.iloc[60, df.columns.get_loc('current_hospitalizations')] = -1
+    return df
+
+
+def get_warnings(caplog, check, df, *args):
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='utils'):
+        check(df, *args)
+    return [record.getMessage() for record in caplog.records]
+
+
+@pytest.mark.parametrize('check, reference', [(utils.quality_check_nan, reference_quality_check_nan),
+                                              (utils.quality_check_negative, reference_quality_check_negative)])
+def test_quality_checks_equal_reference(caplog, who_covid, bucky_adm0, check, reference):
+    for df, data_name in [(who_covid, 'WHO'), (bucky_adm0, 'Bucky NPI Adm0')]:
+        warnings = get_warnings(caplog, check, df, data_name)
+        assert warnings
+        # the reference checks modify their input
+        assert warnings == get_warnings(caplog, reference, df.copy(), data_name)
+
+
+def test_quality_check_nondecreasing_equals_reference(caplog, who_covid):
+    df = who_covid[['Cumulative_cases', 'Cumulative_deaths']]
+    warnings = get_warnings(caplog, utils.quality_check_nondecreasing, df, 'WHO')
+    assert len(warnings) == 2
+    assert warnings == get_warnings(caplog, reference_quality_check_nondecreasing, df, 'WHO')
+
+
+def test_quality_check_nondecreasing_ignores_nan(caplog, who_covid):
+    # the reference check reported a decrease without any date for a column with a missing value,
+    # the missing values are left to the nan check
+    df = who_covid[['Cumulative_cases']].astype(float)
+    df.iloc[50, 0] = np.nan
+    reference_warnings = get_warnings(caplog, reference_quality_check_nondecreasing, df, 'WHO')
+    assert get_warnings(caplog, utils.quality_check_nondecreasing, df, 'WHO') == reference_warnings
+    df.iloc[30, 0] = df.iloc[29, 0]
+    assert get_warnings(caplog, reference_quality_check_nondecreasing, df, 'WHO') == ['WHO: Decreasing value in column Cumulative_cases on ']
+    assert get_warnings(caplog, utils.quality_check_nondecreasing, df, 'WHO') == []
+
+
+def test_quality_checks_return_issues(who_covid):
+    issues = utils.quality_check_negative(who_covid, 'WHO')
+    assert issues == [{'source': 'WHO', 'check': 'negative', 'column': 'New_cases', 'dates': ['2021-01-11']},
+                      {'source': 'WHO', 'check': 'negative', 'column': 'Cumulative_deaths', 'dates': ['2021-02-10']}]
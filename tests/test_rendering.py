@@ -0,0 +1,56 @@
+# the maps rendered on a shared figure are compared pixel by pixel with the maps of the renderer they replaced,
+# which plotted a GeoDataFrame with the values as column on a new figure per map
+import numpy as np
+import geopandas as gpd
+import matplotlib.pyplot as plt
+from matplotlib.colors import BoundaryNorm, LinearSegmentedColormap
+import pytest
+
+import rendering
+import synthetic_data
+from chart_specs import MapSpec
+from generate_charts_report import INCIDENCE_COLORS, INCIDENCE_BINS
+
+BOUNDARY_KWARGS = {'linewidth': 0.1, 'color': 'lightgrey'}
+
+
+@pytest.fixture
+def regions():
+    return synthetic_data.generate_shapefile('XA', 12, 50).geometry
+
+
+def get_map_spec(regions, values, output_file):
+    # a map as described by create_subnational_map_incidence_100k
+    spec = MapSpec('Map', output_file, 'shape', regions, values, INCIDENCE_COLORS, INCIDENCE_BINS, BOUNDARY_KWARGS)
+    spec.axis('axis', 'off')
+    spec.figure('tight_layout')
+    spec.figure('set_size_inches', 7, 6)
+    return spec
+
+
+def render_map_baseline(regions, values, output_file):
+    fig, axis = rendering.create_new_subplot('Map')
+    shapefile = gpd.GeoDataFrame({'value': values}, geometry=regions)
+    cmap = LinearSegmentedColormap.from_list('', INCIDENCE_COLORS)
+    norm = BoundaryNorm(boundaries=INCIDENCE_BINS, ncolors=256)
+    shapefile.plot(column='value', cmap=cmap, norm=norm, ax=axis)
+    shapefile.boundary.plot(ax=axis, **BOUNDARY_KWARGS)
+    axis.axis('off')
+    fig.tight_layout()
+    fig.set_size_inches(7, 6)
+    fig.savefig(output_file)
+    plt.close(fig)
+
+
+def test_render_maps_equals_baseline(regions, tmp_path):
+    rendering.set_matlotlib(plt)
+    rng = np.random.default_rng(0)
+    values = [rng.uniform(0, 40, len(regions)) for _ in range(2)]
+    # regions without a value, also in the corners of the map, are omitted
+    values[0][[0, 5]] = np.nan
+    values[1][[3, 11]] = np.nan
+    specs = [get_map_spec(regions, map_values, str(tmp_path / f'map_{i}.png')) for i, map_values in enumerate(values)]
+    rendering.render_maps(specs)
+    for i, map_values in enumerate(values):
+        render_map_baseline(regions, map_values, str(tmp_path / f'baseline_{i}.png'))
+        np.testing.assert_array_equal(plt.imread(str(tmp_path / f'map_{i}.png')), plt.imread(str(tmp_path / f'baseline_{i}.png')))
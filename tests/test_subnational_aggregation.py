@@ -0,0 +1,51 @@
+# the aggregation of the subnational data is compared with the aggregation it replaced, which forward filled every
+# combination of date and adm2 pcode before summing per date
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+import synthetic_data
+
+
+def reference_aggregate_subnational_covid_data(subnational_covid):
+    # date and adm2 are the unique keys
+    dates = sorted(set(subnational_covid[utils.HLX_TAG_DATE]))
+    adm2pcodes = set(subnational_covid[utils.HLX_TAG_ADM2_PCODE])
+    unique_keys = [utils.HLX_TAG_DATE, utils.HLX_TAG_ADM2_PCODE]
+    # create a multi-index to fill missing combinations with None values
+    mind = pd.MultiIndex.from_product([dates, adm2pcodes], names=unique_keys)
+    subnational_covid = subnational_covid.set_index(unique_keys).reindex(mind, fill_value=None)
+    # forward fill missing values for each pcode
+    subnational_covid = subnational_covid.groupby(utils.HLX_TAG_ADM2_PCODE).ffill()
+    # sum by date, only the numeric columns are compared
+    return subnational_covid.select_dtypes(include=[np.number]).groupby(utils.HLX_TAG_DATE).sum()
+
+
+def get_subnational_covid(seed, num_admin_units=5, num_dates=40):
+    # the subnational data as read by load_subnational_covid_data
+    rng = np.random.default_rng(seed)
+    dates = [date(2021, 1, 1) + timedelta(days=i) for i in range(num_dates)]
+    df = synthetic_data.generate_subnational('AA', num_admin_units, dates, rng)
+    df[utils.HLX_TAG_DATE] = pd.to_datetime(df[utils.HLX_TAG_DATE]).dt.date
+    return df.astype({utils.HLX_TAG_TOTAL_CASES: float, utils.HLX_TAG_TOTAL_DEATHS: float})
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_aggregation_equals_reference(seed):
+    subnational_covid = get_subnational_covid(seed)
+    result = utils.aggregate_subnational_covid_data(subnational_covid)
+    expected = reference_aggregate_subnational_covid_data(subnational_covid)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False)
+
+
+def test_aggregation_with_missing_values_equals_reference():
+    # a missing value is filled with the previous report of the pcode, also before its first report
+    subnational_covid = get_subnational_covid(3)
+    rng = np.random.default_rng(4)
+    missing = rng.choice(len(subnational_covid), size=len(subnational_covid) // 10, replace=False)
+    subnational_covid.iloc[missing, subnational_covid.columns.get_loc(utils.HLX_TAG_TOTAL_CASES)] = np.nan
+    result = utils.aggregate_subnational_covid_data(subnational_covid)
+    expected = reference_aggregate_subnational_covid_data(subnational_covid)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False)
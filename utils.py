@@ -1,32 +1,57 @@
 # global level functions
-import yaml
-import requests
+import os
+import io
+import json
+import time
+import hashlib
 import pandas as pd
-import matplotlib.pyplot as plt
 import argparse
-import matplotlib.dates as mdates
-from scipy.optimize import curve_fit
 import numpy as np
-import matplotlib.colors as mc
 import colorsys
 import logging
-import coloredlogs
 from datetime import timedelta
 
-logger = logging.getLogger(__name__)
+import profiler
 
+logger = logging.getLogger(__name__)
 
-FIG_SIZE=(8,6)
+# the heavy dependencies (requests, yaml, coloredlogs, scipy, pyarrow, geopandas and matplotlib) are imported in the functions that use them,
+# such that importing utils is fast for the runs that don't need them
 
 HLX_TAG_TOTAL_CASES = "#affected+infected+confirmed+total"
 HLX_TAG_TOTAL_DEATHS = "#affected+infected+dead+total"
 HLX_TAG_DATE = "#date"
 HLX_TAG_ADM2_PCODE='#adm2+pcode'
 
+CACHE_DIR='.cache'
+BUCKY_CACHE_DIR=f'{CACHE_DIR}/bucky'
+WHO_CACHE_DIR=f'{CACHE_DIR}/who'
+SHAPEFILE_CACHE_DIR=f'{CACHE_DIR}/shapes'
+DOWNLOAD_CACHE_DIR=f'{CACHE_DIR}/downloads'
+MIRROR_DIR=f'{CACHE_DIR}/mirror'
+#the parquet files are sorted by date and written in row groups of at most this size, so that the date statistics of the groups
+#let date filters skip the groups outside the requested window, without the overhead of many small groups
+BUCKY_CACHE_ROW_GROUP_SIZE=100000
+#the adm1 metrics of which the ranking, the Reff, the incidence and the metrics store are computed keep float64 in the parquet copy,
+#such that these outputs are exactly the same as when they are computed from the csv
+BUCKY_ADM1_FLOAT64_METRICS=['R_eff','cumulative_reported_cases','daily_reported_cases','daily_cases','total_population','current_hospitalizations']
+#the version of the format of the parquet copy, a copy of another version is converted again
+BUCKY_CACHE_VERSION=2
+#the Bucky csv's are converted in batches of dates of about this number of rows
+BUCKY_CSV_CHUNK_SIZE=100000
+#downloads are streamed in chunks of 1MB and retried with an exponential backoff on connection errors and server errors
+DOWNLOAD_CHUNK_SIZE=1024*1024
+DOWNLOAD_RETRIES=3
+DOWNLOAD_BACKOFF_FACTOR=1
+DOWNLOAD_TIMEOUT=60
+#a mirrored file is used without contacting the server if it was retrieved less than this number of seconds ago
+MIRROR_MAX_AGE=6*60*60
+
 def config_logger(level='INFO'):
     #set styling of logger
     # Colours selected from here:
     # http://humanfriendly.readthedocs.io/en/latest/_images/ansi-demo.png
+    import coloredlogs
     coloredlogs.install(
         level=level,
         fmt="%(asctime)s %(name)s %(levelname)s %(message)s",
@@ -38,224 +63,999 @@ def config_logger(level='INFO'):
         },
     )
 
-def set_matlotlib(plt):
-
-    plt.rcParams['axes.grid'] = True    
-    plt.rcParams['grid.color'] = 'lightgrey'
-    plt.rcParams['grid.linestyle'] = 'solid'
-    plt.rcParams['grid.linewidth'] = 0.5
-    plt.rcParams.update({'font.size': 15})
-
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("country_iso3", help="Country ISO3")
     parser.add_argument('-d', '--download-covid', action='store_true',
                         help='Download the COVID-19 data')
+    parser.add_argument('-a', '--assessment-date',
+                        help='Date of the assessment (YYYY-MM-DD), defaults to ASSESSMENT_DATE')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to render the figures with')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only use the local mirror of the remote files, without network access')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Regenerate all outputs, also if their inputs did not change')
+    parser.add_argument('--metrics-only', action='store_true',
+                        help='Only compute the metrics and csv\'s, without rendering any figure')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a summary and a chrome trace of the time spent per stage to profiles/')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='With --profile, also measure the peak memory per stage (slows down the run)')
     return parser.parse_args()
 
 def parse_yaml(filename):
+    import yaml
     with open(filename, "r") as stream:
         config = yaml.safe_load(stream)
     return config
 
-def download_url(url, save_path, chunk_size=128):
-    r = requests.get(url, stream=True)
-    with open(save_path, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=chunk_size):
+_http_session=None
+_offline=False
+
+def set_offline(offline):
+    #in offline mode remote files are only retrieved from the local mirror and nothing is downloaded
+    global _offline
+    _offline=offline
+
+def get_http_session():
+    #one session is shared by all downloads of the process, such that the connections to a host are reused
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry=Retry(total=DOWNLOAD_RETRIES,backoff_factor=DOWNLOAD_BACKOFF_FACTOR,status_forcelist=[429,500,502,503,504])
+        _http_session=requests.Session()
+        _http_session.mount('http://',HTTPAdapter(max_retries=retry))
+        _http_session.mount('https://',HTTPAdapter(max_retries=retry))
+    return _http_session
+
+def get_download_info_filename(save_path):
+    #the validators of a download are saved in the cache instead of next to the downloaded file
+    return f'{DOWNLOAD_CACHE_DIR}/{hashlib.sha1(os.path.abspath(save_path).encode()).hexdigest()}.json'
+
+def write_response(response, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    #stream the body of the response to path and return the sha256 of the content
+    content_hash=hashlib.sha256()
+    with open(path, 'wb') as fd:
+        for chunk in response.iter_content(chunk_size=chunk_size):
             fd.write(chunk)
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def write_json(filename, content):
+    #write to a temporary file first, such that readers never see a partially written file
+    os.makedirs(os.path.dirname(filename),exist_ok=True)
+    with open(f'{filename}.{os.getpid()}.tmp','w') as f:
+        json.dump(content,f)
+    os.replace(f'{filename}.{os.getpid()}.tmp',filename)
+
+def get_conditional_headers(validators):
+    #headers that let the server answer with 304 Not Modified if the file didn't change since it was retrieved with these validators
+    headers={}
+    if validators.get('etag'):
+        headers['If-None-Match']=validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since']=validators['last_modified']
+    return headers
+
+@profiler.profiled(category='io')
+def download_url(url, save_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Download url to save_path, unless the file didn't change since the previous download.
+    The ETag and Last-Modified of the previous download are sent with the request, such that the server can answer that the file is unchanged.
+    The file is downloaded to a temporary file that replaces save_path when complete, so a failed download never leaves a truncated file
+    Args:
+        url: url to download
+        save_path: path to save the file to
+        chunk_size: number of bytes that are read from the response at once
+    Returns:
+        True if the file was downloaded, False if it was unchanged
+    """
+    info_filename=get_download_info_filename(save_path)
+    download_info={}
+    if os.path.exists(save_path) and os.path.exists(info_filename):
+        with open(info_filename,'r') as f:
+            download_info=json.load(f)
+    headers=get_conditional_headers(download_info) if download_info.get('url')==url else {}
+    with get_http_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code==304:
+            print(f'"{url}" is unchanged since the previous download to "{save_path}"')
+            return False
+        r.raise_for_status()
+        save_dir=os.path.dirname(save_path)
+        if save_dir:
+            os.makedirs(save_dir,exist_ok=True)
+        tmp_path=f'{save_path}.{os.getpid()}.tmp'
+        try:
+            write_response(r,tmp_path,chunk_size)
+            os.replace(tmp_path,save_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        download_info={'url':url,'etag':r.headers.get('ETag'),'last_modified':r.headers.get('Last-Modified')}
+    write_json(info_filename,download_info)
     print(f'Downloaded "{url}" to "{save_path}"')
+    return True
+
+def get_mirror_ref_filename(url):
+    return f'{MIRROR_DIR}/refs/{hashlib.sha1(url.encode()).hexdigest()}.json'
+
+def get_mirror_object_filename(content_hash):
+    return f'{MIRROR_DIR}/objects/{content_hash}'
+
+@profiler.profiled(category='io')
+def fetch_url(url, max_age=MIRROR_MAX_AGE):
+    """
+    Retrieve a remote file through the local mirror.
+    The mirror stores the content of every retrieved file once, under its sha256, and keeps a reference per url to the content last retrieved from it.
+    A file that was retrieved less than max_age seconds ago is used without contacting the server,
+    an older one is checked with a conditional request such that it is only downloaded again if it changed.
+    In offline mode (see set_offline) the mirrored file is always used
+    Args:
+        url: url of the file. A local path is returned as is
+        max_age: number of seconds a mirrored file is used without checking for changes
+    Returns:
+        path to the mirrored file
+    """
+    if not url.startswith(('http://','https://')):
+        return url
+    ref_filename=get_mirror_ref_filename(url)
+    ref={}
+    if os.path.exists(ref_filename):
+        with open(ref_filename,'r') as f:
+            ref=json.load(f)
+    if ref and not os.path.exists(get_mirror_object_filename(ref['sha256'])):
+        ref={}
+    if ref and (_offline or time.time()-ref['fetched_at']<max_age):
+        return get_mirror_object_filename(ref['sha256'])
+    if _offline:
+        raise FileNotFoundError(f'"{url}" is not in the mirror, so it cannot be retrieved in offline mode')
+    with get_http_session().get(url, headers=get_conditional_headers(ref), stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code==304:
+            ref['fetched_at']=time.time()
+        else:
+            r.raise_for_status()
+            os.makedirs(f'{MIRROR_DIR}/objects',exist_ok=True)
+            tmp_path=f'{MIRROR_DIR}/objects/{os.getpid()}.tmp'
+            try:
+                content_hash=write_response(r,tmp_path)
+                os.replace(tmp_path,get_mirror_object_filename(content_hash))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            ref={'url':url,'sha256':content_hash,'fetched_at':time.time(),
+                 'etag':r.headers.get('ETag'),'last_modified':r.headers.get('Last-Modified')}
+            print(f'Downloaded "{url}" to the mirror')
+    write_json(ref_filename,ref)
+    return get_mirror_object_filename(ref['sha256'])
 
 def download_who_covid_data(url, save_path):
     # download covid data from HDX
+    if _offline:
+        print(f'Offline, using the existing COVID data from WHO')
+        return
     print(f'Getting updated COVID data from WHO')
+    import requests
     try:
-        download_url(url, save_path)
+        downloaded=download_url(url, save_path)
+    except requests.RequestException as e:
+        #continue with the previous download if there is one
+        if not os.path.exists(save_path):
+            raise
+        logger.warning(f'Cannot download COVID file from WHO, using the existing file: {e}')
+        return
+    # split the global file per country once, such that each country only reads its own rows
+    if downloaded:
+        ingest_who_covid_data(save_path)
 
-    except Exception:
-        print(f'Cannot download COVID file from from HDX')
+def get_numeric_values(df):
+    #the numeric columns of df and their values as one array of shape (rows, columns), without copying the frame
+    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
+    return df_numeric_columns, df[df_numeric_columns].to_numpy(dtype=float)
+
+def report_quality_issues(df, data_name, check, columns, mask, description):
+    """
+    Log and collect the values that failed a quality check
+    Args:
+        df: DataFrame indexed by date that was checked
+        data_name: name of the data source, used in the messages
+        check: name of the check
+        columns: the names of the columns of mask
+        mask: boolean array of shape (rows of df, columns) that flags the values that failed the check
+        description: description of a failing value, used in the messages
+    Returns:
+        issues: list with a dict per column that failed the check, with the source, check, column and the dates that failed
+    """
+    issues=[]
+    for i in np.flatnonzero(mask.any(axis=0)):
+        issue_dates = pd.Index(df.index[mask[:,i]]).unique().sort_values()
+        issue_dates_str = ",".join([n.strftime("%d-%m-%Y") for n in issue_dates])
+        logger.warning(f'{data_name}: {description} in column {columns[i]} on {issue_dates_str}')
+        issues.append({'source':data_name,'check':check,'column':columns[i],'dates':[n.strftime("%Y-%m-%d") for n in issue_dates]})
+    return issues
 
 def quality_check_nan(df, data_name):
-    #if df is bucky output, then on the start date of the simulation, the "daily columns" are supposed to be nan so mask them to 0 for the test
+    df_numeric_columns, values = get_numeric_values(df)
+    mask = np.isnan(values)
+    #if df is bucky output, then on the start date of the simulation, the "daily columns" are supposed to be nan so don't flag them
     #TODO: df.index.min() might not equal the start date of the simulation but couldn't come up with neater method
-    df.loc[df.index==df.index.min(),[c for c in df.columns if "daily" in c]]=0
-    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
-    for c in df_numeric_columns:
-        try:
-            assert not df[c].isnull().values.any()
-        except AssertionError:
-            print("bla",df[df[c].isnull()])
-            nan_dates = df[df[c].isnull()].index.unique()
-            nan_dates = nan_dates.sort_values()
-            nan_dates_str = ",".join([n.strftime("%d-%m-%Y") for n in nan_dates])
-            logger.warning(f'{data_name}: Nan value in column {c} on {nan_dates_str}')
+    if len(df)>0:
+        first_date = np.asarray(df.index==df.index.min())
+        daily_columns = np.array(["daily" in c for c in df_numeric_columns],dtype=bool)
+        mask[np.ix_(first_date,daily_columns)] = False
+    return report_quality_issues(df, data_name, 'nan', df_numeric_columns, mask, 'Nan value')
 
 def quality_check_negative(df, data_name):
-    negative_values=False
-    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
-    for c in df_numeric_columns:
-        try:
-            #all() will return false if any nan values.
-            #There are likely nan values in bucky on the first date of the simulation due to how we handle initialization errors in get_bucky.
-            #so fillna with zeroes to not display those as negative values
-            assert all(i >= 0 for i in df[c].fillna(0))
-        except AssertionError:
-            neg_dates = df[df[c] < 0].index.unique()
-            neg_dates=neg_dates.sort_values()
-            neg_dates_str=",".join([n.strftime("%d-%m-%Y") for n in neg_dates])
-            logger.warning(f'{data_name}: Negative value in column {c} on {neg_dates_str}')
-            negative_values= True
-    return negative_values
+    #There are likely nan values in bucky on the first date of the simulation due to how we handle initialization errors in get_bucky.
+    #nan compares as False, so those are not reported as negative values
+    df_numeric_columns, values = get_numeric_values(df)
+    with np.errstate(invalid='ignore'):
+        mask = values < 0
+    return report_quality_issues(df, data_name, 'negative', df_numeric_columns, mask, 'Negative value')
 
 
 def quality_check_missing_dates(df,data_name,today,window=14):
-    df_window=df.loc[today-timedelta(days=window):today,:]
-    dates_window=list(df_window.index.values)
-    dates_total=list(df.index.values)
-    try:
-        assert not len(dates_total)<window
-    except AssertionError:
+    issues=[]
+    if len(df.index)<window:
         logger.warning(f'{data_name} less than {window} data points')
-    try:
-        assert not len(dates_window)==0
-    except AssertionError:
+        issues.append({'source':data_name,'check':'data_points','column':None,'dates':[]})
+    if not ((df.index>=today-timedelta(days=window)) & (df.index<=today)).any():
         logger.warning(f'{data_name} no values in last {window} days')
+        issues.append({'source':data_name,'check':'missing_dates','column':None,'dates':[]})
+    return issues
 
 def quality_check_nondecreasing(df,data_name):
-    decreasing_values=False
-    df_numeric_columns = list(df.select_dtypes(include=[np.number]).columns.values)
-    for c in df_numeric_columns:
-        try:
-            assert all(x <= y for x, y in zip(df[c], df[c][1:]))
-        except AssertionError:
-            df_copy=df.copy()
-            df_copy["prev_val"]=df_copy[c].shift(1)
-            neg_dates = df_copy[df_copy[c] < df_copy["prev_val"]].index.unique()
-            neg_dates=neg_dates.sort_values()
-            neg_dates_str = ",".join([n.strftime("%d-%m-%Y") for n in neg_dates])
-            logger.warning(f'{data_name}: Decreasing value in column {c} on {neg_dates_str}')
-            decreasing_values = True
-    return decreasing_values
-
-def quality_check_allsources(country_iso3,parameters,who_filename,min_date,max_date,today):
+    #compare every value with the previous value in the same column
+    df_numeric_columns, values = get_numeric_values(df)
+    mask = np.zeros(values.shape,dtype=bool)
+    with np.errstate(invalid='ignore'):
+        mask[1:] = values[1:] < values[:-1]
+    return report_quality_issues(df, data_name, 'decreasing', df_numeric_columns, mask, 'Decreasing value')
+
+@profiler.profiled(category='stage')
+def quality_check_allsources(session,country_iso3,parameters,min_date,max_date,today):
     # Explanation for negative numbers from WHO data documentation (found on https://data.humdata.org/dataset/coronavirus-covid-19-cases-and-deaths)
     # Due to the recent trend of countries conducting data reconciliation exercises which remove large numbers of cases or deaths from their total counts,
     # such data may reflect as negative numbers in the new cases / new deaths counts as appropriate.
     # This will aid users in identifying when such adjustments occur.
     # When additional details become available that allow the subtractions to be suitably apportioned to previous days, data will be updated accordingly.
-    who_covid=get_who(who_filename,parameters["iso2_code"],min_date,max_date)
-    quality_check_negative(who_covid, "WHO")
-    quality_check_nan(who_covid, "WHO")
-    quality_check_nondecreasing(who_covid[["Cumulative_cases","Cumulative_deaths"]], "WHO")
-    quality_check_missing_dates(who_covid,"WHO",today)
-    subnational_covid=get_subnational_covid_data(parameters,aggregate=True,min_date=min_date,max_date=max_date)
-    quality_check_negative(subnational_covid, "subnational")
-    quality_check_nan(subnational_covid, "subnational")
-    quality_check_nondecreasing(subnational_covid[[HLX_TAG_TOTAL_CASES,HLX_TAG_TOTAL_DEATHS]],"subnational")
-    quality_check_missing_dates(subnational_covid,"subnational",today)
+    # Returns the list of issues found by all checks, see report_quality_issues
+    issues=[]
+    who_covid=session.get_who(min_date,max_date)
+    issues+=quality_check_negative(who_covid, "WHO")
+    issues+=quality_check_nan(who_covid, "WHO")
+    issues+=quality_check_nondecreasing(who_covid[["Cumulative_cases","Cumulative_deaths"]], "WHO")
+    issues+=quality_check_missing_dates(who_covid,"WHO",today)
+    subnational_covid=session.get_subnational_covid_data(aggregate=True,min_date=min_date,max_date=max_date)
+    issues+=quality_check_negative(subnational_covid, "subnational")
+    issues+=quality_check_nan(subnational_covid, "subnational")
+    issues+=quality_check_nondecreasing(subnational_covid[[HLX_TAG_TOTAL_CASES,HLX_TAG_TOTAL_DEATHS]],"subnational")
+    issues+=quality_check_missing_dates(subnational_covid,"subnational",today)
     # Bucky negative values mainly occur for first date due to initalization of model
-    bucky_npi_adm0=get_bucky(country_iso3,admin_level='adm0', min_date=min_date, max_date=max_date, npi_filter='npi')#.reset_index(inplace=True)
-    quality_check_nan(bucky_npi_adm0, "Bucky NPI Adm0")
-    quality_check_negative(bucky_npi_adm0,"Bucky NPI Adm0")
-    quality_check_nondecreasing(bucky_npi_adm0.loc[bucky_npi_adm0["quantile"]==0.5,["cumulative_cases","cumulative_reported_cases","cumulative_deaths"]],"Bucky NPI Adm0")
-    bucky_no_npi_adm0=get_bucky(country_iso3,admin_level='adm0', min_date=min_date, max_date=max_date, npi_filter='no_npi')
-    quality_check_negative(bucky_no_npi_adm0, "Bucky NO NPI Adm0")
-    quality_check_nan(bucky_no_npi_adm0, "Bucky NO NPI Adm0")
-    quality_check_nondecreasing(bucky_no_npi_adm0.loc[bucky_npi_adm0["quantile"]==0.5,["cumulative_cases","cumulative_reported_cases","cumulative_deaths"]],"Bucky NO NPI Adm0")
+    bucky_npi_adm0=session.get_bucky(admin_level='adm0', min_date=min_date, max_date=max_date, npi_filter='npi')
+    issues+=quality_check_nan(bucky_npi_adm0, "Bucky NPI Adm0")
+    issues+=quality_check_negative(bucky_npi_adm0,"Bucky NPI Adm0")
+    issues+=quality_check_nondecreasing(bucky_npi_adm0.loc[bucky_npi_adm0["quantile"]==0.5,["cumulative_cases","cumulative_reported_cases","cumulative_deaths"]],"Bucky NPI Adm0")
+    bucky_no_npi_adm0=session.get_bucky(admin_level='adm0', min_date=min_date, max_date=max_date, npi_filter='no_npi')
+    issues+=quality_check_negative(bucky_no_npi_adm0, "Bucky NO NPI Adm0")
+    issues+=quality_check_nan(bucky_no_npi_adm0, "Bucky NO NPI Adm0")
+    issues+=quality_check_nondecreasing(bucky_no_npi_adm0.loc[bucky_no_npi_adm0["quantile"]==0.5,["cumulative_cases","cumulative_reported_cases","cumulative_deaths"]],"Bucky NO NPI Adm0")
     #don't do quality check nondecreasing for adm1 level because you would have to do this for every admin separately
-    bucky_npi_adm1=get_bucky(country_iso3,admin_level='adm1', min_date=min_date, max_date=max_date, npi_filter='npi')
-    quality_check_negative(bucky_npi_adm1, "Bucky NPI Adm1")
-    quality_check_nan(bucky_npi_adm1, "Bucky NPI Adm1")
-    bucky_no_npi_adm1=get_bucky(country_iso3,admin_level='adm1', min_date=min_date, max_date=max_date, npi_filter='no_npi')
-    quality_check_negative(bucky_no_npi_adm1, "Bucky NO NPI Adm1")
-    quality_check_nan(bucky_no_npi_adm1, "Bucky NO NPI Adm1")
-
-def get_bucky(country_iso3,admin_level,min_date,max_date,npi_filter):
-    bucky_df=pd.read_csv(f'Bucky_results/{country_iso3}_{npi_filter}/{admin_level}_quantiles.csv')
+    bucky_npi_adm1=session.get_bucky(admin_level='adm1', min_date=min_date, max_date=max_date, npi_filter='npi')
+    issues+=quality_check_negative(bucky_npi_adm1, "Bucky NPI Adm1")
+    issues+=quality_check_nan(bucky_npi_adm1, "Bucky NPI Adm1")
+    bucky_no_npi_adm1=session.get_bucky(admin_level='adm1', min_date=min_date, max_date=max_date, npi_filter='no_npi')
+    issues+=quality_check_negative(bucky_no_npi_adm1, "Bucky NO NPI Adm1")
+    issues+=quality_check_nan(bucky_no_npi_adm1, "Bucky NO NPI Adm1")
+    return issues
+
+def get_bucky_filename(country_iso3,admin_level,npi_filter):
+    return f'Bucky_results/{country_iso3}_{npi_filter}/{admin_level}_quantiles.csv'
+
+def get_file_signature(filename):
+    #modification time and size identify the version of a file without having to read it. The change time is added since it is
+    #updated by every write and can't be set back, such that a rewrite that keeps the modification time and size is also detected
+    file_stat=os.stat(filename)
+    return f'{file_stat.st_mtime_ns}-{file_stat.st_size}-{file_stat.st_ctime_ns}'
+
+def get_bucky_cache(country_iso3,admin_level,npi_filter):
+    """
+    Return the path to the parquet copy of a Bucky csv. The copy is created on first use and recreated when the csv changed since the conversion
+    Args:
+        country_iso3: iso3 code of the country of interest
+        admin_level: admin level of the Bucky output, i.e. adm0 or adm1
+        npi_filter: scenario of the Bucky output, i.e. npi or no_npi
+    Returns:
+        cache_filename: path to the parquet file
+    """
+    import pyarrow.parquet as pq
+    csv_filename=get_bucky_filename(country_iso3,admin_level,npi_filter)
+    cache_filename=f'{BUCKY_CACHE_DIR}/{country_iso3}_{npi_filter}/{admin_level}_quantiles.parquet'
+    signature=f'{get_file_signature(csv_filename)}-v{BUCKY_CACHE_VERSION}'
+    if os.path.exists(cache_filename):
+        cache_metadata=pq.read_schema(cache_filename).metadata or {}
+        if cache_metadata.get(b'source_signature')==signature.encode():
+            return cache_filename
+    convert_bucky_to_parquet(csv_filename,cache_filename,signature,admin_level)
+    return cache_filename
+
+def get_bucky_csv_dtypes(csv_filename,admin_level):
+    #the quantiles keep their exact values, since they are compared with ==
+    #the other adm1 metrics are stored as float32 to halve the size of the largest input, the metrics that feed the outputs keep float64
+    columns=pd.read_csv(csv_filename,nrows=0).columns
+    return {c:'float64' if admin_level!='adm1' or c in BUCKY_ADM1_FLOAT64_METRICS else 'float32'
+            for c in columns if c not in ['adm0','adm1','date','quantile']}
+
+def get_line_boundaries(content,boundary_numbers):
+    """
+    Find the byte positions of a selection of line boundaries, where boundary k is the position after the k-th line break.
+    The content is scanned in blocks of BUCKY_CSV_CHUNK_SIZE bytes, such that the memory doesn't grow with the size of the file
+    Args:
+        content: array of the bytes of the file, e.g. a memmap
+        boundary_numbers: sorted array with the numbers of the boundaries to find
+    Returns:
+        positions: array with the byte position of every selected boundary that exists
+        num_boundaries: the number of boundaries in the file, counting the end of the file if the last line has no line break
+    """
+    positions=np.zeros(len(boundary_numbers),dtype=np.int64)
+    found=0
+    num_breaks=0
+    for block_start in range(0,len(content),BUCKY_CSV_CHUNK_SIZE):
+        breaks=np.flatnonzero(content[block_start:block_start+BUCKY_CSV_CHUNK_SIZE]==ord('\n'))
+        #the selected boundaries that follow a line break of this block
+        end=np.searchsorted(boundary_numbers,num_breaks+len(breaks))
+        positions[found:end]=block_start+breaks[boundary_numbers[found:end]-num_breaks]+1
+        found=end
+        num_breaks+=len(breaks)
+    if len(content)>0 and content[-1]!=ord('\n'):
+        positions[found:][boundary_numbers[found:]==num_breaks]=len(content)
+        return positions,num_breaks+1
+    return positions,num_breaks
+
+def build_csv_date_index(csv_filename,date_column='date'):
+    """
+    Index the byte ranges of the rows of every date in a csv, such that the rows of a date can be read without parsing the rest of the file
+    The file is not required to be sorted by date, a date that occurs in several blocks of rows, e.g. once per admin unit, gets a range per block
+    Args:
+        csv_filename: path to the csv, without quoted line breaks
+        date_column: name of the date column
+    Returns:
+        dict with the byte position of the end of the header and per date a dict with the byte ranges [start, end) and the number of rows
+    """
+    block_starts=[]
+    block_dates=[]
+    num_rows=0
+    previous_date=None
+    for chunk in pd.read_csv(csv_filename,usecols=[date_column],dtype=str,chunksize=BUCKY_CSV_CHUNK_SIZE):
+        dates=chunk[date_column].to_numpy()
+        #a new block starts at every row of which the date differs from the previous row
+        changes=np.flatnonzero(dates!=np.concatenate([[previous_date],dates[:-1]]))
+        block_starts.append(changes+num_rows)
+        block_dates+=list(dates[changes])
+        num_rows+=len(dates)
+        previous_date=dates[-1]
+    block_starts=np.concatenate(block_starts+[[num_rows]]).astype(int)
+    #only the byte positions of the end of the header and of the starts of the blocks are needed
+    boundary_numbers=np.unique(np.concatenate([[0],block_starts]))
+    positions,num_boundaries=get_line_boundaries(np.memmap(csv_filename,dtype=np.uint8,mode='r'),boundary_numbers)
+    if num_rows!=num_boundaries-1:
+        raise ValueError(f'{csv_filename} has {num_boundaries-1} lines after the header but {num_rows} rows')
+    boundaries=dict(zip(boundary_numbers.tolist(),positions.tolist()))
+    dates={}
+    for block_date,start,end in zip(block_dates,block_starts[:-1],block_starts[1:]):
+        date_ranges=dates.setdefault(block_date,{'ranges':[],'rows':0})
+        date_ranges['ranges'].append([boundaries[start],boundaries[end]])
+        date_ranges['rows']+=int(end-start)
+    return {'header_end':boundaries[0],'dates':dict(sorted(dates.items()))}
+
+def get_csv_date_index(csv_filename,index_filename):
+    #the index is saved next to the parquet copy and rebuilt when the csv changed
+    signature=get_file_signature(csv_filename)
+    if os.path.exists(index_filename):
+        with open(index_filename,'r') as f:
+            date_index=json.load(f)
+        if date_index.get('source_signature')==signature:
+            return date_index
+    date_index={'source_signature':signature,**build_csv_date_index(csv_filename)}
+    os.makedirs(os.path.dirname(index_filename),exist_ok=True)
+    write_json(index_filename,date_index)
+    return date_index
+
+def read_csv_dates(csv_filename,date_index,dates,dtype=None):
+    """
+    Parse the rows of the given dates of a csv, by reading only their byte ranges
+    Args:
+        csv_filename: path to the csv
+        date_index: index of the csv, see build_csv_date_index
+        dates: list of the dates to read as strings in the format of the csv. The rows are returned in this order
+        dtype: dtypes of the columns, passed to pd.read_csv
+    Returns:
+        DataFrame with the rows of the dates
+    """
+    with open(csv_filename,'rb') as f:
+        content=[f.read(date_index['header_end'])]
+        for date in dates:
+            for start,end in date_index['dates'][date]['ranges']:
+                f.seek(start)
+                content.append(f.read(end-start))
+    return pd.read_csv(io.BytesIO(b''.join(content)),dtype=dtype)
+
+@profiler.profiled(category='io')
+def convert_bucky_to_parquet(csv_filename,cache_filename,signature,admin_level):
+    """
+    Convert a Bucky csv to a typed parquet file, sorted by date, with the signature of the csv stored in the metadata
+    The csv is read in batches of dates through its date index and every batch is written in row groups of BUCKY_CACHE_ROW_GROUP_SIZE rows,
+    such that the memory used is bounded by the batch size and a date filter only decodes the row groups that overlap the requested dates
+    Args:
+        csv_filename: path to the Bucky csv
+        cache_filename: path to write the parquet file to
+        signature: signature of the csv, see get_file_signature
+        admin_level: admin level of the Bucky output, i.e. adm0 or adm1
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    dtypes=get_bucky_csv_dtypes(csv_filename,admin_level)
+    date_index=get_csv_date_index(csv_filename,f'{os.path.splitext(cache_filename)[0]}_dates.json')
     #first date is used as an initalization date. This causes daily numbers to sometimes give odd values. The cumulative numbers should equal the last historical number of the subnational data
     #we are removing the first date to be sure the data is clean and since the first date is not a projection yet, this doesn't remove valuable data
-    bucky_df=bucky_df[bucky_df['date']>bucky_df['date'].min()]
-    bucky_df['date']=pd.to_datetime(bucky_df['date']).dt.date
-    bucky_df=bucky_df[(bucky_df['date']>=min_date) &
-                        (bucky_df['date']<=max_date)]
-    bucky_df=bucky_df.set_index('date')
+    dates=list(date_index['dates'])[1:]
+    #group the dates in batches of about BUCKY_CSV_CHUNK_SIZE rows
+    batches=[[]]
+    batch_rows=0
+    for date in dates:
+        if batch_rows>=BUCKY_CSV_CHUNK_SIZE:
+            batches.append([])
+            batch_rows=0
+        batches[-1].append(date)
+        batch_rows+=date_index['dates'][date]['rows']
+    os.makedirs(os.path.dirname(cache_filename),exist_ok=True)
+    #write to a temporary file first such that an interrupted conversion never leaves a truncated cache
+    tmp_filename=f'{cache_filename}.{os.getpid()}.tmp'
+    writer=None
+    try:
+        for batch in batches:
+            if batch:
+                chunk=read_csv_dates(csv_filename,date_index,batch,dtypes)
+            else:
+                #a csv without projected dates gives an empty cache, with the types of the rows of the first date
+                chunk=read_csv_dates(csv_filename,date_index,list(date_index['dates'])[:1],dtypes).iloc[:0]
+            chunk['date']=pd.to_datetime(chunk['date']).dt.date
+            table=pa.Table.from_pandas(chunk,preserve_index=False)
+            table=table.set_column(table.schema.get_field_index('date'),'date',table['date'].cast(pa.date32()))
+            if writer is None:
+                schema=table.schema.with_metadata({**table.schema.metadata,b'source_signature':signature.encode()})
+                writer=pq.ParquetWriter(tmp_filename,schema)
+            writer.write_table(table.replace_schema_metadata(schema.metadata),row_group_size=BUCKY_CACHE_ROW_GROUP_SIZE)
+        writer.close()
+        os.replace(tmp_filename,cache_filename)
+    finally:
+        #the temporary file of a failed conversion is removed
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def read_parquet_slice(filename,date_column,min_date=None,max_date=None,columns=None,filters=None):
+    import pyarrow.parquet as pq
+    #only the requested columns are read and the filters are applied while reading, the date filters also skip the row groups outside the requested window
+    filters=list(filters or [])
+    if min_date is not None:
+        filters.append((date_column,'>=',min_date))
+    if max_date is not None:
+        filters.append((date_column,'<=',max_date))
+    table=pq.read_table(filename,columns=columns,filters=filters or None)
+    df=table.to_pandas()
+    df=df.set_index(date_column)
+    return df
+
+def read_bucky_cache(cache_filename,min_date=None,max_date=None,columns=None,quantiles=None):
+    """
+    Read a window of the parquet copy of a Bucky csv
+    Args:
+        cache_filename: path to the parquet file, see get_bucky_cache
+        min_date: first date to read (inclusive)
+        max_date: last date to read (inclusive)
+        columns: list of the metrics to read. If None, all metrics are read
+        quantiles: list of the quantiles to read. If None, all quantiles are read
+    Returns:
+        DataFrame indexed by date, with the admin and quantile columns as categoricals
+    """
+    import pyarrow.parquet as pq
+    key_columns=[c for c in ['adm0','adm1','quantile'] if c in pq.read_schema(cache_filename).names]
+    if columns is not None:
+        columns=key_columns+['date']+[c for c in columns if c not in key_columns+['date']]
+    filters=[('quantile','in',list(quantiles))] if quantiles is not None else None
+    bucky_df=read_parquet_slice(cache_filename,'date',min_date,max_date,columns,filters)
+    #only the rows that passed the filters are converted
+    for column in key_columns:
+        bucky_df[column]=bucky_df[column].astype('category')
     return bucky_df
-    
-def get_who(filename,country_iso2,min_date,max_date):
-    # Get national level data from WHO
+
+def load_bucky(country_iso3,admin_level,npi_filter):
+    cache_filename=get_bucky_cache(country_iso3,admin_level,npi_filter)
+    return read_bucky_cache(cache_filename)
+
+@profiler.profiled(category='io')
+def get_bucky(country_iso3,admin_level,min_date,max_date,npi_filter,columns=None,as_cube=False,quantiles=None):
+    cache_filename=get_bucky_cache(country_iso3,admin_level,npi_filter)
+    bucky_df=read_bucky_cache(cache_filename,min_date,max_date,columns,quantiles)
+    if as_cube:
+        return QuantileCube.from_frame(bucky_df)
+    return bucky_df
+
+class QuantileCube:
+    """
+    Dense representation of Bucky outputs, with the values stored in one array with axes admin unit x date x quantile x metric.
+    Retrieving a value or series is a lookup on the axes instead of a scan over the rows of the long-format frame
+    Args:
+        values: array of shape (admin units, dates, quantiles, metrics). Combinations that are not in the model output are nan
+        admins: the admin units, i.e. the adm0 or adm1 codes
+        dates: the dates
+        quantiles: the quantiles
+        metrics: the names of the metrics
+    """
+    def __init__(self,values,admins,dates,quantiles,metrics):
+        self.values=values
+        self.admins=pd.Index(admins)
+        self.dates=pd.Index(dates,name='date')
+        self.quantiles=pd.Index(quantiles)
+        self.metrics=pd.Index(metrics)
+
+    @classmethod
+    def from_frame(cls,bucky_df):
+        """
+        Build the cube from the long-format Bucky frame, as returned by get_bucky
+        Args:
+            bucky_df: DataFrame indexed by date with an adm0 or adm1 column, a quantile column and a column per metric
+        Returns:
+            QuantileCube of the frame
+        """
+        admin_column='adm1' if 'adm1' in bucky_df.columns else 'adm0'
+        metrics=[c for c in bucky_df.columns if c not in ['adm0','adm1','quantile']]
+        admin_codes,admins=pd.factorize(bucky_df[admin_column],sort=True)
+        date_codes,dates=pd.factorize(bucky_df.index,sort=True)
+        quantile_codes,quantiles=pd.factorize(bucky_df['quantile'],sort=True)
+        values=np.full((len(admins),len(dates),len(quantiles),len(metrics)),np.nan)
+        values[admin_codes,date_codes,quantile_codes]=bucky_df[metrics].to_numpy(dtype=float)
+        return cls(values,admins,dates,quantiles,metrics)
+
+    def _admin_position(self,admin):
+        #the admin unit can be omitted if the cube contains only one, e.g. for adm0
+        if admin is None:
+            if len(self.admins)!=1:
+                raise ValueError(f'admin has to be given for a cube with {len(self.admins)} admin units')
+            return 0
+        return self.admins.get_loc(admin)
+
+    def value(self,metric,date,quantile=0.5,admin=None):
+        """
+        Retrieve the value of a metric on a date
+        Args:
+            metric: name of the metric
+            date: the date to retrieve the value of
+            quantile: the quantile to retrieve the value of
+            admin: the admin unit. Can be omitted if the cube contains only one admin unit
+        Returns:
+            the value
+        """
+        return self.values[self._admin_position(admin),self.dates.get_loc(date),self.quantiles.get_loc(quantile),self.metrics.get_loc(metric)]
+
+    def series(self,metric,quantile=0.5,admin=None):
+        """
+        Retrieve the values of a metric over all dates
+        Args:
+            metric: name of the metric
+            quantile: the quantile to retrieve the values of
+            admin: the admin unit. Can be omitted if the cube contains only one admin unit
+        Returns:
+            Series of the values, indexed by date
+        """
+        values=self.values[self._admin_position(admin),:,self.quantiles.get_loc(quantile),self.metrics.get_loc(metric)]
+        return pd.Series(values,index=self.dates,name=metric)
+
+    def median(self,metric,admin=None):
+        #series of the median projection of the metric
+        return self.series(metric,0.5,admin)
+
+    def band(self,metric,lower_quantile,upper_quantile,admin=None):
+        """
+        Retrieve the uncertainty band of a metric between two quantiles
+        Args:
+            metric: name of the metric
+            lower_quantile: the quantile of the lower bound
+            upper_quantile: the quantile of the upper bound
+            admin: the admin unit. Can be omitted if the cube contains only one admin unit
+        Returns:
+            lower: Series with the lower bound, indexed by date
+            upper: Series with the upper bound, indexed by date
+        """
+        return self.series(metric,lower_quantile,admin),self.series(metric,upper_quantile,admin)
+
+    def slice(self,min_date=None,max_date=None):
+        """
+        Select the dates between min_date and max_date (inclusive)
+        Args:
+            min_date: first date to select. If None, the dates are selected from the start
+            max_date: last date to select. If None, the dates are selected till the end
+        Returns:
+            QuantileCube with the selected dates
+        """
+        selection=np.ones(len(self.dates),dtype=bool)
+        if min_date is not None:
+            selection&=self.dates>=min_date
+        if max_date is not None:
+            selection&=self.dates<=max_date
+        return QuantileCube(self.values[:,selection],self.admins,self.dates[selection],self.quantiles,self.metrics)
+
+    def mean(self,metric):
+        #mean of the metric over all admin units, dates and quantiles, ignoring the missing combinations
+        return np.nanmean(self.values[...,self.metrics.get_loc(metric)])
+
+def get_who_partition_dir(filename):
+    return f'{WHO_CACHE_DIR}/{os.path.splitext(os.path.basename(filename))[0]}'
+
+@profiler.profiled(category='io')
+def ingest_who_covid_data(filename):
+    """
+    Split the global WHO csv into one typed parquet partition per country, such that the data of a country can be read without parsing the global file.
+    The signature of the csv is saved next to the partitions to detect when they are outdated
+    Args:
+        filename: path to the global WHO csv
+    Returns:
+        partition_dir: directory containing the partitions
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    partition_dir=get_who_partition_dir(filename)
+    signature=get_file_signature(filename)
     who_covid=pd.read_csv(filename)
     who_covid=who_covid.rename(columns=lambda x: x.strip())
-    who_covid=who_covid[who_covid['Country_code']==country_iso2]
     who_covid['Date_reported']=pd.to_datetime(who_covid['Date_reported']).dt.date
-    who_covid=who_covid[(who_covid['Date_reported']>=min_date) &\
-                        (who_covid['Date_reported']<=max_date)]
-    who_covid=who_covid.set_index('Date_reported')
-    return who_covid
+    os.makedirs(partition_dir,exist_ok=True)
+    partitions=set()
+    for country_iso2,who_country in who_covid.groupby('Country_code'):
+        table=pa.Table.from_pandas(who_country.sort_values(by='Date_reported'),preserve_index=False)
+        #the temporary file is unique per process, such that concurrent ingests don't write to the same file
+        pq.write_table(table,f'{partition_dir}/{country_iso2}.parquet.{os.getpid()}.tmp')
+        os.replace(f'{partition_dir}/{country_iso2}.parquet.{os.getpid()}.tmp',f'{partition_dir}/{country_iso2}.parquet')
+        partitions.add(f'{country_iso2}.parquet')
+    #remove the partitions of countries that are no longer in the csv, such that they are reported as having no data
+    for partition in os.listdir(partition_dir):
+        if partition.endswith('.parquet') and partition not in partitions:
+            os.remove(f'{partition_dir}/{partition}')
+    #the signature is written last, so that partitions of an interrupted ingest are never considered up to date
+    write_json(f'{partition_dir}/_source.json',{'source_signature':signature,'columns':list(who_covid.columns)})
+    return partition_dir
 
+def get_who_partition(filename,country_iso2):
+    #ingest the global csv if it hasn't been ingested yet or changed since the last ingest
+    partition_dir=get_who_partition_dir(filename)
+    source_filename=f'{partition_dir}/_source.json'
+    ingest_info={}
+    if os.path.exists(source_filename):
+        with open(source_filename,'r') as f:
+            ingest_info=json.load(f)
+    if ingest_info.get('source_signature')!=get_file_signature(filename):
+        ingest_who_covid_data(filename)
+    return f'{partition_dir}/{country_iso2}.parquet'
 
-def get_subnational_covid_data(parameters,aggregate,min_date,max_date):
+def load_who(filename,country_iso2):
+    return get_who(filename,country_iso2,min_date=None,max_date=None)
+
+@profiler.profiled(category='io')
+def get_who(filename,country_iso2,min_date,max_date):
+    # Get national level data from WHO
+    partition_filename=get_who_partition(filename,country_iso2)
+    if not os.path.exists(partition_filename):
+        logger.warning(f'WHO: No data for country code {country_iso2}')
+        with open(f'{get_who_partition_dir(filename)}/_source.json','r') as f:
+            columns=json.load(f)['columns']
+        return pd.DataFrame(columns=columns).set_index('Date_reported')
+    return read_parquet_slice(partition_filename,'Date_reported',min_date,max_date)
+
+def aggregate_subnational_covid_data(subnational_covid):
+    """
+    Sum the subnational numbers to national numbers per date, where a pcode that didn't report on a date is counted with its last reported value.
+    Instead of forward filling every combination of date and pcode, the national total is computed as the cumulative sum of the changes in the reported values,
+    such that it scales with the number of reported values instead of the number of dates times the number of pcodes
+    Args:
+        subnational_covid: DataFrame with a row per date and adm2 pcode
+    Returns:
+        DataFrame indexed by date with the national total of each numeric column
+    """
+    date_codes,dates=pd.factorize(subnational_covid[HLX_TAG_DATE],sort=True)
+    pcode_codes,_=pd.factorize(subnational_covid[HLX_TAG_ADM2_PCODE])
+    #order the reports by pcode and date, such that the previous report of a pcode is the previous row
+    order=np.lexsort((date_codes,pcode_codes))
+    date_codes=date_codes[order]
+    pcode_codes=pcode_codes[order]
+    totals={}
+    for c in subnational_covid.select_dtypes(include=[np.number]).columns:
+        values=subnational_covid[c].to_numpy(dtype=float)[order]
+        #missing values are forward filled as well, so only the reported values change the total
+        reported=~np.isnan(values)
+        values=values[reported]
+        value_dates=date_codes[reported]
+        value_pcodes=pcode_codes[reported]
+        #the change wrt the previous reported value of the pcode, the first report of a pcode is a change wrt 0
+        changes=np.diff(values,prepend=0)
+        first_report=np.ones(len(values),dtype=bool)
+        first_report[1:]=value_pcodes[1:]!=value_pcodes[:-1]
+        changes[first_report]=values[first_report]
+        totals[c]=np.cumsum(np.bincount(value_dates,weights=changes,minlength=len(dates)))
+    return pd.DataFrame(totals,index=pd.Index(dates,name=HLX_TAG_DATE))
+
+@profiler.profiled(category='io')
+def load_subnational_covid_data(parameters,aggregate):
     # get subnational from COVID parameterization repo
-    subnational_covid=pd.read_csv(parameters['subnational_cases_url'])
+    subnational_covid=pd.read_csv(fetch_url(parameters['subnational_cases_url']))
     subnational_covid[HLX_TAG_DATE]=pd.to_datetime(subnational_covid[HLX_TAG_DATE]).dt.date
     subnational_covid=subnational_covid.sort_values(by=HLX_TAG_DATE)
     if aggregate:
-        # date and adm2 are the unique keys
-        dates=sorted(set(subnational_covid[HLX_TAG_DATE]))
-        adm2pcodes=set(subnational_covid[HLX_TAG_ADM2_PCODE])
-        unique_keys=[HLX_TAG_DATE,HLX_TAG_ADM2_PCODE]
-        # create a multi-index to fill missing combinations with None values
-        mind = pd.MultiIndex.from_product([dates,adm2pcodes],names=unique_keys)
-        subnational_covid=subnational_covid.set_index(unique_keys).reindex(mind,fill_value=None)
-        # forward fill missing values for each pcode
-        subnational_covid=subnational_covid.groupby(HLX_TAG_ADM2_PCODE).ffill()
-        # sum by date
-        subnational_covid=subnational_covid.groupby(HLX_TAG_DATE).sum()
-
-    #only select the subset of dates after aggregation
+        subnational_covid=aggregate_subnational_covid_data(subnational_covid)
+
+    #the subset of dates is only selected after aggregation (see slice_dates)
     #else with forward filling of missing values, there is no good startdata which messes up the estimations
     subnational_covid=subnational_covid.reset_index()
     #during the aggregatoin this changes to a date instead of datetime object, so set it again to datetime
     subnational_covid[HLX_TAG_DATE] = pd.to_datetime(subnational_covid[HLX_TAG_DATE]).dt.date
-    subnational_covid=subnational_covid[(subnational_covid[HLX_TAG_DATE]>=min_date) &\
-                                        (subnational_covid[HLX_TAG_DATE]<=max_date)]
     subnational_covid=subnational_covid.set_index(HLX_TAG_DATE)
-
     return subnational_covid
 
+def get_subnational_covid_data(parameters,aggregate,min_date,max_date):
+    subnational_covid=load_subnational_covid_data(parameters,aggregate)
+    return slice_dates(subnational_covid,min_date,max_date)
 
-def create_new_subplot(fig_title):
-    fig,axis=plt.subplots(figsize=(FIG_SIZE[0],FIG_SIZE[1]))
-    
-    locator = mdates.AutoDateLocator(minticks=3, maxticks=7)
-    formatter = mdates.DateFormatter('%d %b')
-    axis.xaxis.set_major_locator(locator)
-    axis.xaxis.set_major_formatter(formatter)
-
-    axis.set_title(fig_title)
-    x_axis = axis.axes.get_xaxis()
-    x_label = x_axis.get_label()
-    x_label.set_visible(False)
-    axis.grid(linestyle='-', linewidth='0.5', color='black',alpha=0.2)
-    return fig,axis
+def slice_dates(df,min_date,max_date):
+    #select the rows of a date-indexed dataframe between min_date and max_date (inclusive)
+    #a copy is returned such that callers can modify the slice without altering the source dataframe
+    return df[(df.index>=min_date) & (df.index<=max_date)].copy()
 
-def get_bucky_dt_reff(df_bucky):
-    # start fit
-    dates_proj = df_bucky.index
-    xfit=[(x-dates_proj[0]).days for x in dates_proj]
-    yfit = df_bucky['cumulative_reported_cases']
-    initial_caseload=yfit[0]
-    initial_parameters=[initial_caseload,0.03]
-    # # TODO check quality of the fit
-    popt, _ = curve_fit(func,xfit,yfit,p0=initial_parameters)
-    doubling_time_fit=np.log(2)/popt[1]
+class DataSession:
+    """
+    Data context of one country for the duration of a run.
+    Each source (Bucky adm0 per npi filter, WHO, subnational) is parsed once on first use and kept in memory,
+    after which every request for a date window is served as a slice of the parsed data.
+    The Bucky adm1 outputs are the largest input, so they are not kept in memory, every request reads only its window from the parquet copy.
+    Args:
+        country_iso3: iso3 code of the country of interest
+        parameters: country specific parameters, retrieved from config
+        who_filename: path to the global WHO csv
+    """
+    def __init__(self,country_iso3,parameters,who_filename):
+        self.country_iso3=country_iso3
+        self.parameters=parameters
+        self.who_filename=who_filename
+        self._bucky={}
+        self._who=None
+        self._subnational={}
+
+    @profiler.profiled(category='io')
+    def get_bucky(self,admin_level,min_date,max_date,npi_filter,columns=None,as_cube=False,quantiles=None):
+        if admin_level=='adm1':
+            return get_bucky(self.country_iso3,admin_level,min_date,max_date,npi_filter,columns,as_cube,quantiles)
+        key=(admin_level,npi_filter)
+        if key not in self._bucky:
+            self._bucky[key]=load_bucky(self.country_iso3,admin_level,npi_filter)
+        bucky_df=self._bucky[key]
+        if columns is not None:
+            bucky_df=bucky_df[[c for c in bucky_df.columns if c in ['adm0','adm1','quantile'] or c in columns]]
+        if quantiles is not None:
+            bucky_df=bucky_df[bucky_df['quantile'].isin(quantiles)]
+        if as_cube:
+            #no copy of the slice is needed, the cube holds its own array
+            return QuantileCube.from_frame(bucky_df[(bucky_df.index>=min_date) & (bucky_df.index<=max_date)])
+        return slice_dates(bucky_df,min_date,max_date)
+
+    @profiler.profiled(category='io')
+    def get_who(self,min_date,max_date):
+        if self._who is None:
+            self._who=load_who(self.who_filename,self.parameters['iso2_code'])
+        return slice_dates(self._who,min_date,max_date)
+
+    @profiler.profiled(category='io')
+    def get_subnational_covid_data(self,aggregate,min_date,max_date):
+        if aggregate not in self._subnational:
+            self._subnational[aggregate]=load_subnational_covid_data(self.parameters,aggregate)
+        return slice_dates(self._subnational[aggregate],min_date,max_date)
+
+
+@profiler.profiled(category='io')
+def read_dbf(filename,columns=None,encoding='UTF-8'):
+    """
+    Read the attribute table of a dBase (.dbf) file, i.e. the attributes of a shapefile, without parsing any geometry
+    Args:
+        filename: path to the .dbf file
+        columns: list of the columns to read. If None, all columns are read
+        encoding: encoding of the text fields
+    Returns:
+        DataFrame with one row per record that is not flagged as deleted
+    """
+    with open(filename,'rb') as f:
+        content=f.read()
+    num_records=int.from_bytes(content[4:8],'little')
+    header_length=int.from_bytes(content[8:10],'little')
+    record_length=int.from_bytes(content[10:12],'little')
+    # the field descriptors are 32 bytes each and are terminated by 0x0D
+    fields=[]
+    for offset in range(32,header_length-1,32):
+        descriptor=content[offset:offset+32]
+        if descriptor[0]==0x0D:
+            break
+        name=descriptor[:11].split(b'\x00')[0].decode(encoding)
+        fields.append((name,chr(descriptor[11]),descriptor[16],descriptor[17]))
+    # every record starts with a deletion flag, followed by the fixed width fields
+    record_dtype=np.dtype([('_deleted','S1')]+[(f'_field{i}',f'S{length}') for i,(_,_,length,_) in enumerate(fields)])
+    records=np.frombuffer(content,dtype=record_dtype,count=num_records,offset=header_length)
+    records=records[records['_deleted']!=b'*']
+    df=pd.DataFrame()
+    for i,(name,field_type,length,decimals) in enumerate(fields):
+        if columns is not None and name not in columns:
+            continue
+        values=pd.Series(records[f'_field{i}']).str.decode(encoding).str.strip(' \x00')
+        empty=values==''
+        if field_type in ('N','F'):
+            values=pd.to_numeric(values.mask(empty))
+            if decimals==0 and not empty.any():
+                values=values.astype(np.int64)
+        elif field_type=='L':
+            values=values.str.upper().isin(['T','Y'])
+        else:
+            if field_type=='D':
+                values=values.str.slice(0,4)+'-'+values.str.slice(4,6)+'-'+values.str.slice(6,8)
+            # empty fields are missing values, as when reading the shapefile with geopandas
+            values=values.astype(object)
+            values[empty]=None
+        df[name]=values
+    if columns is not None:
+        df=df[columns]
+    return df
+
+class ShapefileRegistry:
+    """
+    Registry of the shapefiles in the config, keyed by their path.
+    Parsed shapefiles are kept in memory for the run and cached as parquet on disk, such that later runs don't have to parse the shapefile again.
+    Attributes can be retrieved without parsing any geometry
+    """
+    def __init__(self):
+        self._shapefiles={}
+
+    def get_attributes(self,shape,columns=None):
+        """
+        Retrieve the attributes of the admin regions, read from the .dbf of the shapefile
+        Args:
+            shape: path to the shapefile, as given in the config
+            columns: list of the columns to read. If None, all columns are read
+        Returns:
+            DataFrame with the attributes of the shapefile
+        """
+        if shape in self._shapefiles:
+            return pd.DataFrame(self._shapefiles[shape].drop(columns='geometry'))[columns or slice(None)]
+        return read_dbf(f'{os.path.splitext(shape)[0]}.dbf',columns)
+
+    def get_shapefile(self,shape):
+        """
+        Retrieve the shapefile including the geometry
+        Args:
+            shape: path to the shapefile, as given in the config
+        Returns:
+            GeoDataFrame of the shapefile. This is a copy, so it can be modified without altering the registry
+        """
+        if shape not in self._shapefiles:
+            self._shapefiles[shape]=self._read_shapefile(shape)
+        return self._shapefiles[shape].copy()
+
+    def _read_shapefile(self,shape):
+        import geopandas as gpd
+        #the cache is valid as long as none of the files that make up the shapefile changed
+        shape_basename=os.path.splitext(shape)[0]
+        signature=','.join(get_file_signature(f'{shape_basename}{ext}') for ext in ['.shp','.shx','.dbf','.prj','.cpg'] if os.path.exists(f'{shape_basename}{ext}'))
+        #the cache is keyed by the full path, such that shapefiles with the same name in different directories have their own cache
+        path_hash=hashlib.sha1(os.path.realpath(shape).encode()).hexdigest()[:12]
+        cache_filename=f'{SHAPEFILE_CACHE_DIR}/{os.path.basename(shape_basename)}_{path_hash}.parquet'
+        signature_filename=f'{cache_filename}.json'
+        if os.path.exists(signature_filename):
+            with open(signature_filename,'r') as f:
+                if json.load(f)['source_signature']==signature:
+                    return gpd.read_parquet(cache_filename)
+        with profiler.span('gpd.read_file','io',shape=shape):
+            shapefile=gpd.read_file(shape,encoding='UTF-8')
+        os.makedirs(SHAPEFILE_CACHE_DIR,exist_ok=True)
+        #the countries that are run in parallel share the cache, so the files are written to a temporary file first
+        shapefile.to_parquet(f'{cache_filename}.{os.getpid()}.tmp')
+        os.replace(f'{cache_filename}.{os.getpid()}.tmp',cache_filename)
+        #the signature is written last, such that it never validates a cache of which the parquet is not written yet
+        write_json(signature_filename,{'source_signature':signature})
+        #return the shapefile as read from the cache, such that it is the same with and without a cache hit
+        return gpd.read_parquet(cache_filename)
+
+shapefile_registry=ShapefileRegistry()
+
+def fit_growth_rates(x, y, max_iterations=50, tolerance=1e-10):
+    """
+    Fit func (exponential growth) to many series at once, with the same least squares objective as curve_fit.
+    The parameters are initialized by a log-linear least squares fit in closed form, and refined with Gauss-Newton iterations on all series at once.
+    The series that don't converge are fitted with curve_fit
+    Args:
+        x: array with the x values, shared by all series
+        y: array of shape (number of series, len(x)) with the values to fit
+        max_iterations: maximum number of Gauss-Newton iterations
+        tolerance: relative change of the parameters below which a fit has converged
+    Returns:
+        array with the fitted growth rate (beta of func) of each series. nan if the series contains missing values or can't be fitted
+    """
+    x=np.asarray(x,dtype=float)
+    y=np.atleast_2d(np.asarray(y,dtype=float))
+    complete=~np.isnan(y).any(axis=1)
+    # log-linear least squares on the positive values, i.e. log(y)=log(p0)+beta*x
+    with np.errstate(divide='ignore',invalid='ignore'):
+        log_y=np.log(y)
+    positive=np.isfinite(log_y)
+    x_positive=np.where(positive,x,0.)
+    log_y_positive=np.where(positive,log_y,0.)
+    n=positive.sum(axis=1)
+    sum_x=x_positive.sum(axis=1)
+    sum_log_y=log_y_positive.sum(axis=1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        beta=(n*(x_positive*log_y_positive).sum(axis=1)-sum_x*sum_log_y)/(n*(x_positive**2).sum(axis=1)-sum_x**2)
+        p0=np.exp((sum_log_y-beta*sum_x)/n)
+    # Gauss-Newton on the residuals y-func(x,p0,beta), solving the 2x2 normal equations of every series in closed form
+    converged=np.zeros(len(y),dtype=bool)
+    active=complete & np.isfinite(beta) & np.isfinite(p0)
+    with np.errstate(over='ignore',divide='ignore',invalid='ignore'):
+        for _ in range(max_iterations):
+            if not active.any():
+                break
+            growth=np.exp(np.outer(beta[active],x))
+            residuals=y[active]-p0[active,None]*growth
+            jacobian_p0=growth
+            jacobian_beta=p0[active,None]*x*growth
+            a00=(jacobian_p0**2).sum(axis=1)
+            a01=(jacobian_p0*jacobian_beta).sum(axis=1)
+            a11=(jacobian_beta**2).sum(axis=1)
+            b0=(jacobian_p0*residuals).sum(axis=1)
+            b1=(jacobian_beta*residuals).sum(axis=1)
+            det=a00*a11-a01**2
+            step_p0=(a11*b0-a01*b1)/det
+            step_beta=(a00*b1-a01*b0)/det
+            p0[active]+=step_p0
+            beta[active]+=step_beta
+            done=(np.abs(step_p0)<=tolerance*np.abs(p0[active])) & (np.abs(step_beta)<=tolerance*np.maximum(np.abs(beta[active]),tolerance))
+            failed=~np.isfinite(step_p0) | ~np.isfinite(step_beta)
+            converged[np.flatnonzero(active)[done & ~failed]]=True
+            active[np.flatnonzero(active)[done | failed]]=False
+    # fall back to curve_fit for the complete series that didn't converge
+    for i in np.flatnonzero(complete & ~converged):
+        from scipy.optimize import curve_fit
+        try:
+            popt, _ = curve_fit(func,x,y[i],p0=[y[i][0],0.03])
+            beta[i]=popt[1]
+        except (RuntimeError,ValueError):
+            beta[i]=np.nan
+    beta[~complete]=np.nan
+    return beta
+
+def calc_Reff_from_growth_rate(r):
     # parameters suggested by Matt
     Tg = 7.
     Ts = 5.
     n = 3
     f = .4
     m = 2
-    r = np.log(2)/doubling_time_fit
     Te=calc_Te(Tg, Ts, n, f)
-    reff=calc_Reff(m, n, Tg, Te, r)
+    return calc_Reff(m, n, Tg, Te, r)
+
+def get_bucky_dt_reff(df_bucky):
+    # start fit
+    dates_proj = df_bucky.index
+    xfit=[(x-dates_proj[0]).days for x in dates_proj]
+    yfit = df_bucky['cumulative_reported_cases']
+    # # TODO check quality of the fit
+    r=fit_growth_rates(xfit,yfit.to_numpy())[0]
+    doubling_time_fit=np.log(2)/r
+    reff=calc_Reff_from_growth_rate(r)
     # old method
     # # https://www.acpjournals.org/doi/10.7326/M20-0504
     # infectious_period=5.2
@@ -263,6 +1063,27 @@ def get_bucky_dt_reff(df_bucky):
     # reff=1+(np.log(2)/doubling_time_fit)*infectious_period
     return doubling_time_fit,reff
 
+@profiler.profiled(category='compute')
+def get_bucky_dt_reff_distribution(bucky_cube):
+    """
+    Estimate the doubling time and Reff from the reported cumulative cases of every admin unit and quantile at once
+    Args:
+        bucky_cube: QuantileCube with the model projections over the period to estimate the doubling time on
+    Returns:
+        DataFrame with the doubling time and Reff per admin unit and quantile
+    """
+    values=bucky_cube.values[...,bucky_cube.metrics.get_loc('cumulative_reported_cases')]
+    # one series per admin unit and quantile
+    series=values.transpose(0,2,1).reshape(-1,len(bucky_cube.dates))
+    xfit=[(x-bucky_cube.dates[0]).days for x in bucky_cube.dates]
+    r=fit_growth_rates(xfit,series)
+    with np.errstate(divide='ignore'):
+        doubling_time=np.log(2)/r
+    return pd.DataFrame({'adm':np.repeat(bucky_cube.admins.to_numpy(),len(bucky_cube.quantiles)),
+                         'quantile':np.tile(bucky_cube.quantiles.to_numpy(),len(bucky_cube.admins)),
+                         'doubling_time':doubling_time,
+                         'Reff':calc_Reff_from_growth_rate(r)})
+
 def calc_Te(Tg, Ts, n, f):
     num = 2.0 * n * f / (n + 1.0) * Tg - Ts
     den = 2.0 * n * f / (n + 1.0) - 1.0
@@ -291,6 +1112,7 @@ def lighten_color(color, amount=0.5):
     >> lighten_color('#F034A3', 0.6)
     >> lighten_color((.3,.55,.1), 0.5)
     """
+    import matplotlib.colors as mc
 
     try:
         c = mc.cnames[color]